@@ -0,0 +1,181 @@
+"""BK-tree Class."""
+import heapq
+
+from simmeasure import levenshtein_dist
+
+
+class BKTree:
+    """Class that implements a BK-tree (Burkhard-Keller tree) over strings
+     using the edit (Levenshtein) distance, to find the values most similar to
+     a query value (using the similarity of editdist()) without comparing the
+     query with all values.
+
+     Each node contains a string, the positions (numbers) of the values equal
+     to this string, the maximum length of the strings in its subtree, a
+     dictionary with its child nodes, keyed by their edit distance to the
+     string of the node, and the counts of the characters in its string.
+     Because the edit distance is a metric, if the query has distance k to a
+     node then all strings in the child subtree with key e have a distance of
+     at least |k - e| to the query (triangle inequality).
+  """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def __init__(self, val_list):
+        """Build the tree for the given list of strings, where a value is
+       identified by its position in the list.
+
+       Empty strings are not inserted, as their similarity with any value is
+       0 (see editdist()).
+    """
+
+        self.root = None
+
+        for (pos, val) in enumerate(val_list):
+            if (val != ''):
+                self.__insert__(val, pos)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def __insert__(self, val, pos):
+        """Insert one value with its position into the tree.
+    """
+
+        val_len = len(val)
+
+        if (self.root == None):
+            self.root = [val, [pos], val_len, {}, self.__get_char_count__(val)]
+            return
+
+        node = self.root
+        while True:
+            node[2] = max(node[2], val_len)  # Maximum length in the subtree
+
+            dist = levenshtein_dist(val, node[0])
+            if (dist == 0):
+                node[1].append(pos)
+                return
+
+            child_dict = node[3]
+            if (dist not in child_dict):
+                child_dict[dist] = [val, [pos], val_len, {}, self.__get_char_count__(val)]
+                return
+
+            node = child_dict[dist]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def __get_char_count__(self, val):
+        """Return a dictionary with the number of occurrences of each character
+       in the given string.
+    """
+
+        char_count_dict = {}
+        for c in val:
+            char_count_dict[c] = char_count_dict.get(c, 0) + 1
+
+        return char_count_dict
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def find_most_similar(self, query_val):
+        """Find the value most similar to the given query value, where the
+       similarity is 1 - edit distance / maximum length of the two strings,
+       as calculated by editdist().
+
+       The method returns a pair (similarity, position) with the largest
+       similarity (above 0.0) and the smallest position of all values with
+       this similarity, which is the value an exhaustive scan over all values
+       in position order finds when it only keeps a value if it is more
+       similar than the best value so far. If no value has a similarity above
+       0.0 then (0.0, None) is returned.
+
+       Subtrees are visited in order of an upper bound of the similarity of
+       their values, based on the triangle inequality and the maximum length
+       of their strings, and skipped if this bound is below the best
+       similarity found so far. Distances are only calculated as far as they
+       can matter, using a lower bound from the counts of the characters
+       first.
+    """
+
+        best_sim = 0.0
+        best_pos = None
+
+        if (self.root == None) or (query_val == ''):
+            return best_sim, best_pos
+
+        query_len = len(query_val)
+        query_char_count = self.__get_char_count__(query_val)
+
+        # Nodes to visit with an upper bound of the similarities in their
+        # subtrees
+        #
+        node_heap = [(-1.0, 0, self.root)]
+
+        while (node_heap != []):
+            neg_max_sim, _, node = heapq.heappop(node_heap)
+            max_sim = -neg_max_sim
+
+            node_val, node_pos_list, node_max_len, child_dict, node_char_count = node
+
+            # Values are inserted in position order, so the first position of
+            # a node is the smallest in its subtree. A subtree is skipped if
+            # it cannot contain a more similar value, or an equally similar
+            # one with a smaller position.
+            #
+            if (max_sim < best_sim) or ((max_sim == best_sim) and
+                                        ((best_sim == 0.0) or (node_pos_list[0] > best_pos))):
+                continue
+
+            # Only distances up to max_dist can make this value at least as
+            # similar as the best so far (max_dist includes a margin of 1 so
+            # rounding does not matter), for larger distances only a lower
+            # bound (larger than max_dist) is used to skip child subtrees
+            #
+            max_dist = int((1.0 - best_sim) * max(query_len, len(node_val))) + 1
+
+            # Lower bound of the distance from the counts of common characters
+            #
+            num_common = 0
+            for (c, count) in query_char_count.items():
+                num_common += min(count, node_char_count.get(c, 0))
+            dist = max(query_len, len(node_val)) - num_common
+
+            if (dist <= max_dist):
+                dist = levenshtein_dist(query_val, node_val, max_dist)
+            else:
+                dist = max_dist + 1
+
+            if (dist <= max_dist):  # Exact distance
+                sim_val = 1.0 - float(dist) / float(max(query_len, len(node_val)))
+
+                if (sim_val > best_sim) or ((sim_val == best_sim) and (sim_val > 0.0) and
+                                            (node_pos_list[0] < best_pos)):
+                    best_sim = sim_val
+                    best_pos = node_pos_list[0]
+
+                min_dist_funct = lambda child_dist: abs(dist - child_dist)
+
+            else:  # Only a lower bound of the distance
+                min_dist_funct = lambda child_dist: max(dist - child_dist, 0)
+
+            # Upper bounds of the similarities in the child subtrees, using
+            # the minimum distance from the triangle inequality and from the
+            # lengths of the strings
+            #
+            cand_child_list = []
+
+            for (child_dist, child_node) in child_dict.items():
+                child_max_len = child_node[2]
+                min_dist = max(min_dist_funct(child_dist), query_len - child_max_len)
+                child_max_sim = 1.0 - float(min_dist) / float(max(query_len, child_max_len))
+
+                if (child_max_sim >= best_sim):
+                    cand_child_list.append((child_max_sim, child_dist, child_node))
+
+            # The most promising subtrees are visited first
+            #
+            for (child_max_sim, child_dist, child_node) in cand_child_list:
+                heapq.heappush(node_heap, (-child_max_sim, child_node[1][0], child_node))
+
+        return best_sim, best_pos
@@ -52,6 +52,47 @@ RAND_SEED = 42
 
 HLSH_NUM_BIT = 45
 HLSH_NUM_ITER = 40
+HLSH_NUM_PROBE = 0  # Probed buckets per bucket (multi-probe LSH, e.g. 45 with 10 iterations)
+
+# Oversized HLSH blocks, with more records in a bucket or more record pairs
+# than these (None for no limit), are split using the keys of the following
+# iterations, or dropped if HLSH_SPLIT_OVERSIZED is False
+#
+HLSH_MAX_BUCKET_SIZE = None
+HLSH_MAX_BUCKET_PAIRS = None
+HLSH_SPLIT_OVERSIZED = True
+
+# If a pairs completeness is given, the numbers of HLSH bits and iterations
+# are tuned on a sample of the records before each BFLSH experiment, as the
+# cheapest of these settings predicted to reach it
+#
+HLSH_TUNE_MIN_PC = None  # E.g. 0.95
+HLSH_TUNE_NUM_BIT_LIST = [20, 30, 45, 60]
+HLSH_TUNE_NUM_ITER_LIST = [5, 10, 20, 40]
+
+# Pruning of similar neighbouring reference values in SNC2P (None for no
+# pruning), the fraction of the values compared, and the number of reference
+# values to sample after pruning (None to keep all)
+#
+SNC2P_PRUNE_MIN_SIM = None  # 0.6
+SNC2P_PRUNE_PREFIX_FRAC = 0.25
+SNC2P_PRUNE_NUM_REF_VAL = None
+
+# Similarities between reference values in hclustering, 'float32' needs a
+# third less memory but changes the merges of equally similar clusters (see
+# hclustering), and a directory stores them in memory-mapped files
+#
+HCLUST_SIM_DTYPE = 'float64'
+HCLUST_MEMMAP_DIR = None
+
+NUM_WORKERS = 1  # Number of worker processes to insert records into blocks
+
+DEDUP_BKV = True  # Place records with the same blocking key value only once
+
+CACHE_DIR = None  # Directory for cached clusters of (and similarities
+# between) reference values, e.g. './cache' (None for no caching). The cache
+# keys only cover the parameters and reference values, so remove the cache
+# after changing the code of a method or similarity measure.
 
 oz_file_name = 'datasets/OZ-clean-with-gname.csv'
 
@@ -124,6 +165,7 @@ def experiment(pprlclass, alice_data_file, bob_data_file, load_ref_data, ref_con
     print('Testing ', name)
     print('------------------------------------------------')
     obj = pprlclass(**args)
+    obj.dedup_bkv = DEDUP_BKV
 
     # load data
     obj.load_database_alice(alice_data_file, header_line=True, rec_id_col=0, ent_id_col=0)
@@ -207,7 +249,9 @@ for K in [100]:  # [3,10,20,50,100]:
         ATTR_BF_SAMPLE_LIST, HLSH_NUM_BIT, HLSH_NUM_ITER
         if 'KNN' in BLOCKING_METHODS:
             K = 3
-            args = dict(k=K, sim_measure=dice_sim.sim, min_sim_threshold=MIN_SIM_VAL, use_medoids=True)
+            args = dict(k=K, sim_measure=dice_sim.sim, min_sim_threshold=MIN_SIM_VAL, use_medoids=True,
+                        sim_matrix=dice_sim.sim_matrix, num_workers=NUM_WORKERS,
+                        cache_dir=CACHE_DIR)
             experiment(PPRLIndexKAnonymousNearestNeighbourClustering, oz_small_alice_file_name, oz_small_bob_file_name,
                        True, ref_config, assess_results, 'k-anonymous nearest neighbour clustering', 'knn', args, {})
 
@@ -220,7 +264,8 @@ for K in [100]:  # [3,10,20,50,100]:
         # ----------------------------------------------------------------------------
         if 'KASN_SIM' in BLOCKING_METHODS:
             args = dict(k=K, sim_measure=dice_sim.sim, min_sim_threshold=MIN_SIM_VAL, overlap=OVERLAP,
-                        sim_or_size='SIM')
+                        sim_or_size='SIM', num_workers=NUM_WORKERS,
+                        sim_pairs=dice_sim.sim_pairs, cache_dir=CACHE_DIR)
             experiment(PPRLIndexKAnonymousSortedNeighbour, oz_small_alice_file_name, oz_small_bob_file_name,
                        True, ref_config, assess_results, 'k-anonymous sorted neighbourhood SIM', 'kasn_sim', args, {})
 
@@ -229,15 +274,29 @@ for K in [100]:  # [3,10,20,50,100]:
             print()
             print()
             args = dict(k=K, sim_measure=dice_sim.sim, min_sim_threshold=MIN_SIM_VAL, overlap=OVERLAP,
-                        sim_or_size='SIZE')
+                        sim_or_size='SIZE', num_workers=NUM_WORKERS)
             experiment(PPRLIndexKAnonymousSortedNeighbour, oz_small_alice_file_name, oz_small_bob_file_name,
                        True, ref_config, assess_results, 'k-anonymous sorted neighbourhood SIZE', 'kasn_size', args, {})
 
         # ----------------------------------------------------------------------------
         if 'BFLSH' in BLOCKING_METHODS:
-            args = dict(num_hash_funct=N_HASH, one_bit_set_perc=SET_BIT_PERC, random_seed=RAND_SEED)
+            args = dict(num_hash_funct=N_HASH, one_bit_set_perc=SET_BIT_PERC, random_seed=RAND_SEED,
+                        num_workers=NUM_WORKERS, max_bucket_size=HLSH_MAX_BUCKET_SIZE,
+                        max_bucket_pairs=HLSH_MAX_BUCKET_PAIRS, split_oversized=HLSH_SPLIT_OVERSIZED)
             build_index_args = dict(attr_bf_sample_list=ATTR_BF_SAMPLE_LIST, num_bits_hlsh=HLSH_NUM_BIT,
-                                    num_iter_hlsh=HLSH_NUM_ITER)
+                                    num_iter_hlsh=HLSH_NUM_ITER, num_probe_hlsh=HLSH_NUM_PROBE)
+
+            if (HLSH_TUNE_MIN_PC != None):
+                tuner = PPRLIndexBloomFilterHLSH(**args)
+                tuner.load_database_alice(oz_small_alice_file_name, header_line=True, rec_id_col=0,
+                                          ent_id_col=0)
+                tuner.load_database_bob(oz_small_bob_file_name, header_line=True, rec_id_col=0,
+                                        ent_id_col=0)
+                hlsh_setting, _ = tuner.tune_parameters(OZ_ATTR_SEL_LIST, ATTR_BF_SAMPLE_LIST, HLSH_TUNE_MIN_PC,
+                                                        HLSH_TUNE_NUM_BIT_LIST, HLSH_TUNE_NUM_ITER_LIST)
+                if (hlsh_setting != None):
+                    build_index_args['num_bits_hlsh'], build_index_args['num_iter_hlsh'] = hlsh_setting
+                del tuner
             experiment(PPRLIndexBloomFilterHLSH, oz_small_alice_file_name, oz_small_bob_file_name,
                        False, None, assess_results, 'Bloom filter Hamming LSH', 'bflsh_clust', args, build_index_args)
 
@@ -245,7 +304,11 @@ for K in [100]:  # [3,10,20,50,100]:
 
         if 'KASN_2P_SIM' in BLOCKING_METHODS:
             args = dict(k=K, w=W, sim_measure=dice_sim.sim, min_sim_threshold=MIN_SIM_VAL, overlap=OVERLAP,
-                        sim_or_size='SIM')
+                        sim_or_size='SIM', num_workers=NUM_WORKERS,
+                        sim_pairs=dice_sim.sim_pairs, cache_dir=CACHE_DIR,
+                        prune_min_sim=SNC2P_PRUNE_MIN_SIM,
+                        prune_prefix_frac=SNC2P_PRUNE_PREFIX_FRAC,
+                        prune_num_ref_val=SNC2P_PRUNE_NUM_REF_VAL)
             ref_config_copy = ref_config.copy()
             ref_config_copy['two_party'] = True
             R = 10
@@ -256,7 +319,8 @@ for K in [100]:  # [3,10,20,50,100]:
         # ----------------------------------------------------------------------------
 
         if 'HCLUST_2P' in BLOCKING_METHODS:
-            args = dict(dist=editdist, nb=num_recs/10, wn=num_recs, ep=0.3)
+            args = dict(dist=editdist, nb=num_recs/10, wn=num_recs, ep=0.3, num_workers=NUM_WORKERS,
+                        cache_dir=CACHE_DIR, sim_dtype=HCLUST_SIM_DTYPE, memmap_dir=HCLUST_MEMMAP_DIR)
             experiment(hclustering, oz_small_alice_file_name, oz_small_bob_file_name,
                        True, ref_config, assess_results, '2-party hclustering', 'hclust', args, {})
 
@@ -0,0 +1,52 @@
+"""Pool of forked worker processes."""
+import multiprocessing
+
+# The function used by worker processes. It is set before the workers are
+# forked, so workers share the (read-only) data it refers to (clusters,
+# reference values, plans, ...) without pickling them.
+#
+_worker_funct = None
+
+
+def _call_worker_funct(arg):
+    """Call the function inherited from the parent process.
+  """
+
+    return _worker_funct(arg)
+
+
+def can_fork():
+    """Return True if worker processes can be forked on this platform.
+  """
+
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def fork_imap(funct, arg_list, num_workers):
+    """Apply the given function to each argument in arg_list in a pool of
+     num_workers forked worker processes, and yield the results in the order
+     of arg_list (as soon as they are available).
+
+     The function does not need to be picklable, as workers inherit it when
+     they are forked (only the arguments and results are pickled). Only one
+     pool can be in use at a time.
+  """
+
+    global _worker_funct
+
+    assert num_workers >= 1
+    assert can_fork()
+    assert _worker_funct == None, 'Another pool is in use'
+
+    _worker_funct = funct
+
+    try:
+        pool = multiprocessing.get_context('fork').Pool(num_workers)
+        try:
+            for result in pool.imap(_call_worker_funct, arg_list):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _worker_funct = None
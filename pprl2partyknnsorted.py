@@ -1,7 +1,7 @@
 import os
 import time
-import bisect
-from itertools import tee
+import random
+from functools import partial
 
 from pprlindex import PPRLIndex
 from config import SORTED_FIRST_VAL
@@ -22,7 +22,10 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
 
     # --------------------------------------------------------------------------
 
-    def __init__(self, k, w, sim_measure, min_sim_threshold, overlap, sim_or_size):
+    def __init__(self, k, w, sim_measure, min_sim_threshold, overlap, sim_or_size,
+                 num_workers=1, sim_pairs=None, cache_dir=None,
+                 prune_min_sim=None, prune_prefix_frac=0.25,
+                 prune_num_ref_val=None):
         """Initialise the class and set the required parameters.
 
        Arguments:
@@ -44,6 +47,31 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
                             minimum similarity between adjacent reference
                             values, or by merging blocks until they each
                             contain k record identifiers.
+       - num_workers        The number of worker processes used to insert
+                            records into the sorted reference values (default
+                            1, no worker processes).
+       - sim_pairs          An optional function which takes two lists of
+                            strings of the same length and returns the
+                            similarities of the pairs of strings at the same
+                            positions in one batch (such as
+                            DiceSim.sim_pairs()), used to calculate the
+                            similarities between adjacent reference values.
+       - cache_dir          An optional directory where the similarities
+                            between adjacent reference values are stored, so
+                            later runs with the same reference values do not
+                            need to calculate them again.
+       - prune_min_sim      If given, neighbouring sorted reference values are
+                            pruned before indexing: a value is only kept if
+                            the similarity between its prefix and the prefix
+                            of the previous kept value is below this
+                            threshold (otherwise the longer of the two values
+                            is kept). Default None, no pruning.
+       - prune_prefix_frac  The fraction of the length of the shorter of two
+                            neighbouring values that is compared when pruning
+                            (default 0.25).
+       - prune_num_ref_val  If given (and pruning is done), the pruned
+                            reference values are randomly sampled down to at
+                            most this number of values.
     """
 
         self.k = k
@@ -54,6 +82,23 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
         assert sim_or_size in ['SIM', 'SIZE']
         self.sim_or_size = sim_or_size
 
+        assert num_workers >= 1
+        self.num_workers = num_workers
+
+        self.sim_pairs = sim_pairs
+        self.cache_dir = cache_dir
+
+        self.adj_sim_dict = {}  # Similarities between adjacent reference
+        # values for each sorted list of reference values
+
+        if (prune_min_sim != None):
+            assert (prune_min_sim > 0.0) and (prune_min_sim <= 1.0), prune_min_sim
+            assert (prune_prefix_frac > 0.0) and (prune_prefix_frac <= 1.0), \
+                prune_prefix_frac
+        self.prune_min_sim = prune_min_sim
+        self.prune_prefix_frac = prune_prefix_frac
+        self.prune_num_ref_val = prune_num_ref_val
+
         self.ref_val_list_alice = None  # List of selected reference values
         self.ref_val_list_bob = None
 
@@ -115,41 +160,64 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
 
     # --------------------------------------------------------------------------
 
-    def __sort_appropriate_ref_values_alice__(self):
-        """Sort the reference values and assign an integer value (starting from 0)
-       to each according to this sorting.
-    """
+    def __select_appropriate_ref_values__(self, ref_val_list, random_seed):
+        """Sort the given reference values and prune values that are similar to
+       their previous value in the sorted list.
 
-        assert self.ref_val_list_alice != None
+       In one pass over the sorted values, the first prune_prefix_frac of each
+       value and of the previous kept value (of the length of the shorter of
+       the two) are compared with the similarity measure. If their similarity
+       is below prune_min_sim the value is kept, otherwise only the longer of
+       the two values is kept. If prune_num_ref_val is given the kept values
+       are then randomly sampled down to this number.
+
+       The method returns the sorted list of selected reference values.
+    """
 
-        random.seed(10)
+        sim_measure = self.sim_measure
+        prune_min_sim = self.prune_min_sim
+        prune_prefix_frac = self.prune_prefix_frac
 
-        sort_ref_val_list_alice = sorted(self.ref_val_list_alice)
+        sort_ref_val_list = sorted(ref_val_list)
 
-        final_ref_val_list_alice = []
+        final_ref_val_list = []
 
-        for i in range(len(sort_ref_val_list_alice) - 1):
-            this_ref_val = sort_ref_val_list_alice[i]
-            if len(final_ref_val_list_alice) == 0:
-                final_ref_val_list_alice.append(this_ref_val)
+        for this_ref_val in sort_ref_val_list:
+            if len(final_ref_val_list) == 0:
+                final_ref_val_list.append(this_ref_val)
             else:
-                prev_ref_val = final_ref_val_list_alice[-1]
-                min_len = min(len(this_ref_val), len(prev_ref_val)) / 4
-                if (self.sim_measure(this_ref_val[:min_len], prev_ref_val[:min_len]) < 0.6):
-                    ##if (stringcmp.winkler(this_ref_val,prev_ref_val) < 0.8):
-                    final_ref_val_list_alice.append(this_ref_val)
-                else:
-                    if len(this_ref_val) > len(prev_ref_val):
-                        final_ref_val_list_alice.remove(prev_ref_val)
-                        final_ref_val_list_alice.append(this_ref_val)
-
-        selected_ref_val_list_alice = []
-        if len(final_ref_val_list_alice) > (ref_vals / 1):
-            selected_ref_val_list_alice = random.sample(final_ref_val_list_alice, ref_vals / 1)
+                prev_ref_val = final_ref_val_list[-1]
+                min_len = int(prune_prefix_frac * min(len(this_ref_val), len(prev_ref_val)))
+                if (sim_measure(this_ref_val[:min_len], prev_ref_val[:min_len]) < prune_min_sim):
+                    final_ref_val_list.append(this_ref_val)
+                elif len(this_ref_val) > len(prev_ref_val):
+                    final_ref_val_list[-1] = this_ref_val  # Keep the longer value
+
+        num_ref_val = self.prune_num_ref_val
+        if (num_ref_val != None) and (len(final_ref_val_list) > int(num_ref_val)):
+            rand = random.Random(random_seed)
+            selected_ref_val_list = sorted(rand.sample(final_ref_val_list,
+                                                       int(num_ref_val)))
         else:
-            selected_ref_val_list_alice = final_ref_val_list_alice
+            selected_ref_val_list = final_ref_val_list
+
+        print('  Pruned %d reference values to %d (%d after sampling)' % \
+              (len(sort_ref_val_list), len(final_ref_val_list),
+               len(selected_ref_val_list)))
+
+        return selected_ref_val_list
+
+    # --------------------------------------------------------------------------
+
+    def __sort_appropriate_ref_values_alice__(self):
+        """Sort and prune the reference values and assign an integer value
+       (starting from 0) to each according to this sorting.
+    """
 
-        print(len(sort_ref_val_list_alice), len(final_ref_val_list_alice), len(selected_ref_val_list_alice))
+        assert self.ref_val_list_alice != None
+
+        selected_ref_val_list_alice = \
+            self.__select_appropriate_ref_values__(self.ref_val_list_alice, 10)
 
         ref_ind_dict_alice = {}
 
@@ -166,40 +234,14 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
     # --------------------------------------------------------------------------
 
     def __sort_appropriate_ref_values_bob__(self):
-        """Sort the reference values and assign an integer value (starting from 0)
-       to each according to this sorting.
+        """Sort and prune the reference values and assign an integer value
+       (starting from 0) to each according to this sorting.
     """
 
         assert self.ref_val_list_bob != None
 
-        random.seed(18)  # 18
-
-        sort_ref_val_list_bob = sorted(self.ref_val_list_bob)
-
-        final_ref_val_list_bob = []
-
-        for i in range(len(sort_ref_val_list_bob) - 1):
-            this_ref_val = sort_ref_val_list_bob[i]
-            if len(final_ref_val_list_bob) == 0:
-                final_ref_val_list_bob.append(this_ref_val)
-            else:
-                prev_ref_val = final_ref_val_list_bob[-1]
-                min_len = min(len(this_ref_val), len(prev_ref_val)) / 4
-                if (self.sim_measure(this_ref_val[:min_len], prev_ref_val[:min_len]) < 0.6):
-                    ##if (stringcmp.winkler(this_ref_val,prev_ref_val) < 0.8):
-                    final_ref_val_list_bob.append(this_ref_val)
-                else:
-                    if len(this_ref_val) > len(prev_ref_val):
-                        final_ref_val_list_bob.remove(prev_ref_val)
-                        final_ref_val_list_bob.append(this_ref_val)
-
-        selected_ref_val_list_bob = []
-        if len(final_ref_val_list_bob) > (ref_vals / 1):
-            selected_ref_val_list_bob = random.sample(final_ref_val_list_bob, ref_vals / 1)
-        else:
-            selected_ref_val_list_bob = final_ref_val_list_bob
-
-        print(len(sort_ref_val_list_bob), len(final_ref_val_list_bob), len(selected_ref_val_list_bob))
+        selected_ref_val_list_bob = \
+            self.__select_appropriate_ref_values__(self.ref_val_list_bob, 18)
 
         ref_ind_dict_bob = {}
 
@@ -215,16 +257,92 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
 
     # --------------------------------------------------------------------------
 
-    def __window__(self, iterable, size):
-        """Sliding window approach.
+    def __get_cand_rep_pairs__(self, rep_val_list, alice_rep_set, bob_rep_set):
+        """Find the candidate pairs of representative reference values by
+       moving a window over the sorted representative values of both
+       parties.
+
+       Arguments:
+       - rep_val_list   The sorted list of distinct representative values of
+                        Alice and Bob.
+       - alice_rep_set  The set of Alice's representative values.
+       - bob_rep_set    The set of Bob's representative values.
+
+       A window of 2*w values starts at each position in rep_val_list, and is
+       extended until it contains at least w values of each party (or until
+       the end of the list is reached). All pairs of an Alice and a Bob value
+       in the window are candidate pairs.
+
+       The end of the window never moves backwards, so it is moved with two
+       pointers, and a window can only add pairs that contain at least one
+       value beyond the end of the previous window. The candidate pairs are
+       therefore generated in linear time (plus the number of pairs) without
+       checking for duplicates.
+
+       The method returns the list of candidate [alice_rep, bob_rep] pairs,
+       in the order they first occur in a window.
     """
 
-        iters = tee(iterable, size)
+        w = self.w
+        skip = w * 2
+        num_rep_val = len(rep_val_list)
 
-        for i in range(1, size):
-            for each in iters[i:]:
-                next(each, None)
-        return zip(*iters)
+        is_alice_list = [(val in alice_rep_set) for val in rep_val_list]
+        is_bob_list = [(val in bob_rep_set) for val in rep_val_list]
+
+        cand_ref_list = []
+
+        win_alice_list = []  # Positions of Alice's values in the window
+        win_bob_list = []  # Positions of Bob's values in the window
+        alice_start = 0  # First positions in these lists inside the window
+        bob_start = 0
+
+        prev_end = -1  # Last position of the previous window
+        end = -1  # Last position of the current window
+
+        for start in range(num_rep_val - skip + 1):
+            # Move the start of the window
+            #
+            while (alice_start < len(win_alice_list)) and \
+                    (win_alice_list[alice_start] < start):
+                alice_start += 1
+            while (bob_start < len(win_bob_list)) and \
+                    (win_bob_list[bob_start] < start):
+                bob_start += 1
+
+            # Move the end of the window until it contains 2*w values and at
+            # least w values of each party
+            #
+            while (end < start + skip - 1) or \
+                    (((len(win_alice_list) - alice_start < w) or \
+                      (len(win_bob_list) - bob_start < w)) and \
+                     (end + 1 < num_rep_val)):
+                end += 1
+                if (is_alice_list[end] == True):
+                    win_alice_list.append(end)
+                if (is_bob_list[end] == True):
+                    win_bob_list.append(end)
+
+            # Generate the pairs with at least one value after the end of the
+            # previous window (all other pairs have been generated before)
+            #
+            if (end > prev_end):
+                new_bob_list = [rep_val_list[pos] for pos in win_bob_list[bob_start:] \
+                                if pos > prev_end]
+                win_bob_val_list = [rep_val_list[pos] for pos in win_bob_list[bob_start:]]
+
+                for alice_pos in win_alice_list[alice_start:]:
+                    alice_val = rep_val_list[alice_pos]
+                    if (alice_pos > prev_end):
+                        for bob_val in win_bob_val_list:
+                            cand_ref_list.append([alice_val, bob_val])
+                    else:
+                        for bob_val in new_bob_list:
+                            cand_ref_list.append([alice_val, bob_val])
+
+                prev_end = end
+
+        return cand_ref_list
 
     # --------------------------------------------------------------------------
 
@@ -256,36 +374,41 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
         block_dict = {}  # Resulting blocks generated
         blk_keys = []  # Resulting block keys
 
-        num_rec_done = 0
-
-        # Insert the records into the sorted reference dictionary
+        # Only the distinct SKVs need to be located in the sorted reference values
         #
-        for (rec_id, rec_list) in rec_dict.items():
-            num_rec_done += 1
-            if (num_rec_done % 10000 == 0):
-                print(num_rec_done, len(rec_dict))
+        rec_id_list, skv_ind_list, skv_list = \
+            self.__get_distinct_bkv__(rec_dict, attr_select_list)
 
-            # Generate the SKV for this record
-            #
-            sk_val = ''
-            for col_num in attr_select_list:
-                sk_val += rec_list[col_num]
+        # Find the position of each SKV in the sorted list of ref vals
+        #
+        skv_pos_list = self.__place_distinct_bkv__(
+            partial(self.__find_sorted_pos__, sort_ref_val_list), skv_list,
+            self.num_workers)
 
-            # Find the position of this SKV in the sorted list of ref vals and
-            # insert it into the corresponding list of record identifiers in the
-            # reference dictionary
-            #
-            pos = bisect.bisect(sort_ref_val_list, sk_val)
-            ref_val = ref_ind_dict[pos]
-            skvs_list = ref_val_dict[ref_val]
-            # skvs_list.append((sk_val,rec_id))  # Store value and record identifier
-            skvs_list.append(rec_id)
-            ref_val_dict[ref_val] = skvs_list
+        # Insert the records into the corresponding list of record identifiers
+        # in the sorted reference dictionary
+        #
+        pos_rec_id_list = self.__group_rec_ids_by_pos__(rec_id_list, skv_ind_list,
+                                                        skv_pos_list, len(ref_ind_dict))
+        for (pos, pos_rec_ids) in enumerate(pos_rec_id_list):
+            if (len(pos_rec_ids) > 0):
+                ref_val_dict[ref_ind_dict[pos]] = pos_rec_ids
 
         len_sort_ref_list = len(sort_ref_val_list)
 
         # a) max block criteria - min similarity between ref values
         if self.sim_or_size == 'SIM':
+            # The similarities between adjacent reference values only depend
+            # on the reference values, so they are only calculated once
+            #
+            sort_ref_val_tuple = tuple([ref_ind_dict[ref_ind] for ref_ind in \
+                                        range(len(ref_ind_dict))])
+            if (sort_ref_val_tuple not in self.adj_sim_dict):
+                self.adj_sim_dict[sort_ref_val_tuple] = self.__get_adjacent_sim_list__(
+                    sort_ref_val_tuple, sim_measure, self.sim_pairs, None,
+                    self.cache_dir)
+            adj_sim_list = self.adj_sim_dict[sort_ref_val_tuple]
+
             # Merge blocks if they contain less than k elements
             #
             i = 0
@@ -308,32 +431,30 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
                     # Similarity of the next (if not the last) ref value with this ref value
                     #
                     if ((i + j + 1) != len_sort_ref_list):
-                        next_ref_val = ref_ind_dict[i + j + 1]
-                        sim_val = sim_measure(this_ref_val, next_ref_val)
+                        sim_val = adj_sim_list[i + j]
 
                     j += 1
 
                 # If a block contains less than k elements (probably the last block)
                 # merge it with the previous block
                 #
+                # (blocks are generated in the order of the reference values, so
+                # the previous block is always the last one generated)
+                #
                 if (len(this_blk_elements_list) < k):
-                    prev_blk_str = '_' + str(i - 1) + '_'
-                    prev_blk_id = next(k for (k, v) in block_dict.items() if \
-                                       prev_blk_str in k)
+                    prev_blk_id = blk_keys.pop()
                     prev_blk_elements_list = block_dict[prev_blk_id]
                     this_blk_elements_list += prev_blk_elements_list
-                    block_id = prev_blk_id
+                    first_ref_ind = prev_blk_id[0]
                     del block_dict[prev_blk_id]  # Delete this block and add a new
                     # merged block
-                    blk_keys.remove(prev_blk_id)
                 else:
-                    block_id = 'b_'
+                    first_ref_ind = i
 
-                # Generate the block identifier of this block consisting of the indices
-                # of all the reference values in the block
+                # The block identifier of this block is the pair of the indices
+                # of the first and last reference values in the block
                 #
-                for b in range(j):
-                    block_id += str(i + b) + '_'
+                block_id = (first_ref_ind, i + j - 1)
 
                 # Insert the list of record identifiers for this block into final dict
                 #
@@ -353,8 +474,8 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
 
        Argument:
        - block_index       k-anonymous clusters: A dictionary with keys being
-                           the block key consisting of the integer numbers of
-                           the reference values in that block and values are
+                           the pairs of the integer numbers of the first and
+                           last reference values in that block and values are
                            the SKVs in the block.
        - ref_ind_dict      Reference values with integer values as keys
                            (with reference values sorted)
@@ -367,10 +488,8 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
         for key in keys_list:
             # Get the ids of reference values in each block
             #
-            ref_nums_list = key.split('_')
-            # First element will be 'b', and last will be empty, so not used
-            #
-            ref_nums = [int(i) for i in key.split('_')[1:-1]]
+            first_ref_ind, last_ref_ind = key
+            ref_nums = list(range(first_ref_ind, last_ref_ind + 1))
 
             # rep_refs = [random.choice(ref_nums)]
             # rep_ref_vals += rep_refs # 1 ref val
@@ -448,8 +567,10 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
 
         self.attr_select_list_alice = attr_select_list
 
-        self.__sort_ref_values_alice__()
-        # self.__sort_appropriate_ref_values_alice__()
+        if (self.prune_min_sim == None):
+            self.__sort_ref_values_alice__()
+        else:
+            self.__sort_appropriate_ref_values_alice__()
 
         assert self.rec_dict_alice != None
         # print self.sort_ref_val_list_alice
@@ -500,8 +621,10 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
 
         self.attr_select_list_bob = attr_select_list
 
-        self.__sort_ref_values_bob__()
-        # self.__sort_appropriate_ref_values_bob__()
+        if (self.prune_min_sim == None):
+            self.__sort_ref_values_bob__()
+        else:
+            self.__sort_appropriate_ref_values_bob__()
 
         assert self.rec_dict_bob != None
         # print self.sort_ref_val_list_bob
@@ -537,6 +660,13 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
     def generate_blocks(self):
         """Method which generates the blocks based on the built two index data
        structures.
+
+       The candidate pairs of representative values are grouped by the
+       clusters of Alice and Bob they represent, and one block is generated
+       for each candidate pair of clusters (in the order Alice's clusters
+       first occur in the candidate pairs). The number of candidate record
+       pairs is calculated from the cluster sizes before the blocks are
+       generated and stored in num_cand_rec_pairs.
     """
 
         block_dict = {}  # contains final candidate record pairs
@@ -550,8 +680,6 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
         alice_rep_vals = self.alice_rep_vals
         bob_rep_vals = self.bob_rep_vals
 
-        cand_ref_list = []
-
         start_time = time.time()
 
         rep_val_list = set(alice_rep_vals)
@@ -564,69 +692,50 @@ class PPRLIndex2PartyKAnonymousSortedNeighbour(PPRLIndex):
         if SORTED_FIRST_VAL in rep_val_list:
             rep_val_list.remove(SORTED_FIRST_VAL)
 
-        skip = w * 2
-        for each in self.__window__(rep_val_list, skip):
-            # print list(each)
-
-            num_alice_ref = 0
-            num_bob_ref = 0
-            this_win_alice_ref = []
-            this_win_bob_ref = []
-
-            this_window_list = list(each)
-            for val in this_window_list:
-                if val in alice_rep_vals:
-                    num_alice_ref += 1
-                    if val not in this_win_alice_ref:
-                        this_win_alice_ref.append(val)
-                if val in bob_rep_vals:
-                    num_bob_ref += 1
-                    if val not in this_win_bob_ref:
-                        this_win_bob_ref.append(val)
-
-            while num_alice_ref < w or num_bob_ref < w:
-                # print 'skip'
-                last_ele_this_list = this_window_list[-1]
-                current_pos = rep_val_list.index(last_ele_this_list)
-                if current_pos + 1 < len(rep_val_list):
-                    next_element = rep_val_list[current_pos + 1]
-                    this_window_list.append(next_element)
-                    # print this_window_list
-                    if next_element in alice_rep_vals:
-                        num_alice_ref += 1
-                        if next_element not in this_win_alice_ref:
-                            this_win_alice_ref.append(next_element)
-                    if next_element in bob_rep_vals:
-                        num_bob_ref += 1
-                        if next_element not in this_win_bob_ref:
-                            this_win_bob_ref.append(next_element)
-                    # print next_element
-                else:
-                    break
-
-            # print this_win_alice_ref
-            # print this_win_bob_ref
-
-            for this_alice_ref in this_win_alice_ref:
-                for this_bob_ref in this_win_bob_ref:
-                    if [this_alice_ref, this_bob_ref] not in cand_ref_list:
-                        cand_ref_list.append([this_alice_ref, this_bob_ref])
+        cand_ref_list = self.__get_cand_rep_pairs__(rep_val_list,
+                                                    set(alice_rep_vals), set(bob_rep_vals))
 
         # print cand_ref_list
         # print rep_val_list
 
-        cand_blk_key = 0
-        for cand_pair in cand_ref_list:
-            alice_rep, bob_rep = cand_pair
+        # Group the candidate pairs by the clusters of their representative
+        # values, so each pair of clusters is only used once
+        #
+        cand_clust_dict = {}  # Alice's clusters and lists of Bob's clusters
+        cand_clust_pair_set = set()
 
+        for (alice_rep, bob_rep) in cand_ref_list:
             alice_block = alice_rep_index[alice_rep]
+            bob_block = bob_rep_index[bob_rep]
+
+            if ((alice_block, bob_block) not in cand_clust_pair_set):
+                cand_clust_pair_set.add((alice_block, bob_block))
+                cand_clust_dict.setdefault(alice_block, []).append(bob_block)
+
+        # Each record is in one cluster of its party, so the number of
+        # candidate record pairs follows from the cluster sizes
+        #
+        num_cand_rec_pairs = 0
+        for (alice_block, bob_block_list) in cand_clust_dict.items():
+            num_alice_rec = len(index_alice[alice_block])
+            for bob_block in bob_block_list:
+                num_cand_rec_pairs += num_alice_rec * len(index_bob[bob_block])
+
+        print('%d candidate representative value pairs in %d cluster pairs ' % \
+              (len(cand_ref_list), len(cand_clust_pair_set)) + \
+              '(%d candidate record pairs)' % (num_cand_rec_pairs))
+
+        self.num_cand_rec_pairs = num_cand_rec_pairs
+
+        cand_blk_key = 0
+        for (alice_block, bob_block_list) in cand_clust_dict.items():
             alice_rec_ids = index_alice[alice_block]
 
-            bob_block = bob_rep_index[bob_rep]
-            bob_rec_ids = index_bob[bob_block]
+            for bob_block in bob_block_list:
+                bob_rec_ids = index_bob[bob_block]
 
-            block_dict[cand_blk_key] = (alice_rec_ids, bob_rec_ids)
-            cand_blk_key += 1
+                block_dict[cand_blk_key] = (alice_rec_ids, bob_rec_ids)
+                cand_blk_key += 1
 
         block_time = time.time() - start_time
         # print block_dict
@@ -2,11 +2,92 @@ import os
 import math
 import random
 import hashlib
+import numpy
+from functools import partial
 
 from pprlindex import PPRLIndex
 from config import QGRAM_LEN, QGRAM_PADDING, PADDING_END_CHAR, PADDING_START_CHAR
 
 
+class HLSHPlan:
+    """Class that holds all the (random) parameters both database owners need
+     to generate the same HLSH blocks: the attribute Bloom filter lengths,
+     the bits sampled from each attribute Bloom filter, the permutation used
+     to shuffle record Bloom filters, and the bits sampled from the record
+     Bloom filters in each HLSH iteration.
+
+     A plan is generated once (see PPRLIndexBloomFilterHLSH.build_plan()) and
+     not modified afterwards (its lists are tuples and its arrays are read
+     only). Besides the lists it also holds their numpy array forms as used
+     when generating blocks, and it can be pickled so it can be saved to and
+     loaded from a file.
+  """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def __init__(self, param_tuple, attr_bf_len_list, attr_bf_sel_list,
+                 shuffle_bit_list, hlsh_sample_bits_list):
+        """Initialise the plan and calculate the array forms of its lists.
+
+       Arguments:
+       - param_tuple            The parameters the plan was generated with
+                                (see PPRLIndexBloomFilterHLSH.__get_plan_param_tuple__()).
+       - attr_bf_len_list       The length of each attribute Bloom filter.
+       - attr_bf_sel_list       For each attribute the list of bits sampled
+                                from its Bloom filters.
+       - shuffle_bit_list       The permutation of record Bloom filter bits.
+       - hlsh_sample_bits_list  For each HLSH iteration the list of record
+                                Bloom filter bits that form its keys.
+    """
+
+        self.param_tuple = param_tuple
+
+        self.attr_bf_len_list = tuple(attr_bf_len_list)
+        self.attr_bf_sel_list = tuple([tuple(sel_list) for sel_list in attr_bf_sel_list])
+        self.shuffle_bit_list = tuple(shuffle_bit_list)
+        self.hlsh_sample_bits_list = tuple([tuple(bit_list) for bit_list in \
+                                            hlsh_sample_bits_list])
+
+        self.rec_bf_len = sum(self.attr_bf_len_list)
+
+        assert len(self.attr_bf_sel_list) == len(self.attr_bf_len_list)
+        assert len(self.shuffle_bit_list) == self.rec_bf_len
+
+        # For each attribute the column of each of its Bloom filter bits in the
+        # shuffled record Bloom filter (-1 if the bit is not sampled)
+        #
+        shuffle_bit_array = numpy.array(self.shuffle_bit_list, dtype=numpy.int64)
+
+        attr_col_array_list = []
+        attr_offset = 0
+        for (attr_bf_len, sel_list) in zip(self.attr_bf_len_list,
+                                           self.attr_bf_sel_list):
+            sel_bit_array = numpy.array(sorted(sel_list), dtype=numpy.int64)
+
+            attr_col_array = numpy.full(attr_bf_len, -1, dtype=numpy.int64)
+            attr_col_array[sel_bit_array] = shuffle_bit_array[sel_bit_array + attr_offset]
+            attr_col_array.setflags(write=False)
+
+            attr_col_array_list.append(attr_col_array)
+            attr_offset += attr_bf_len
+
+        self.attr_col_array_list = tuple(attr_col_array_list)
+
+        # For each HLSH iteration the sampled bits as an array
+        #
+        sample_bit_array_list = []
+        for bit_list in self.hlsh_sample_bits_list:
+            assert (min(bit_list) >= 0) and (max(bit_list) < self.rec_bf_len)
+
+            sample_bit_array = numpy.array(bit_list, dtype=numpy.int64)
+            sample_bit_array.setflags(write=False)
+            sample_bit_array_list.append(sample_bit_array)
+
+        self.sample_bit_array_list = tuple(sample_bit_array_list)
+
+
+# ============================================================================
+
 class PPRLIndexBloomFilterHLSH(PPRLIndex):
     """Class that implements a Bloom filter and Hamming Locality Sensitive
      hashing (LSH) approach for PPRL indexing.
@@ -25,7 +106,9 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
 
     # --------------------------------------------------------------------------
 
-    def __init__(self, num_hash_funct, one_bit_set_perc=50, random_seed=42):
+    def __init__(self, num_hash_funct, one_bit_set_perc=50, random_seed=42,
+                 plan_file_name=None, num_workers=1, max_bucket_size=None,
+                 max_bucket_pairs=None, split_oversized=True):
         """Initialise the class.
 
        Arguments:
@@ -39,6 +122,27 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
        - random_seed       An integer number. This argument is required to
                            make sure both database owners will generate the
                            same sequence of random values.
+       - plan_file_name    An optional file name for the HLSH plan (see
+                           HLSHPlan). If the file exists the plan is loaded
+                           from it, otherwise the generated plan is saved into
+                           it, so both database owners and later runs with the
+                           same parameters use the same plan without
+                           generating it again.
+       - num_workers       The number of worker processes used to convert
+                           records into Bloom filters and HLSH keys (default
+                           1, no worker processes). All random values are
+                           taken from the plan, so the blocks are the same
+                           for any number of workers.
+       - max_bucket_size   If given, a block where the bucket of Alice or of
+                           Bob contains more records than this is oversized.
+       - max_bucket_pairs  If given, a block with more record pairs (the size
+                           of the bucket of Alice times the size of the
+                           bucket of Bob) than this is oversized.
+       - split_oversized   If True (default) oversized blocks are split into
+                           smaller blocks using the HLSH keys of the records
+                           in the following iterations (and only dropped if
+                           they are still oversized after all iterations are
+                           used), if False oversized blocks are dropped.
     """
 
         assert num_hash_funct > 0
@@ -48,6 +152,16 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
         self.num_hash_funct = num_hash_funct
         self.one_bit_set_perc = one_bit_set_perc
         self.random_seed = random_seed
+        self.plan_file_name = plan_file_name
+
+        assert num_workers >= 1
+        self.num_workers = num_workers
+
+        assert (max_bucket_size == None) or (max_bucket_size >= 1)
+        assert (max_bucket_pairs == None) or (max_bucket_pairs >= 1)
+        self.max_bucket_size = max_bucket_size
+        self.max_bucket_pairs = max_bucket_pairs
+        self.split_oversized = split_oversized
 
         # The two databases by Alice and Bob
         #
@@ -66,6 +180,8 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
         # order of bit indexes to be used to shuffle
         # the record Bloom filters.
 
+        self.hlsh_plan = None  # The HLSHPlan the following lists are taken from
+
         self.hlsh_sample_bits_list = None  # List which will contain several sets
         # for the random bit positions that are
         # extracted from record Bloom filters
@@ -73,6 +189,20 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
         # (these correspond to the Hamming
         # locality sensitive hashing values).
 
+        # The record identifiers of the two databases, the indexes contain the
+        # buckets of each HLSH iteration with the numbers of their records
+        #
+        self.rec_id_list_alice = None
+        self.rec_id_list_bob = None
+
+        self.num_probe_hlsh = 0  # Number of probed buckets (multi-probe LSH)
+
+        self.bucket_size_hist_list = None  # For each iteration a pair with
+        # the histograms of the bucket sizes of
+        # Alice and Bob, where entry b is the
+        # number of buckets with a size from 2^b
+        # to 2^(b+1)-1.
+
         self.bf_cache = {}  # A cache for Bloom filters (keys are strings and
         # values their Bloom filters as sets)
 
@@ -208,8 +338,359 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
 
     # --------------------------------------------------------------------------
 
+    def __get_plan_param_tuple__(self, attr_select_list, attr_bf_sample_list,
+                                 num_bits_hlsh, num_iter_hlsh):
+        """Return a tuple with all parameters a HLSH plan depends on.
+    """
+
+        return (self.num_hash_funct, self.one_bit_set_perc, self.random_seed,
+                QGRAM_LEN, QGRAM_PADDING, tuple(attr_select_list),
+                tuple(attr_bf_sample_list), num_bits_hlsh, num_iter_hlsh)
+
+    # --------------------------------------------------------------------------
+
+    def build_plan(self, attr_select_list, attr_bf_sample_list, num_bits_hlsh,
+                   num_iter_hlsh):
+        """Generate a HLSH plan for the given parameters (see
+       build_index_alice() for their description).
+
+       The attribute Bloom filter lengths are calculated from records of
+       both databases, and all random values are drawn from a random number
+       generator seeded with random_seed, so both database owners generate
+       the same plan.
+
+       The method returns the generated HLSHPlan.
+    """
+
+        assert len(attr_select_list) == len(attr_bf_sample_list)
+
+        assert num_bits_hlsh > 0
+        assert num_iter_hlsh > 0
+
+        rand = random.Random(self.random_seed)
+
+        attr_bf_len_list = self.__calc_attr_bf_len__(attr_select_list)
+
+        # Generate list which specifies which bits to sample from each attribute
+        # Bloom filter
+        #
+        attr_bf_sel_list = []
+        for i in range(len(attr_select_list)):
+            attr_bf_len = attr_bf_len_list[i]  # Attribute BF length
+
+            # Number of bits to sample for this attribute
+            #
+            attr_bf_sample = int(math.ceil(float(attr_bf_sample_list[i]) / \
+                                           100.0 * attr_bf_len))
+            attr_bf_sel_list.append(rand.sample(list(range(attr_bf_len)),
+                                                attr_bf_sample))
+
+        rec_bf_len = sum(attr_bf_len_list)
+
+        # Generate a random permutation of bit positions
+        #
+        shuffle_bit_list = list(range(rec_bf_len))
+        rand.shuffle(shuffle_bit_list)
+
+        rec_bits = list(range(rec_bf_len))
+
+        # Generate num_iter_hlsh lists each containing num_bits_hlsh bit
+        # positions
+        #
+        hlsh_sample_bits_list = []
+        for i in range(num_iter_hlsh):
+            hlsh_sample_bits_list.append(rand.sample(rec_bits, num_bits_hlsh))
+
+        param_tuple = self.__get_plan_param_tuple__(attr_select_list,
+                                                    attr_bf_sample_list, num_bits_hlsh, num_iter_hlsh)
+
+        return HLSHPlan(param_tuple, attr_bf_len_list, attr_bf_sel_list,
+                        shuffle_bit_list, hlsh_sample_bits_list)
+
+    # --------------------------------------------------------------------------
+
+    def save_plan(self, file_name):
+        """Save the HLSH plan used by this index into the given file.
+    """
+
+        assert self.hlsh_plan != None
+
+        self.__save_cache__(file_name, self.hlsh_plan)
+
+    # --------------------------------------------------------------------------
+
+    def load_plan(self, file_name):
+        """Load a HLSH plan from the given file and use it for this index.
+    """
+
+        hlsh_plan = self.__load_cache__(file_name)
+        assert isinstance(hlsh_plan, HLSHPlan), file_name
+
+        self.__use_plan__(hlsh_plan)
+
+    # --------------------------------------------------------------------------
+
+    def __use_plan__(self, hlsh_plan):
+        """Use the given HLSH plan for this index.
+    """
+
+        self.hlsh_plan = hlsh_plan
+
+        self.attr_bf_len_list = list(hlsh_plan.attr_bf_len_list)
+        self.attr_bf_sel_list = [list(sel_list) for sel_list in hlsh_plan.attr_bf_sel_list]
+        self.rec_bf_len = hlsh_plan.rec_bf_len
+        self.shuffle_bit_list = list(hlsh_plan.shuffle_bit_list)
+        self.hlsh_sample_bits_list = [list(bit_list) for bit_list in \
+                                      hlsh_plan.hlsh_sample_bits_list]
+
+    # --------------------------------------------------------------------------
+
+    def __set_plan__(self, attr_select_list, attr_bf_sample_list, num_bits_hlsh,
+                     num_iter_hlsh):
+        """Make sure this index uses a HLSH plan for the given parameters,
+       which is the plan already in use, the plan in the plan file (if it
+       exists), or a newly generated plan (which is then saved into the plan
+       file if one is given).
+    """
+
+        param_tuple = self.__get_plan_param_tuple__(attr_select_list,
+                                                    attr_bf_sample_list, num_bits_hlsh, num_iter_hlsh)
+
+        if (self.hlsh_plan == None) and (self.plan_file_name != None) and \
+                os.path.exists(self.plan_file_name):
+            self.load_plan(self.plan_file_name)
+
+        if (self.hlsh_plan != None):
+            assert self.hlsh_plan.param_tuple == param_tuple, \
+                ('HLSH plan generated with different parameters',
+                 self.hlsh_plan.param_tuple, param_tuple)
+            return
+
+        self.__use_plan__(self.build_plan(attr_select_list, attr_bf_sample_list,
+                                          num_bits_hlsh, num_iter_hlsh))
+
+        if (self.plan_file_name != None):
+            self.save_plan(self.plan_file_name)
+
+    # --------------------------------------------------------------------------
+
+    def __get_sample_bf_matrix__(self, hlsh_plan, rec_dict, rec_id_list,
+                                 attr_select_list):
+        """Return the packed record Bloom filter matrix (see
+       __get_rec_bf_matrix__()) of the given records, one row per record in
+       the order of rec_id_list.
+    """
+
+        bkv_list = [tuple([rec_dict[rec_id][col_num] for col_num in attr_select_list]) \
+                    for rec_id in rec_id_list]
+
+        return self.__get_rec_bf_matrix__(hlsh_plan, bkv_list)
+
+    # --------------------------------------------------------------------------
+
+    def __get_collision_prob_array__(self, rec_bf_len, num_bits):
+        """Return a numpy array with, for each Hamming distance d from 0 to
+       rec_bf_len, the probability that two record Bloom filters with this
+       distance have the same key in one HLSH iteration, which is the
+       probability that none of the num_bits sampled bit positions (sampled
+       without replacement) is one of the d positions where they differ.
+    """
+
+        dist_array = numpy.arange(rec_bf_len + 1, dtype=numpy.float64)
+
+        prob_array = numpy.ones(rec_bf_len + 1, dtype=numpy.float64)
+        for k in range(num_bits):
+            prob_array *= numpy.maximum(rec_bf_len - dist_array - k, 0.0) / (rec_bf_len - k)
+
+        return prob_array
+
+    # --------------------------------------------------------------------------
+
+    def tune_parameters(self, attr_select_list, attr_bf_sample_list, min_pc,
+                        num_bits_list, num_iter_list, sample_size=1000):
+        """Find the cheapest number of bits and number of iterations for HLSH
+       that is predicted to reach the given pairs completeness, without
+       building the indexes.
+
+       Arguments:
+       - attr_select_list     A list of column numbers of the attributes (see
+                              build_index_alice()).
+       - attr_bf_sample_list  A list with the percentages of bits to sample
+                              from the attribute Bloom filters (see
+                              build_index_alice()).
+       - min_pc               The required pairs completeness (between 0 and
+                              1).
+       - num_bits_list        A list with the numbers of bits to sample from
+                              record Bloom filters to try.
+       - num_iter_list        A list with the numbers of iterations to try.
+       - sample_size          The number of records of Alice and of Bob, and
+                              the number of true matches (records of Alice
+                              and Bob with the same identifier, as in
+                              assess_blocks()), sampled from the databases.
+
+       The record Bloom filters of the sampled records are generated once,
+       with a plan for the largest number of bits and iterations. For each
+       setting the pairs completeness and the number of candidate record
+       pairs (distinct pairs with the same key in at least one iteration) are
+       predicted in two ways:
+       - analytically, from the Hamming distances of the sampled pairs, as
+         the expected values over all random plans, and
+       - empirically, from the keys of the sampled pairs using the first bits
+         and iterations of this one plan.
+
+       A setting meets the required pairs completeness if both predictions
+       reach it, and its cost is the analytically predicted number of
+       candidate pairs plus the number of records inserted into buckets (the
+       number of iterations times the number of records of Alice and Bob).
+
+       The method returns a pair with the cheapest setting as a pair
+       (num_bits_hlsh, num_iter_hlsh), or None if no setting meets min_pc,
+       and a list with a tuple (num_bits_hlsh, num_iter_hlsh, analytic pc,
+       empirical pc, analytic number of candidate pairs, empirical number of
+       candidate pairs, cost) for each setting.
+    """
+
+        assert self.rec_dict_alice != None
+        assert self.rec_dict_bob != None
+
+        assert (min_pc > 0.0) and (min_pc <= 1.0), min_pc
+        assert (num_bits_list != []) and (min(num_bits_list) > 0)
+        assert (num_iter_list != []) and (min(num_iter_list) > 0)
+        assert sample_size > 0
+
+        print()
+        print('Tune HLSH parameters for pairs completeness %.3f:' % (min_pc))
+
+        num_rec_alice = len(self.rec_dict_alice)
+        num_rec_bob = len(self.rec_dict_bob)
+
+        max_num_iter = max(num_iter_list)
+
+        hlsh_plan = self.build_plan(attr_select_list, attr_bf_sample_list,
+                                    max(num_bits_list), max_num_iter)
+        rec_bf_len = hlsh_plan.rec_bf_len
+
+        # Sample the true matches and the records of Alice and Bob
+        #
+        rand = random.Random(self.random_seed)
+
+        match_id_list = [rec_id for rec_id in self.rec_dict_alice if rec_id in self.rec_dict_bob]
+        assert match_id_list != [], 'No true matches in the databases'
+        match_id_list = rand.sample(match_id_list, min(sample_size, len(match_id_list)))
+
+        sample_id_list_alice = rand.sample(list(self.rec_dict_alice.keys()),
+                                           min(sample_size, num_rec_alice))
+        sample_id_list_bob = rand.sample(list(self.rec_dict_bob.keys()),
+                                         min(sample_size, num_rec_bob))
+
+        match_bf_matrix_alice = self.__get_sample_bf_matrix__(hlsh_plan, self.rec_dict_alice,
+                                                              match_id_list, attr_select_list)
+        match_bf_matrix_bob = self.__get_sample_bf_matrix__(hlsh_plan, self.rec_dict_bob,
+                                                            match_id_list, attr_select_list)
+        sample_bf_matrix_alice = self.__get_sample_bf_matrix__(hlsh_plan, self.rec_dict_alice,
+                                                               sample_id_list_alice, attr_select_list)
+        sample_bf_matrix_bob = self.__get_sample_bf_matrix__(hlsh_plan, self.rec_dict_bob,
+                                                             sample_id_list_bob, attr_select_list)
+
+        print('  Sampled %d true matches, %d records of Alice and %d of Bob' % \
+              (len(match_id_list), len(sample_id_list_alice), len(sample_id_list_bob)))
+
+        # Hamming distances of the true matches and of all pairs of sampled
+        # records, as the numbers of pairs with each distance
+        #
+        match_dist_array = numpy.unpackbits(match_bf_matrix_alice ^ match_bf_matrix_bob,
+                                            axis=1).sum(axis=1)
+        match_dist_count_array = numpy.bincount(match_dist_array, minlength=rec_bf_len + 1)
+
+        bit_matrix_alice = numpy.unpackbits(sample_bf_matrix_alice, axis=1).astype(numpy.float64)
+        bit_matrix_bob = numpy.unpackbits(sample_bf_matrix_bob, axis=1).astype(numpy.float64)
+
+        pair_dist_matrix = bit_matrix_alice.sum(axis=1)[:, None] + \
+                           bit_matrix_bob.sum(axis=1)[None, :] - \
+                           2.0 * numpy.dot(bit_matrix_alice, bit_matrix_bob.T)
+        pair_dist_count_array = numpy.bincount(numpy.rint(pair_dist_matrix).astype(numpy.int64).ravel(),
+                                               minlength=rec_bf_len + 1)
+
+        num_sample_pairs = len(sample_id_list_alice) * len(sample_id_list_bob)
+        pair_scale = float(num_rec_alice) * num_rec_bob / num_sample_pairs
+
+        result_list = []
+
+        for num_bits in sorted(set(num_bits_list)):
+            prob_array = self.__get_collision_prob_array__(rec_bf_len, num_bits)
+
+            # Pairs of the samples with the same key in at least one of the
+            # iterations so far
+            #
+            match_found_array = numpy.zeros(len(match_id_list), dtype=bool)
+            pair_found_matrix = numpy.zeros((len(sample_id_list_alice), len(sample_id_list_bob)),
+                                            dtype=bool)
+
+            for i in range(max_num_iter):
+                sample_bit_array = hlsh_plan.sample_bit_array_list[i][:num_bits]
+
+                key_array_list = [self.__get_hlsh_key_array__(rec_bf_matrix, sample_bit_array) \
+                                  for rec_bf_matrix in [match_bf_matrix_alice, match_bf_matrix_bob,
+                                                        sample_bf_matrix_alice, sample_bf_matrix_bob]]
+
+                # Number the keys (which can be Python integers) to compare
+                # them as integers
+                #
+                key_num_array = numpy.unique(numpy.concatenate(key_array_list),
+                                             return_inverse=True)[1].reshape(-1)
+                key_num_array_list = numpy.split(key_num_array,
+                                                 numpy.cumsum([len(key_array) for key_array \
+                                                               in key_array_list])[:-1])
+
+                match_found_array |= (key_num_array_list[0] == key_num_array_list[1])
+                pair_found_matrix |= (key_num_array_list[2][:, None] == key_num_array_list[3][None, :])
+
+                num_iter = i + 1
+                if (num_iter not in num_iter_list):
+                    continue
+
+                iter_prob_array = 1.0 - (1.0 - prob_array) ** num_iter
+
+                analytic_pc = float(numpy.dot(match_dist_count_array, iter_prob_array)) / \
+                              len(match_id_list)
+                empirical_pc = float(match_found_array.sum()) / len(match_id_list)
+
+                analytic_num_pairs = float(numpy.dot(pair_dist_count_array, iter_prob_array)) * \
+                                     pair_scale
+                empirical_num_pairs = float(pair_found_matrix.sum()) * pair_scale
+
+                cost = analytic_num_pairs + num_iter * (num_rec_alice + num_rec_bob)
+
+                result_list.append((num_bits, num_iter, analytic_pc, empirical_pc,
+                                    analytic_num_pairs, empirical_num_pairs, cost))
+
+        print('  Bits  Iterations  PC (analytic / empirical)  ' + \
+              'Candidate pairs (analytic / empirical)')
+
+        best_setting = None
+        best_cost = None
+
+        for (num_bits, num_iter, analytic_pc, empirical_pc, analytic_num_pairs,
+             empirical_num_pairs, cost) in result_list:
+            print('  %4d  %10d  %.4f / %.4f            %d / %d' % \
+                  (num_bits, num_iter, analytic_pc, empirical_pc,
+                   round(analytic_num_pairs), round(empirical_num_pairs)))
+
+            if (min(analytic_pc, empirical_pc) >= min_pc) and \
+                    ((best_cost == None) or (cost < best_cost)):
+                best_setting = (num_bits, num_iter)
+                best_cost = cost
+
+        if (best_setting == None):
+            print('  No setting reaches pairs completeness %.3f' % (min_pc))
+        else:
+            print('  Cheapest setting: %d bits and %d iterations' % best_setting)
+
+        return best_setting, result_list
+    # --------------------------------------------------------------------------
+
     def build_index_alice(self, attr_select_list, attr_bf_sample_list,
-                          num_bits_hlsh, num_iter_hlsh):
+                          num_bits_hlsh, num_iter_hlsh, num_probe_hlsh=0):
         """Method which builds the index for the first database owner.
 
        The generated index needs to be stored in the variable self.index_alice
@@ -226,69 +707,28 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
                               hashing (LSH) values.
        - num_iter_hlsh        Number of times a record Bloom filter is
                               sampled.
+       - num_probe_hlsh       Number of additional buckets of Bob (with keys
+                              that differ in one or two bits) that are paired
+                              with each bucket of Alice when generating the
+                              blocks (multi-probe LSH), default 0.
     """
 
-        # Set random seed so both database owners have the same start
-        #
-        random.seed(self.random_seed)
-
         assert self.rec_dict_alice != None
 
-        assert len(attr_select_list) == len(attr_bf_sample_list)
         self.attr_select_list = attr_select_list
 
-        assert num_bits_hlsh > 0
-        assert num_iter_hlsh > 0
+        assert num_probe_hlsh >= 0
+        self.num_probe_hlsh = num_probe_hlsh
 
-        if (self.shuffle_bit_list == None):
-            self.attr_bf_len_list = self.__calc_attr_bf_len__(attr_select_list)
+        self.__set_plan__(attr_select_list, attr_bf_sample_list, num_bits_hlsh,
+                          num_iter_hlsh)
 
-            # Generate list which specifies which bits to sample from each attribute
-            # Bloom filter
-            #
-            self.attr_bf_sel_list = []
-            i = 0
-            for i in range(len(attr_select_list)):
-                attr_bf_len = self.attr_bf_len_list[i]  # Attribute BF length
-
-                # Number of bits to sample for this attribute
-                #
-                attr_bf_sample = int(math.ceil(float(attr_bf_sample_list[i]) / \
-                                               100.0 * attr_bf_len))
-                self.attr_bf_sel_list.append(set(random.sample(list(range(attr_bf_len)),
-                                                               attr_bf_sample)))
-                # print i, attr_bf_len, attr_bf_sample, len(self.attr_bf_sel_list[-1])
+        self.rec_id_list_alice, self.index_alice = \
+            self.__generate_data_set_blocks__(self.rec_dict_alice, attr_select_list)
+        print('Index for Alice contains %d blocks' % \
+              (sum([len(key_array) for (key_array, _, _) in self.index_alice])))
 
-            self.rec_bf_len = sum(self.attr_bf_len_list)
-            # print self.rec_bf_len
-
-            # Generate a random permutation of bit positions
-            #
-            self.shuffle_bit_list = list(range(self.rec_bf_len))
-            random.shuffle(self.shuffle_bit_list)
-
-        if (self.hlsh_sample_bits_list == None):
-
-            rec_bits = list(range(self.rec_bf_len))
-
-            # Generate num_iter_hlsh lists each containing num_bits_hlsh bit
-            # positions
-            #
-            self.hlsh_sample_bits_list = []
-            for i in range(num_iter_hlsh):
-                rand_bit_list = random.sample(rec_bits, num_bits_hlsh)
-                self.hlsh_sample_bits_list.append(rand_bit_list)
-                # print self.hlsh_sample_bits_list[-1]
-                assert min(self.hlsh_sample_bits_list[-1]) >= 0
-                assert max(self.hlsh_sample_bits_list[-1]) < self.rec_bf_len
-
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-
-        self.index_alice = self.__generate_data_set_blocks__(self.rec_dict_alice,
-                                                             attr_select_list)
-        print('Index for Alice contains %d blocks' % (len(self.index_alice)))
-
-        stat = self.block_stats(self.index_alice)
+        stat = self.block_size_stats(self.__get_bucket_size_list__(self.index_alice))
         min_block_size, med_blk_size, max_block_size, avr_block_size, std_dev, blk_len_list = stat
 
         wr_file_name = './logs/HLSH_data_alice.csv'
@@ -308,7 +748,7 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
     # --------------------------------------------------------------------------
 
     def build_index_bob(self, attr_select_list, attr_bf_sample_list,
-                        num_bits_hlsh, num_iter_hlsh):
+                        num_bits_hlsh, num_iter_hlsh, num_probe_hlsh=0):
         """Method which builds the index for the second database owner.
 
        The generated index needs to be stored in the variable self.index_bob
@@ -325,69 +765,28 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
                               hashing (LSH) values.
        - num_iter_hlsh        Number of times a record Bloom filter is
                               sampled.
+       - num_probe_hlsh       Number of additional buckets of Bob (with keys
+                              that differ in one or two bits) that are paired
+                              with each bucket of Alice when generating the
+                              blocks (multi-probe LSH), default 0.
     """
 
-        # Set random seed so both database owners have the same start
-        #
-        random.seed(self.random_seed)
-
         assert self.rec_dict_bob != None
 
-        assert len(attr_select_list) == len(attr_bf_sample_list)
         self.attr_select_list = attr_select_list
 
-        assert num_bits_hlsh > 0
-        assert num_iter_hlsh > 0
-
-        if (self.shuffle_bit_list == None):
-            self.attr_bf_len_list = self.__calc_attr_bf_len__(attr_select_list)
-
-            # Generate list which specifies which bits to sample from each attribute
-            # Bloom filter
-            #
-            self.attr_bf_sel_list = []
-            i = 0
-            for i in range(len(attr_select_list)):
-                attr_bf_len = self.attr_bf_len_list[i]  # Attribute BF length
-
-                # Number of bits to sample for this attribute
-                #
-                attr_bf_sample = int(math.ceil(float(attr_bf_sample_list[i]) / \
-                                               100.0 * attr_bf_len))
-                self.attr_bf_sel_list.append(random.sample(list(range(attr_bf_len)),
-                                                           attr_bf_sample))
-                # print i, attr_bf_len, attr_bf_sample, len(self.attr_bf_sel_list[-1])
-
-            self.rec_bf_len = sum(self.attr_bf_len_list)
-            # print self.rec_bf_len
-
-            # Generate a random permutation of bit positions
-            #
-            self.shuffle_bit_list = list(range(self.rec_bf_len))
-            random.shuffle(self.shuffle_bit_list)
-
-        if (self.hlsh_sample_bits_list == None):
+        assert num_probe_hlsh >= 0
+        self.num_probe_hlsh = num_probe_hlsh
 
-            rec_bits = list(range(self.rec_bf_len))
+        self.__set_plan__(attr_select_list, attr_bf_sample_list, num_bits_hlsh,
+                          num_iter_hlsh)
 
-            # Generate num_iter_hlsh lists each containing num_bits_hlsh bit
-            # positions
-            #
-            self.hlsh_sample_bits_list = []
-            for i in range(num_iter_hlsh):
-                rand_bit_list = random.sample(rec_bits, num_bits_hlsh)
-                self.hlsh_sample_bits_list.append(rand_bit_list)
-                # print self.hlsh_sample_bits_list[-1]
-                assert min(self.hlsh_sample_bits_list[-1]) >= 0
-                assert max(self.hlsh_sample_bits_list[-1]) < self.rec_bf_len
-
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-
-        self.index_bob = self.__generate_data_set_blocks__(self.rec_dict_bob,
-                                                           attr_select_list)
-        print('Index for Bob contains %d blocks' % (len(self.index_bob)))
+        self.rec_id_list_bob, self.index_bob = \
+            self.__generate_data_set_blocks__(self.rec_dict_bob, attr_select_list)
+        print('Index for Bob contains %d blocks' % \
+              (sum([len(key_array) for (key_array, _, _) in self.index_bob])))
 
-        stat = self.block_stats(self.index_bob)
+        stat = self.block_size_stats(self.__get_bucket_size_list__(self.index_bob))
         min_block_size, med_blk_size, max_block_size, avr_block_size, std_dev, blk_len_list = stat
 
         wr_file_name = './logs/HLSH_data_bob.csv'
@@ -419,7 +818,9 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
                            extract attribute values from the given records and
                            generate Bloom filters for these attributes.
 
-       The method returns a dictionary which contains the generated blocks.
+       The method returns the list of record identifiers and a list with the
+       bucket table (see __get_bucket_table__()) of each HLSH iteration, so
+       the blocks are keyed by (iteration, key) pairs.
     """
 
         print()
@@ -427,81 +828,450 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
 
         assert rec_dict != None
 
-        str2bf = self.__str2bf__
-
-        block_dict = {}  # Resulting blocks generated
+        # Only the distinct combinations of attribute values need to be
+        # converted into Bloom filters and blocking key values
+        #
+        rec_id_list, bkv_ind_list, bkv_list = \
+            self.__get_distinct_bkv__(rec_dict, attr_select_list, concat=False)
 
-        num_rec_done = 0
+        # Shards of the distinct values can be converted in worker processes,
+        # their keys are concatenated in shard order
+        #
+        key_matrix = self.__place_distinct_bkv__(
+            partial(self.__get_hlsh_key_matrix__, self.hlsh_plan), bkv_list,
+            self.num_workers)
 
-        attr_bf_len_list = self.attr_bf_len_list
-        attr_bf_sel_list = self.attr_bf_sel_list
-        shuffle_bit_list = self.shuffle_bit_list
-        hlsh_sample_bits_list = self.hlsh_sample_bits_list
+        bkv_ind_array = numpy.array(bkv_ind_list, dtype=numpy.int64)
 
-        # Calculate the start 'indexes' for the different attribute Bloom filters
+        # Insert the records into the buckets of each iteration
         #
-        bf_start_index_list = [0]
+        bucket_table_list = []
+        for i in range(len(self.hlsh_plan.sample_bit_array_list)):
+            bucket_table_list.append(self.__get_bucket_table__(key_matrix[bkv_ind_array, i]))
+
+        return rec_id_list, bucket_table_list
+
+    # --------------------------------------------------------------------------
+
+    def __get_hlsh_key_matrix__(self, hlsh_plan, bkv_list):
+        """Convert the given attribute value tuples into record Bloom filters
+       and generate their keys for all HLSH iterations of the given plan, by
+       extracting the selected bits from the shuffled Bloom filters.
+
+       This method only reads the plan, so it can be run in worker processes.
+
+       The method returns a numpy array with one row per value tuple and one
+       column per HLSH iteration.
+    """
+
+        rec_bf_matrix = self.__get_rec_bf_matrix__(hlsh_plan, bkv_list)
+
+        key_array_list = []
+        for sample_bit_array in hlsh_plan.sample_bit_array_list:
+            key_array_list.append(self.__get_hlsh_key_array__(rec_bf_matrix,
+                                                              sample_bit_array))
+
+        return numpy.stack(key_array_list, axis=1)
+
+    # --------------------------------------------------------------------------
+
+    def __get_bucket_table__(self, rec_key_array):
+        """Group the records (their numbers) by their key of one HLSH
+       iteration.
+
+       The method returns a tuple (key array, start array, record number
+       array), where the key array contains the sorted distinct keys, and the
+       numbers of the records in the bucket of the i-th key are
+       rec_num_array[start_array[i]:start_array[i+1]] (in record order).
+    """
+
+        rec_num_array = numpy.argsort(rec_key_array, kind='mergesort')  # Stable
+        sort_key_array = rec_key_array[rec_num_array]
 
-        for attr_bf_len in attr_bf_len_list:
-            bf_start_index_list.append(bf_start_index_list[-1] + attr_bf_len)
-        bf_start_index_list = bf_start_index_list[:-1]  # Last element no needed
+        key_array, start_array = numpy.unique(sort_key_array, return_index=True)
+        start_array = numpy.append(start_array, len(sort_key_array)).astype(numpy.int64)
 
-        # Main loop over all records in database
+        return key_array, start_array, rec_num_array
+
+    # --------------------------------------------------------------------------
+
+    def __get_rec_bf_matrix__(self, hlsh_plan, bkv_list, max_block_size=100000):
+        """Convert the given attribute value tuples into shuffled record Bloom
+       filters, as specified by the given HLSH plan.
+
+       The attribute Bloom filters are generated once for each distinct
+       attribute value, the bits to be sampled from them are mapped onto
+       their (shuffled) positions in the record Bloom filter as column
+       indexes, and the record Bloom filters are then set in blocks of at
+       most max_block_size rows.
+
+       The method returns a numpy uint8 matrix with one row per value tuple
+       and the bits of the record Bloom filters packed into bytes (with the
+       first bit in the most significant bit of the first byte, as
+       numpy.packbits() does).
+    """
+
+        attr_bf_len_list = hlsh_plan.attr_bf_len_list
+        rec_bf_len = hlsh_plan.rec_bf_len
+
+        num_val = len(bkv_list)
+
+        # For each attribute the column indexes of the sampled bits of the
+        # Bloom filters of its distinct values (concatenated, with the start
+        # index of each value), and for each value tuple the number of its
+        # attribute value
         #
-        for (rec_id, rec_list) in rec_dict.items():
-            num_rec_done += 1
-            if (num_rec_done % 10000 == 0):
-                print('  Processed %d of %d records' % (num_rec_done, len(rec_dict)))
+        attr_col_list = []  # Pairs of (column array, start array)
+        attr_val_ind_list = []
 
-            # Convert the selected attributes into Bloom filters, then sample bits
-            # from them, and combine into record Bloom filter
+        for (i, attr_bf_len) in enumerate(attr_bf_len_list):
+
+            # Column of each attribute Bloom filter bit in the shuffled record
+            # Bloom filter (-1 if the bit is not sampled)
             #
-            i = 0
-            for col_num in attr_select_list:
-                attr_val = rec_list[col_num]
-                attr_bf = str2bf(attr_val, attr_bf_len_list[i])
+            attr_col_array = hlsh_plan.attr_col_array_list[i]
 
-                # Only keep the bits that are to be sampled
-                #
-                attr_sel_bf = attr_bf_sel_list[i].intersection(attr_bf)
+            attr_val_ind_dict = {}
+            val_ind_array = numpy.zeros(num_val, dtype=numpy.int64)
+            col_array_list = []
+
+            for (j, attr_val_tuple) in enumerate(bkv_list):
+                attr_val = attr_val_tuple[i]
+
+                val_ind = attr_val_ind_dict.get(attr_val)
+                if (val_ind == None):  # A new distinct attribute value
+                    val_ind = len(col_array_list)
+                    attr_val_ind_dict[attr_val] = val_ind
+
+                    attr_bf = self.__str2bf__(attr_val, attr_bf_len)
+
+                    col_array = attr_col_array[sorted(attr_bf)]
+                    col_array_list.append(col_array[col_array >= 0])
+
+                val_ind_array[j] = val_ind
+
+            col_len_array = numpy.array([len(col_array) for col_array in col_array_list],
+                                        dtype=numpy.int64)
+            start_array = numpy.zeros(len(col_array_list) + 1, dtype=numpy.int64)
+            start_array[1:] = numpy.cumsum(col_len_array)
+
+            if (col_array_list != []):
+                all_col_array = numpy.concatenate(col_array_list)
+            else:
+                all_col_array = numpy.zeros(0, dtype=numpy.int64)
+
+            attr_col_list.append((all_col_array, start_array))
+            attr_val_ind_list.append(val_ind_array)
+
+        # Set the bits of the record Bloom filters in blocks of rows
+        #
+        rec_bf_matrix = numpy.zeros((num_val, (rec_bf_len + 7) // 8), dtype=numpy.uint8)
+
+        for block_start in range(0, num_val, max_block_size):
+            block_end = min(block_start + max_block_size, num_val)
 
-                # Modify bit positions for record Bloom filter
+            block_bit_matrix = numpy.zeros((block_end - block_start, rec_bf_len),
+                                           dtype=numpy.bool_)
+
+            for (i, (all_col_array, start_array)) in enumerate(attr_col_list):
+                val_ind_array = attr_val_ind_list[i][block_start:block_end]
+
+                row_start_array = start_array[val_ind_array]
+                row_len_array = start_array[val_ind_array + 1] - row_start_array
+
+                # Gather the columns of all rows with one index array
                 #
-                if (i == 0):  # No offset needed
-                    rec_bf = attr_sel_bf
-                else:
-                    attr_offset = bf_start_index_list[i]
-                    for bit_pos in attr_sel_bf:
-                        rec_bf.add(bit_pos + attr_offset)
+                row_array = numpy.repeat(numpy.arange(len(val_ind_array)), row_len_array)
+                col_ind_array = numpy.arange(row_len_array.sum()) - \
+                                numpy.repeat(numpy.cumsum(row_len_array) - row_len_array, row_len_array) + \
+                                numpy.repeat(row_start_array, row_len_array)
 
-                i += 1
+                block_bit_matrix[row_array, all_col_array[col_ind_array]] = True
 
-            # Shuffle bits in record Bloom filter
-            #
-            rec_bf_shuffle = set()
-            for bit_pos in rec_bf:
-                rec_bf_shuffle.add(shuffle_bit_list[bit_pos])
+            rec_bf_matrix[block_start:block_end] = numpy.packbits(block_bit_matrix, axis=1)
 
-            # Generate the desired number of blocking key values by extracting
-            # selected bits from the shuffled Bloom filter
-            #
-            for sample_bit_list in hlsh_sample_bits_list:
+        return rec_bf_matrix
 
-                block_str = ''
-                for bit_pos in sample_bit_list:
-                    if (bit_pos in rec_bf_shuffle):
-                        block_str += '1'
-                    else:
-                        block_str += '0'
-                assert len(block_str) == len(sample_bit_list), (len(block_str), len(sample_bit_list))
+    # --------------------------------------------------------------------------
+
+    def __get_hlsh_key_array__(self, rec_bf_matrix, sample_bit_list):
+        """Extract the given bit positions from the packed record Bloom filters
+       and combine them into one integer key per record Bloom filter, where
+       the first sampled bit is the most significant bit of the key.
+
+       The method returns a numpy uint64 array with the keys if at most 64
+       bits are sampled, otherwise an object array with Python integers.
+    """
+
+        num_bits = len(sample_bit_list)
+
+        bit_pos_array = numpy.array(sample_bit_list, dtype=numpy.int64)
+
+        bit_matrix = (rec_bf_matrix[:, bit_pos_array >> 3] >> \
+                      (7 - (bit_pos_array & 7)).astype(numpy.uint8)) & 1
+
+        key_byte_matrix = numpy.packbits(bit_matrix, axis=1)
+
+        num_bytes = key_byte_matrix.shape[1]
+        pad_bits = 8 * num_bytes - num_bits
+
+        if (num_bits <= 64):
+            key_word_matrix = numpy.zeros((key_byte_matrix.shape[0], 8), dtype=numpy.uint8)
+            key_word_matrix[:, :num_bytes] = key_byte_matrix
+            key_array = key_word_matrix.view('>u8')[:, 0].astype(numpy.uint64)
+
+            return key_array >> numpy.uint64(64 - num_bits)
+
+        return numpy.array([int.from_bytes(key_bytes.tobytes(), 'big') >> pad_bits for \
+                            key_bytes in key_byte_matrix], dtype=object)
+
+    # --------------------------------------------------------------------------
+
+    def __get_bucket_size_list__(self, bucket_table_list):
+        """Return a list with the sizes of all buckets of all iterations.
+    """
+
+        blk_len_list = []
+        for (key_array, start_array, rec_num_array) in bucket_table_list:
+            blk_len_list += numpy.diff(start_array).tolist()
+
+        return blk_len_list
+
+    # --------------------------------------------------------------------------
+
+    def __get_key_bit_matrix__(self, key_array, num_bits):
+        """Return a numpy uint8 matrix with one row per key and one column per
+       bit of the keys (the first sampled bit, which is the most significant
+       bit of a key, first).
+    """
+
+        if (key_array.dtype == object):  # Keys with more than 64 bits
+            return numpy.array([[(key >> (num_bits - 1 - j)) & 1 for j in range(num_bits)] \
+                                for key in key_array.tolist()],
+                               dtype=numpy.uint8).reshape(len(key_array), num_bits)
+
+        shift_array = numpy.arange(num_bits - 1, -1, -1).astype(numpy.uint64)
+
+        return ((key_array[:, None] >> shift_array[None, :]) & numpy.uint64(1)).astype(numpy.uint8)
+
+    # --------------------------------------------------------------------------
+
+    def __get_bit_mask_array__(self, bit_pos_array, num_bits, key_dtype):
+        """Return an array (with the given key data type) with the key masks
+       that have only the given bit positions set.
+    """
+
+        shift_array = num_bits - 1 - bit_pos_array
+
+        if (key_dtype == object):  # Keys with more than 64 bits
+            return numpy.left_shift(numpy.ones(shift_array.shape, dtype=object),
+                                    shift_array.astype(object))
+
+        return numpy.left_shift(numpy.uint64(1), shift_array.astype(numpy.uint64))
+
+    # --------------------------------------------------------------------------
+
+    def __get_probe_bucket_pairs__(self, bucket_table_alice, bucket_table_bob,
+                                   num_bits, num_probe):
+        """Find the buckets of Bob that are probed for each bucket of Alice in
+       one HLSH iteration (multi-probe LSH).
+
+       The probed keys differ from the key of Alice's bucket in one or two
+       bits. The probability that a bit of a record of Bob differs from the
+       bit of Alice's key is estimated from the fraction of Bob's records
+       that have this bit set, and the num_probe keys with the highest
+       probability (the product of the probabilities of their changed bits)
+       are probed. Only the num_probe bits with the highest probabilities
+       can occur in these keys, so only these bits are combined. Ties are
+       broken by the order of the bits, so the probes are deterministic.
+
+       The method returns two numpy arrays with the indexes of the paired
+       buckets of Alice and Bob (ordered by Alice's bucket and then by the
+       probability of the probe).
+    """
+
+        key_array_alice = bucket_table_alice[0]
+        key_array_bob, start_array_bob, rec_num_array_bob = bucket_table_bob
 
-                block_rec_id_list = block_dict.get(block_str, [])
-                block_rec_id_list.append(rec_id)
-                block_dict[block_str] = block_rec_id_list
+        num_key_alice = len(key_array_alice)
 
-                # print block_str, block_rec_id_list
+        if (num_probe == 0) or (num_key_alice == 0) or (len(key_array_bob) == 0):
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
 
-        return block_dict
+        # Fraction of Bob's records with each bit set
+        #
+        bob_size_array = numpy.diff(start_array_bob)
+        bit_one_frac_array = numpy.dot(bob_size_array,
+                                       self.__get_key_bit_matrix__(key_array_bob, num_bits)) / \
+                             float(bob_size_array.sum())
+
+        # Probability that the bits of a record of Bob differ from the bits of
+        # each of Alice's keys
+        #
+        alice_bit_matrix = self.__get_key_bit_matrix__(key_array_alice, num_bits)
+        flip_prob_matrix = numpy.where(alice_bit_matrix == 1, 1.0 - bit_one_frac_array,
+                                       bit_one_frac_array)
+
+        num_top_bits = min(num_probe, num_bits)
+
+        top_bit_matrix = numpy.argsort(-flip_prob_matrix, axis=1,
+                                       kind='mergesort')[:, :num_top_bits]
+        top_prob_matrix = numpy.take_along_axis(flip_prob_matrix, top_bit_matrix, axis=1)
+
+        # The candidate probes: each of the top bits and each pair of them
+        #
+        pair_first_array, pair_second_array = numpy.triu_indices(num_top_bits, 1)
+
+        cand_prob_matrix = numpy.concatenate([top_prob_matrix,
+                                              top_prob_matrix[:, pair_first_array] *
+                                              top_prob_matrix[:, pair_second_array]], axis=1)
+        cand_first_array = numpy.concatenate([numpy.arange(num_top_bits), pair_first_array])
+        cand_second_array = numpy.concatenate([numpy.full(num_top_bits, -1), pair_second_array])
+
+        probe_matrix = numpy.argsort(-cand_prob_matrix, axis=1,
+                                     kind='mergesort')[:, :num_probe]
+        num_probe = probe_matrix.shape[1]
+
+        # Keys of the probes
+        #
+        first_pos_matrix = numpy.take_along_axis(top_bit_matrix,
+                                                 cand_first_array[probe_matrix], axis=1)
+        second_ind_matrix = cand_second_array[probe_matrix]
+        second_pos_matrix = numpy.take_along_axis(top_bit_matrix,
+                                                  numpy.maximum(second_ind_matrix, 0), axis=1)
+
+        key_dtype = key_array_alice.dtype
+
+        mask_matrix = self.__get_bit_mask_array__(first_pos_matrix, num_bits, key_dtype)
+        second_mask_matrix = self.__get_bit_mask_array__(second_pos_matrix, num_bits, key_dtype)
+        second_mask_matrix[second_ind_matrix < 0] = 0
+        mask_matrix = mask_matrix | second_mask_matrix
+
+        probe_key_array = (key_array_alice[:, None] ^ mask_matrix).ravel()
+
+        # Find the probed keys in Bob's sorted keys
+        #
+        bob_ind_array = numpy.searchsorted(key_array_bob, probe_key_array)
+        found_array = bob_ind_array < len(key_array_bob)
+        found_array[found_array] = key_array_bob[bob_ind_array[found_array]] == \
+                                   probe_key_array[found_array]
+
+        alice_ind_array = numpy.repeat(numpy.arange(num_key_alice), num_probe)
+
+        return alice_ind_array[found_array], bob_ind_array[found_array]
+
+    # --------------------------------------------------------------------------
+
+    def __get_bucket_size_hist__(self, bucket_table):
+        """Return a list with the histogram of the bucket sizes of one HLSH
+       iteration, where entry b is the number of buckets with a size from
+       2^b to 2^(b+1)-1.
+    """
+
+        size_array = numpy.diff(bucket_table[1])
+        if (len(size_array) == 0):
+            return []
+
+        # Bucket sizes are at least 1, so their bit lengths are at least 1
+        #
+        bin_array = numpy.frexp(size_array.astype(numpy.float64))[1] - 1
+
+        return numpy.bincount(bin_array).tolist()
+
+    # --------------------------------------------------------------------------
+
+    def __get_oversized_array__(self, size_array_alice, size_array_bob):
+        """Return a boolean numpy array which is True for the blocks (pairs of
+       buckets with the given sizes) that are oversized.
+    """
+
+        oversized_array = numpy.zeros(len(size_array_alice), dtype=bool)
+
+        if (self.max_bucket_size != None):
+            oversized_array |= (size_array_alice > self.max_bucket_size)
+            oversized_array |= (size_array_bob > self.max_bucket_size)
+
+        if (self.max_bucket_pairs != None):
+            oversized_array |= (size_array_alice.astype(numpy.int64) *
+                                size_array_bob.astype(numpy.int64) > self.max_bucket_pairs)
+
+        return oversized_array
+
+    # --------------------------------------------------------------------------
+
+    def __get_rec_key_array__(self, bucket_table, num_rec):
+        """Return a numpy array with the HLSH key of each record (by record
+       number) in the given bucket table.
+    """
+
+        key_array, start_array, rec_num_array = bucket_table
+
+        rec_key_array = numpy.empty(num_rec, dtype=key_array.dtype)
+        rec_key_array[rec_num_array] = numpy.repeat(key_array, numpy.diff(start_array))
+
+        return rec_key_array
+
+    # --------------------------------------------------------------------------
+
+    def __split_block__(self, rec_num_array_alice, rec_num_array_bob, iter_list,
+                        rec_key_dict_alice, rec_key_dict_bob, sub_block_list):
+        """Split an oversized block (given by the record numbers of Alice and
+       Bob) into sub-blocks of records that also have the same key in the
+       HLSH iterations in iter_list (one iteration after the other, as long
+       as a sub-block is oversized), and append the sub-blocks that are not
+       oversized to sub_block_list.
+
+       The dictionaries rec_key_dict_alice and rec_key_dict_bob hold the
+       record key arrays (see __get_rec_key_array__()) of the iterations
+       used so far.
+
+       Returns the number of record pairs in the dropped sub-blocks.
+    """
+
+        if not self.__get_oversized_array__(numpy.array([len(rec_num_array_alice)]),
+                                            numpy.array([len(rec_num_array_bob)]))[0]:
+            sub_block_list.append((rec_num_array_alice, rec_num_array_bob))
+            return 0
+
+        if (iter_list == []):  # Still oversized, so drop it
+            return len(rec_num_array_alice) * len(rec_num_array_bob)
+
+        iter_num = iter_list[0]
+
+        if (iter_num not in rec_key_dict_alice):
+            rec_key_dict_alice[iter_num] = \
+                self.__get_rec_key_array__(self.index_alice[iter_num],
+                                           len(self.rec_id_list_alice))
+            rec_key_dict_bob[iter_num] = \
+                self.__get_rec_key_array__(self.index_bob[iter_num],
+                                           len(self.rec_id_list_bob))
+
+        # Group the records by their keys in this iteration (keeping their
+        # order) and pair the groups of Alice and Bob with the same key
+        #
+        table_alice = self.__get_bucket_table__(rec_key_dict_alice[iter_num][rec_num_array_alice])
+        table_bob = self.__get_bucket_table__(rec_key_dict_bob[iter_num][rec_num_array_bob])
+
+        common_key_array, alice_ind_array, bob_ind_array = \
+            numpy.intersect1d(table_alice[0], table_bob[0], assume_unique=True,
+                              return_indices=True)
+
+        num_drop_rec_pairs = len(rec_num_array_alice) * len(rec_num_array_bob)
+
+        for (alice_ind, bob_ind) in zip(alice_ind_array.tolist(), bob_ind_array.tolist()):
+            sub_rec_num_array_alice = rec_num_array_alice[
+                table_alice[2][table_alice[1][alice_ind]:table_alice[1][alice_ind + 1]]]
+            sub_rec_num_array_bob = rec_num_array_bob[
+                table_bob[2][table_bob[1][bob_ind]:table_bob[1][bob_ind + 1]]]
+
+            num_drop_rec_pairs -= len(sub_rec_num_array_alice) * len(sub_rec_num_array_bob)
+
+            num_drop_rec_pairs += \
+                self.__split_block__(sub_rec_num_array_alice, sub_rec_num_array_bob,
+                                     iter_list[1:], rec_key_dict_alice, rec_key_dict_bob,
+                                     sub_block_list)
+
+        return num_drop_rec_pairs
 
     # --------------------------------------------------------------------------
 
@@ -512,6 +1282,10 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
       Because a candidate record pair can occur in several blocks we need to
       record all pairs that have been generated, and only keep a pair in a
       single block.
+
+      If a maximum bucket size or number of record pairs is given, oversized
+      blocks are split or dropped (see __init__()). The histograms of the
+      bucket sizes of each iteration are kept in self.bucket_size_hist_list.
    """
 
         block_dict = {}
@@ -520,23 +1294,114 @@ class PPRLIndexBloomFilterHLSH(PPRLIndex):
 
         block_num = 0  # Each block get a unique number
 
-        blocks_alice = self.index_alice  # Keys are cluster identifiers, values the
-        blocks_bob = self.index_bob  # corresponding lists of record
-        # identifiers
+        rec_id_list_alice = self.rec_id_list_alice
+        rec_id_list_bob = self.rec_id_list_bob
+
+        num_probe_hlsh = self.num_probe_hlsh
 
-        for block_bit_str in blocks_alice:
+        num_iter = len(self.index_alice)
+
+        num_oversized = 0  # Number of oversized blocks
+        num_sub_blocks = 0  # Number of blocks they were split into
+        num_drop_rec_pairs = 0  # Number of record pairs dropped
+
+        rec_key_dict_alice = {}  # Record keys of iterations used for splitting
+        rec_key_dict_bob = {}
+
+        self.bucket_size_hist_list = []
+
+        # The buckets of Alice and Bob with the same key in the same iteration
+        # are found by merging their sorted key arrays
+        #
+        for (i, (bucket_table_alice, bucket_table_bob)) in \
+                enumerate(zip(self.index_alice, self.index_bob)):
+            key_array_alice, start_array_alice, rec_num_array_alice = bucket_table_alice
+            key_array_bob, start_array_bob, rec_num_array_bob = bucket_table_bob
+
+            self.bucket_size_hist_list.append((self.__get_bucket_size_hist__(bucket_table_alice),
+                                               self.__get_bucket_size_hist__(bucket_table_bob)))
+
+            common_key_array, alice_ind_array, bob_ind_array = \
+                numpy.intersect1d(key_array_alice, key_array_bob, assume_unique=True,
+                                  return_indices=True)
+
+            # With multi-probe LSH also pair Alice's buckets with the probed
+            # buckets of Bob
+            #
+            if (num_probe_hlsh > 0):
+                num_bits = len(self.hlsh_plan.sample_bit_array_list[i])
+
+                probe_alice_ind_array, probe_bob_ind_array = \
+                    self.__get_probe_bucket_pairs__(bucket_table_alice, bucket_table_bob,
+                                                    num_bits, num_probe_hlsh)
+
+                alice_ind_array = numpy.concatenate([alice_ind_array, probe_alice_ind_array])
+                bob_ind_array = numpy.concatenate([bob_ind_array, probe_bob_ind_array])
+
+            block_list = list(zip(alice_ind_array.tolist(), bob_ind_array.tolist()))
+
+            # Oversized blocks are split into smaller blocks using the keys of
+            # the following iterations, or dropped
+            #
+            if (self.max_bucket_size != None) or (self.max_bucket_pairs != None):
+                size_array_alice = numpy.diff(start_array_alice)[alice_ind_array]
+                size_array_bob = numpy.diff(start_array_bob)[bob_ind_array]
+
+                oversized_array = self.__get_oversized_array__(size_array_alice, size_array_bob)
+
+                sub_block_list = []  # Pairs of record number arrays
+                for block_ind in numpy.flatnonzero(oversized_array).tolist():
+                    alice_ind, bob_ind = block_list[block_ind]
+
+                    block_rec_num_array_alice = \
+                        rec_num_array_alice[start_array_alice[alice_ind]:start_array_alice[alice_ind + 1]]
+                    block_rec_num_array_bob = \
+                        rec_num_array_bob[start_array_bob[bob_ind]:start_array_bob[bob_ind + 1]]
+
+                    if (self.split_oversized == True):
+                        iter_list = [(i + j) % num_iter for j in range(1, num_iter)]
+                    else:
+                        iter_list = []
+
+                    num_drop_rec_pairs += \
+                        self.__split_block__(block_rec_num_array_alice, block_rec_num_array_bob,
+                                             iter_list, rec_key_dict_alice, rec_key_dict_bob,
+                                             sub_block_list)
+
+                num_oversized += int(oversized_array.sum())
+                num_sub_blocks += len(sub_block_list)
+
+                block_list = [block_list[block_ind] for block_ind in \
+                              numpy.flatnonzero(~oversized_array).tolist()]
+
+            else:
+                sub_block_list = []
+
+            block_rec_num_list = [(rec_num_array_alice[start_array_alice[alice_ind]:
+                                                       start_array_alice[alice_ind + 1]],
+                                   rec_num_array_bob[start_array_bob[bob_ind]:
+                                                     start_array_bob[bob_ind + 1]]) \
+                                  for (alice_ind, bob_ind) in block_list] + sub_block_list
+
+            for (block_rec_num_array_alice, block_rec_num_array_bob) in block_rec_num_list:
 
-            if (block_bit_str in blocks_bob):
                 # Get list of record identifiers in this block
                 #
-                block_rec_list_alice = blocks_alice[block_bit_str]
-                block_rec_list_bob = blocks_bob[block_bit_str]
+                block_rec_list_alice = [rec_id_list_alice[rec_num] for rec_num in \
+                                        block_rec_num_array_alice.tolist()]
+                block_rec_list_bob = [rec_id_list_bob[rec_num] for rec_num in \
+                                      block_rec_num_array_bob.tolist()]
 
                 block_dict[block_num] = (block_rec_list_alice, block_rec_list_bob)
                 num_cand_rec_pairs += len(block_rec_list_alice) * \
                                       len(block_rec_list_bob)
                 block_num += 1
 
+        if (self.max_bucket_size != None) or (self.max_bucket_pairs != None):
+            print('  %d oversized blocks split into %d blocks, %d record pairs ' % \
+                  (num_oversized, num_sub_blocks, num_drop_rec_pairs) + \
+                  'in oversized blocks dropped')
+
         self.block_dict = block_dict
 
         print('Final indexing contains %d blocks' % (len(block_dict)))
@@ -1,16 +1,30 @@
+import os
 import gzip
 import math
+import pickle
+import bisect
 import random
+import hashlib
+import numpy
 from tqdm import tqdm
 from itertools import product
 from memory_profiler import profile
 import time
 
+from config import QGRAM_LEN, QGRAM_PADDING
+from forkpool import can_fork, fork_imap
+
 
 class PPRLIndex:
     """General class that implements an indexing technique for PPRL.
   """
 
+    # If True (default) records with the same blocking key value are placed
+    # only once (see __get_distinct_bkv__()). Set to False for data where
+    # nearly all values are distinct, to save the lookups of this pre-pass.
+    #
+    dedup_bkv = True
+
     # --------------------------------------------------------------------------
 
     def __init__(self):
@@ -320,6 +334,427 @@ class PPRLIndex:
 
     # --------------------------------------------------------------------------
 
+    def __get_cache_file_name__(self, cache_dir, method_name, ref_val_list,
+                                param_list):
+        """Generate the name of the file in the given cache directory that
+       holds the clustering (or other) results of the given method for the
+       given reference values and parameters.
+
+       The file name contains a SHA1 hash of the reference values (in their
+       given order, as the clustering algorithms depend on this order) and
+       of the string representations of the parameter values, so different
+       reference values or parameters never share a cache file.
+    """
+
+        hasher = hashlib.sha1()
+
+        for param in param_list:
+            hasher.update(str(param).encode('utf-8'))
+            hasher.update(b'\x00')
+
+        hasher.update(str(len(ref_val_list)).encode('utf-8'))
+        for ref_val in ref_val_list:
+            hasher.update(b'\x00')
+            hasher.update(ref_val.encode('utf-8'))
+
+        return os.path.join(cache_dir, '%s_%s.pickle' % (method_name,
+                                                         hasher.hexdigest()))
+
+    # --------------------------------------------------------------------------
+
+    def __load_cache__(self, cache_file_name):
+        """Load the clustering results stored in the given cache file.
+
+       The method returns the stored data, or None if the file does not
+       exist.
+    """
+
+        if (not os.path.exists(cache_file_name)):
+            return None
+
+        cache_file = open(cache_file_name, 'rb')
+        cache_data = pickle.load(cache_file)
+        cache_file.close()
+
+        print('  Loaded cached results from file %s' % (cache_file_name))
+
+        return cache_data
+
+    # --------------------------------------------------------------------------
+
+    def __save_cache__(self, cache_file_name, cache_data):
+        """Store the given clustering results in the given cache file.
+
+       The data is first written into a temporary file which is then renamed,
+       so concurrent runs never read a partially written cache file.
+    """
+
+        cache_dir = os.path.dirname(cache_file_name)
+        if (cache_dir != ''):
+            os.makedirs(cache_dir, exist_ok=True)
+
+        tmp_file_name = cache_file_name + '.%d.tmp' % (os.getpid())
+
+        tmp_file = open(tmp_file_name, 'wb')
+        pickle.dump(cache_data, tmp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_file.close()
+
+        os.replace(tmp_file_name, cache_file_name)
+
+        print('  Saved results to cache file %s' % (cache_file_name))
+
+    # --------------------------------------------------------------------------
+
+    def __get_distinct_bkv__(self, rec_dict, attr_select_list, concat=True,
+                             dedup=None):
+        """Generate the blocking key value (BKV) of every record in the given
+       record dictionary and find the distinct BKVs, so that the (expensive)
+       placement of a value into a block only needs to be done once for each
+       distinct value rather than once for each record.
+
+       Arguments:
+       - rec_dict          A dictionary containing records, with the the keys
+                           being record identifiers and values being a list of
+                           attribute values for each record.
+       - attr_select_list  A list of column numbers that will be used to
+                           extract attribute values from the given records.
+       - concat            If True (default) the selected attribute values are
+                           concatenated into one string value, otherwise a
+                           tuple of the selected attribute values is used as
+                           BKV (for methods that process attributes
+                           separately).
+       - dedup             If True equal BKVs are collapsed into one distinct
+                           value, if False every record keeps its own BKV
+                           (so bkv_ind_list is 0, 1, 2, ...). If None
+                           (default) self.dedup_bkv is used.
+
+       The number of collapsed duplicate BKVs is kept in self.num_dup_bkv,
+       if it is 0 then every BKV is used by exactly one record.
+
+       The method returns three lists:
+       - rec_id_list   The record identifiers in the order of rec_dict.
+       - bkv_ind_list  For each record the index of its BKV in bkv_list.
+       - bkv_list      The distinct BKVs in order of their first occurrence.
+    """
+
+        assert rec_dict != None
+
+        if (dedup == None):
+            dedup = self.dedup_bkv
+
+        if (dedup == False):
+            rec_id_list = list(rec_dict.keys())
+
+            if (concat == True):
+                bkv_list = [''.join([rec_list[col_num] for col_num in attr_select_list]) \
+                            for rec_list in rec_dict.values()]
+            else:
+                bkv_list = [tuple([rec_list[col_num] for col_num in attr_select_list]) \
+                            for rec_list in rec_dict.values()]
+
+            self.num_dup_bkv = 0
+
+            return rec_id_list, list(range(len(rec_id_list))), bkv_list
+
+        bkv_ind_dict = {}  # Distinct BKVs and their index in bkv_list
+
+        rec_id_list = []
+        bkv_ind_list = []
+        bkv_list = []
+
+        for (rec_id, rec_list) in rec_dict.items():
+
+            if (concat == True):
+                bk_val = ''.join([rec_list[col_num] for col_num in attr_select_list])
+            else:
+                bk_val = tuple([rec_list[col_num] for col_num in attr_select_list])
+
+            bkv_ind = bkv_ind_dict.get(bk_val)
+            if (bkv_ind == None):  # A new distinct value
+                bkv_ind = len(bkv_list)
+                bkv_ind_dict[bk_val] = bkv_ind
+                bkv_list.append(bk_val)
+
+            rec_id_list.append(rec_id)
+            bkv_ind_list.append(bkv_ind)
+
+        self.num_dup_bkv = len(rec_id_list) - len(bkv_list)
+
+        print('  Found %d distinct blocking key values in %d records ' % \
+              (len(bkv_list), len(rec_id_list)) + \
+              '(%d duplicates collapsed)' % (self.num_dup_bkv))
+
+        return rec_id_list, bkv_ind_list, bkv_list
+
+    # --------------------------------------------------------------------------
+
+    def __place_distinct_bkv__(self, place_funct, bkv_list, num_workers=1):
+        """Place the given distinct blocking key values (BKVs) into blocks,
+       either in this process or in a pool of worker processes.
+
+       Arguments:
+       - place_funct  A function which takes a list of BKVs and returns a
+                      list (of the same length) which for each BKV contains
+                      the list of block keys the value is placed into (or a
+                      numpy array with one row for each BKV). The function
+                      must only read the model (clusters or reference
+                      values) it uses.
+       - bkv_list     The distinct BKVs as returned by __get_distinct_bkv__().
+       - num_workers  The number of worker processes. If 1 (default), or if
+                      processes cannot be forked on this platform, all values
+                      are placed in this process.
+
+       With several workers the values are split into contiguous shards
+       which are placed in forked worker processes (which share the model
+       with this process), and the results are concatenated in shard order.
+       The result is therefore the same for any number of workers.
+
+       The method returns the list of block key lists (or the array), one for
+       each BKV.
+    """
+
+        assert num_workers >= 1
+
+        if (num_workers == 1) or (len(bkv_list) < 2) or (not can_fork()):
+            return place_funct(bkv_list)
+
+        # Several shards per worker to balance the load between workers
+        #
+        num_shards = min(len(bkv_list), 4 * num_workers)
+        shard_size = int(math.ceil(float(len(bkv_list)) / num_shards))
+
+        shard_list = [bkv_list[i:i + shard_size] for i in \
+                      range(0, len(bkv_list), shard_size)]
+
+        print('  Placing %d values in %d shards with %d workers' % \
+              (len(bkv_list), len(shard_list), num_workers))
+
+        shard_block_list = list(fork_imap(place_funct, shard_list, num_workers))
+
+        if isinstance(shard_block_list[0], numpy.ndarray):
+            bkv_block_list = numpy.concatenate(shard_block_list)
+        else:
+            bkv_block_list = []
+            for shard_blocks in shard_block_list:
+                bkv_block_list += shard_blocks
+
+        assert len(bkv_block_list) == len(bkv_list)
+
+        return bkv_block_list
+
+    # --------------------------------------------------------------------------
+
+    def __expand_distinct_bkv__(self, rec_id_list, bkv_ind_list, bkv_block_list,
+                                block_dict=None):
+        """Expand the blocks generated for distinct blocking key values (BKVs)
+       back to record identifiers.
+
+       Arguments:
+       - rec_id_list     The record identifiers as returned by
+                         __get_distinct_bkv__().
+       - bkv_ind_list    For each record the index of its distinct BKV as
+                         returned by __get_distinct_bkv__().
+       - bkv_block_list  For each distinct BKV a list of the block keys the
+                         value has been placed into.
+       - block_dict      An optional dictionary of (possibly empty) blocks the
+                         record identifiers will be added to. If not given a
+                         new dictionary is generated.
+
+       Records are processed in the order of rec_id_list, so the generated
+       blocks are the same (including the order of record identifiers in
+       each block) as when inserting records one by one.
+
+       The method returns the dictionary with the blocks.
+    """
+
+        assert len(rec_id_list) == len(bkv_ind_list)
+
+        if (block_dict == None):
+            block_dict = {}
+
+        # Without duplicates the BKV of each record is the one at its own
+        # position (the BKVs are in order of their first occurrence)
+        #
+        if (len(bkv_block_list) == len(rec_id_list)):
+            rec_block_iter = zip(rec_id_list, bkv_block_list)
+        else:
+            rec_block_iter = ((rec_id, bkv_block_list[bkv_ind]) for (rec_id, bkv_ind) in \
+                              zip(rec_id_list, bkv_ind_list))
+
+        for (rec_id, rec_block_key_list) in rec_block_iter:
+            for block_key in rec_block_key_list:
+                block_rec_id_list = block_dict.get(block_key)
+                if (block_rec_id_list == None):
+                    block_dict[block_key] = [rec_id]
+                else:
+                    block_rec_id_list.append(rec_id)
+
+        return block_dict
+
+    # --------------------------------------------------------------------------
+
+    def __find_sorted_pos__(self, sort_ref_val_list, val_list):
+        """Find the position of each of the given values in the given sorted
+       list of reference values, that is the number of reference values that
+       are smaller than or equal to the value (as returned by bisect.bisect()).
+
+       The values are sorted once and then merged with the reference values
+       in one pass, where each search only starts at the position of the
+       previous (smaller) value.
+
+       The method returns a list with the position of each value.
+    """
+
+        pos_list = [0] * len(val_list)
+
+        pos = 0
+        for val_ind in sorted(range(len(val_list)), key=val_list.__getitem__):
+            pos = bisect.bisect(sort_ref_val_list, val_list[val_ind], pos)
+            pos_list[val_ind] = pos
+
+        return pos_list
+
+    # --------------------------------------------------------------------------
+
+    def __group_rec_ids_by_pos__(self, rec_id_list, bkv_ind_list, bkv_pos_list,
+                                 num_pos):
+        """Group record identifiers by the positions of their distinct
+       blocking key values (BKVs).
+
+       Arguments:
+       - rec_id_list   The record identifiers as returned by
+                       __get_distinct_bkv__().
+       - bkv_ind_list  For each record the index of its distinct BKV as
+                       returned by __get_distinct_bkv__().
+       - bkv_pos_list  For each distinct BKV its position (an integer from 0
+                       to num_pos-1).
+       - num_pos       The number of positions.
+
+       The records are grouped with a stable numpy sort of their positions,
+       so the identifiers at each position are in the order of rec_id_list
+       (the same as when inserting records one by one).
+
+       The method returns a list with num_pos lists of record identifiers.
+    """
+
+        assert len(rec_id_list) == len(bkv_ind_list)
+
+        if (len(rec_id_list) == 0):
+            return [[] for pos in range(num_pos)]
+
+        rec_pos_array = numpy.array(bkv_pos_list, dtype=numpy.int64)[
+            numpy.array(bkv_ind_list, dtype=numpy.int64)]
+
+        rec_order_array = numpy.argsort(rec_pos_array, kind='stable')
+        pos_count_array = numpy.bincount(rec_pos_array, minlength=num_pos)
+
+        sorted_rec_id_list = numpy.array(rec_id_list, dtype=object)[rec_order_array].tolist()
+
+        pos_rec_id_list = []
+        start = 0
+        for pos_count in pos_count_array.tolist():
+            pos_rec_id_list.append(sorted_rec_id_list[start:start + pos_count])
+            start += pos_count
+
+        return pos_rec_id_list
+
+    # --------------------------------------------------------------------------
+
+    def __get_range_block_str__(self, block_range):
+        """Generate the string identifier of a sorted-neighbourhood block that
+       is given as a (first, last) pair of reference value indices, consisting
+       of the indices of all reference values in the block (such as
+       'b_12_13_14_'). Only used when printing or logging blocks.
+    """
+
+        first_ref_ind, last_ref_ind = block_range
+
+        return 'b_' + ''.join([str(ref_ind) + '_' for ref_ind in \
+                               range(first_ref_ind, last_ref_ind + 1)])
+
+    # --------------------------------------------------------------------------
+
+    def __get_range_block_lookup__(self, block_dict, num_ref):
+        """Generate a list that for each reference value index (from 0 to
+       num_ref-1) contains the key of the block in block_dict that contains
+       this reference value, where the keys of block_dict are (first, last)
+       pairs of reference value indices. Indices not in any block are set to
+       None.
+    """
+
+        ref_block_list = [None] * num_ref
+
+        for block_range in block_dict:
+            first_ref_ind, last_ref_ind = block_range
+            for ref_ind in range(first_ref_ind, last_ref_ind + 1):
+                ref_block_list[ref_ind] = block_range
+
+        return ref_block_list
+
+    # --------------------------------------------------------------------------
+
+    def __get_adjacent_sim_list__(self, ref_val_list, sim_measure, sim_pairs=None,
+                                  prefix_frac=None, cache_dir=None):
+        """Calculate the similarity between each value in the given (sorted)
+       list of reference values and the next value in the list.
+
+       Arguments:
+       - ref_val_list  The sorted list of reference values.
+       - sim_measure   A function which takes two strings as input and returns
+                       a similarity value between 0 and 1.
+       - sim_pairs     An optional function which takes two lists of strings
+                       of the same length and returns the similarities of the
+                       pairs of strings at the same positions in one batch
+                       (such as DiceSim.sim_pairs()). If not given sim_measure
+                       is called for each pair.
+       - prefix_frac   If given only the first int(prefix_frac * l) characters
+                       of two adjacent values are compared, where l is the
+                       length of the shorter of the two values.
+       - cache_dir     An optional directory where the similarities are
+                       stored, so later runs with the same reference values
+                       do not need to calculate them again.
+
+       The method returns a list with len(ref_val_list)-1 similarities.
+    """
+
+        if (cache_dir != None):
+            sim_name = getattr(sim_measure, '__qualname__', repr(sim_measure))
+
+            cache_file_name = self.__get_cache_file_name__(cache_dir, 'adj_sim',
+                                                           ref_val_list, [sim_name, QGRAM_LEN, QGRAM_PADDING, prefix_frac])
+
+            adj_sim_list = self.__load_cache__(cache_file_name)
+            if (adj_sim_list != None):
+                return adj_sim_list
+
+        val_list1 = []
+        val_list2 = []
+
+        for i in range(len(ref_val_list) - 1):
+            this_ref_val = ref_val_list[i]
+            next_ref_val = ref_val_list[i + 1]
+
+            if (prefix_frac != None):
+                min_len = int(prefix_frac * min(len(this_ref_val), len(next_ref_val)))
+                this_ref_val = this_ref_val[:min_len]
+                next_ref_val = next_ref_val[:min_len]
+
+            val_list1.append(this_ref_val)
+            val_list2.append(next_ref_val)
+
+        if (sim_pairs != None):
+            adj_sim_list = [float(sim_val) for sim_val in sim_pairs(val_list1, val_list2)]
+        else:
+            adj_sim_list = [sim_measure(val1, val2) for (val1, val2) in \
+                            zip(val_list1, val_list2)]
+
+        if (cache_dir != None):
+            self.__save_cache__(cache_file_name, adj_sim_list)
+
+        return adj_sim_list
+
+    # --------------------------------------------------------------------------
+
     def build_index_alice(self, attr_select_list):
         """Method which builds the index for the first database owner.
 
@@ -485,7 +920,11 @@ class PPRLIndex:
                 # if block_num % int(block_dict_size / 5) == 0:
                     # print('Processing block %d of %d' % (block_num, num_blocks))
                 alice_rec_id_list = block_data[0]
-                bob_rec_id_list = block_data[1]
+
+                # Blocks can hold lists or numpy arrays of record identifiers,
+                # and a list is faster to iterate over for each Alice record
+                #
+                bob_rec_id_list = list(block_data[1])
 
                 for alice_rec_id in alice_rec_id_list:
 
@@ -563,19 +1002,31 @@ class PPRLIndex:
 
         return rr, pc, pq, num_cand_rec_pairs
 
-    def block_stats(self, blocks):
-        """Calculate few statistics for blocks."""
+    def block_stats(self, blocks, noise_dict=None):
+        """Calculate few statistics for blocks.
+
+       If a noise_dict is given, the number of noise records it holds for a
+       block (key) is added to the size of that block.
+    """
+        blk_len_list = []
+        for (block_id, block) in blocks.items():
+            block_len = len(block)
+            if (noise_dict != None):
+                block_len += noise_dict.get(block_id, 0)
+            blk_len_list.append(block_len)
+
+        return self.block_size_stats(blk_len_list)
+
+    def block_size_stats(self, blk_len_list):
+        """Calculate few statistics for blocks with the given sizes."""
         min_block_size = math.inf
         max_block_size = 1
         avr_block_size = 0
-        blk_len_list = []
-        for block in blocks.values():
-            block_len = len(block)
+        for block_len in blk_len_list:
             min_block_size = min(min_block_size, block_len)
             max_block_size = max(max_block_size, block_len)
             avr_block_size += block_len
-            blk_len_list.append(block_len)
-        avr_block_size /= len(blocks.values())
+        avr_block_size /= len(blk_len_list)
         sorted(blk_len_list)
         halfn = int(len(blk_len_list) / 2)
         if not len(blk_len_list) % 2:
@@ -594,8 +1045,13 @@ class PPRLIndex:
 
         return min_block_size, med_blk_size, max_block_size, avr_block_size, std_dev, blk_len_list
 
-    def disclosure_risk(self):
-        """Find disclosure risk sorted array back."""
+    def disclosure_risk(self, block_noise_dict=None):
+        """Find disclosure risk sorted array back.
+
+       If a block_noise_dict is given, it holds for a candidate block (key)
+       the pair of numbers of noise records added to Alice's and Bob's blocks,
+       which are included in the block sizes.
+    """
         # construct a dictionary of record and block they are in
         alice = {}
         bob = {}
@@ -617,6 +1073,10 @@ class PPRLIndex:
         # compute the block size
         alice_blk_size = {k: len(v) for k, (v, _) in self.block_dict.items()}
         bob_blk_size = {k: len(v) for k, (_, v) in self.block_dict.items()}
+        if (block_noise_dict != None):
+            for (k, (alice_noise, bob_noise)) in block_noise_dict.items():
+                alice_blk_size[k] += alice_noise
+                bob_blk_size[k] += bob_noise
 
         # for record that only belongs to 1 block, risk=1/block size
         alice_risk = {}
@@ -1,7 +1,10 @@
 import os
 import math
+import random
+import numpy
 from memory_profiler import profile
 from pprlindex import PPRLIndex
+from config import QGRAM_LEN, QGRAM_PADDING
 
 
 class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
@@ -19,14 +22,18 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
 
   # --------------------------------------------------------------------------
 
-  def __init__(self, k, sim_measure, min_sim_threshold, use_medoids=False):
+  def __init__(self, k, sim_measure, min_sim_threshold, use_medoids=False,
+               rep_method='medoid', sim_matrix=None, clara_sample_size=None,
+               num_workers=1, cache_dir=None):
     """Initialise the class and set the required parameters.
 
        Arguments:
        - k                  The minimum block size (in number of records that
                             need to be in a block).
        - sim_measure        A function which takes two strings as input and
-                            returns a similarity value between 0 and 1.
+                            returns a similarity value between 0 and 1 (and
+                            accepts a min_threshold keyword argument below
+                            which it can return early).
        - min_sim_threshold  A similarity threshold between 0 and 1 which is
                             used to decide if a value is to be added to an
                             existing cluster (if a similarity value is equal
@@ -40,6 +47,29 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
                             values in the cluster centers).
                             The default is not to use the medoids but the
                             complete clusters.
+       - rep_method         How the representative value of each cluster is
+                            selected if use_medoids is True, either 'medoid'
+                            (the value with the highest average similarity to
+                            all other values in its cluster, the default) or
+                            'center' (the value with the lowest similarity to
+                            all values in other clusters).
+       - sim_matrix         An optional function which takes two lists of
+                            strings as input and returns a numpy array with
+                            the similarities of all pairs (such as
+                            DiceSim.sim_matrix), with the same values as
+                            sim_measure. If not given the similarity matrices
+                            are calculated with sim_measure.
+       - clara_sample_size  If given, the medoid of a cluster with more than
+                            this number of values is selected from samples of
+                            this size (CLARA), rather than from all pairs of
+                            values in the cluster.
+       - num_workers        The number of worker processes used to insert
+                            records into their closest clusters (default 1,
+                            no worker processes).
+       - cache_dir          An optional directory where the clusters (and
+                            medoids) of the reference values are stored, so
+                            later runs with the same reference values and
+                            parameters do not need to cluster them again.
     """
 
     self.k =                 k
@@ -50,6 +80,16 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
     self.use_medoids =     use_medoids
     self.cluster_medoids = None
 
+    assert rep_method in ['medoid', 'center']
+    self.rep_method =        rep_method
+    self.sim_matrix =        sim_matrix
+    self.clara_sample_size = clara_sample_size
+
+    assert num_workers >= 1
+    self.num_workers = num_workers
+
+    self.cache_dir = cache_dir
+
     self.ref_val_list = None
     self.clusters =     None
 
@@ -108,7 +148,71 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
 
   # --------------------------------------------------------------------------
 
-  def __get_cluster_centers__(self):
+  def __build_clusters__(self):
+    """Cluster the reference values and, if medoids are used, find the
+       representative value of each cluster.
+
+       If a cache directory is given then the results are loaded from it if
+       the same reference values have been clustered with the same parameters
+       before, otherwise they are stored into it after clustering.
+    """
+
+    if (self.cache_dir != None):
+      sim_name = getattr(self.sim_measure, '__qualname__', repr(self.sim_measure))
+
+      cache_file_name = self.__get_cache_file_name__(self.cache_dir, 'knn',
+                          self.ref_val_list, [sim_name, QGRAM_LEN, QGRAM_PADDING,
+                          self.min_sim_threshold, self.use_medoids,
+                          self.rep_method, self.clara_sample_size])
+
+      cache_data = self.__load_cache__(cache_file_name)
+
+      if (cache_data != None):
+        self.clusters =        cache_data['clusters']
+        self.cluster_medoids = cache_data['cluster_medoids']
+        del self.ref_val_list
+        print('Found %d clusters' % (len(self.clusters)))
+        return
+
+    self.__nn_clustering__()
+
+    if (self.use_medoids == True):
+      if (self.rep_method == 'center'):
+        self.cluster_medoids = self.__get_cluster_centers__()
+      else:
+        self.cluster_medoids = self.__get_cluster_medoids__()
+
+    if (self.cache_dir != None):
+      self.__save_cache__(cache_file_name,
+                          {'clusters':        self.clusters,
+                           'cluster_medoids': self.cluster_medoids})
+
+  # --------------------------------------------------------------------------
+
+  def __get_sim_matrix__(self, val_list1, val_list2):
+    """Calculate the similarities between all values in the first list and
+       all values in the second list.
+
+       The method returns a numpy array with len(val_list1) rows and
+       len(val_list2) columns.
+    """
+
+    if (self.sim_matrix != None):
+      return self.sim_matrix(val_list1, val_list2)
+
+    sim_measure = self.sim_measure
+
+    sim_matrix = numpy.zeros((len(val_list1), len(val_list2)))
+
+    for i in range(len(val_list1)):
+      for j in range(len(val_list2)):
+        sim_matrix[i,j] = sim_measure(val_list1[i], val_list2[j])
+
+    return sim_matrix
+
+  # --------------------------------------------------------------------------
+
+  def __get_cluster_centers__(self, max_block_size=4000000):
     """A method which for each cluster finds the most central element (string)
        according to the similarity measure that was used to generate the
        clusters.
@@ -116,60 +220,117 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
        A cluster center is defined as the string that is furthest away from
        all strings in other clusters.
 
+       The similarity of each value to its nearest value in any other cluster
+       is calculated in one pass over all values, in blocks of rows of the
+       similarity matrix with at most max_block_size entries.
+
        The method returns a dictionary which for each cluster contains its
        central string.
     """
 
     assert self.clusters != None
 
-    clusters =    self.clusters
-    sim_measure = self.sim_measure
+    clusters = self.clusters
 
-    cluster_centers = []
+    all_val_list =  []  # All values in all clusters
+    clust_num_list = []  # The cluster number of each value
 
-    for cluster_elem_list in clusters:
+    for c in range(len(clusters)):
+      all_val_list +=   clusters[c]
+      clust_num_list += [c] * len(clusters[c])
 
-      # A dictionary which for each element in this cluster will contain the
-      # maximum similarity to any element in an other cluster
-      #
-      cluster_elem_max_sim_dict = {}
+    num_val =       len(all_val_list)
+    clust_num_arr = numpy.array(clust_num_list)
 
-      for cluster_val in cluster_elem_list:  # All values in this cluster
+    # For each value the maximum similarity with any value in another cluster
+    #
+    max_other_sim_arr = numpy.zeros(num_val)
 
-        cluster_val_max_sim = 0.0  # Maximum similarity for this element
-                                   # with any element in another cluster
+    num_block_rows = max(1, int(max_block_size / max(num_val, 1)))
 
-        # Check all other clusters, not the current cluster itself
-        #
-        for other_cluster_elem_list in clusters:
-          if (other_cluster_elem_list != cluster_elem_list):
+    for start in range(0, num_val, num_block_rows):
+      end = min(start + num_block_rows, num_val)
 
-            for other_cluster_val in other_cluster_elem_list:
-              s = sim_measure(cluster_val, other_cluster_val, True)
-              cluster_val_max_sim = max(cluster_val_max_sim, s)
+      sim_block = self.__get_sim_matrix__(all_val_list[start:end], all_val_list)
 
-        cluster_elem_max_sim_dict[cluster_val] = cluster_val_max_sim
+      # Do not consider values in the same cluster
+      #
+      sim_block[numpy.equal.outer(clust_num_arr[start:end], clust_num_arr)] = 0.0
+
+      max_other_sim_arr[start:end] = sim_block.max(axis=1)
+
+    max_other_sim_list = max_other_sim_arr.tolist()
 
-      #print 'cluster:'
-      #print cluster_elem_list
-      #print cluster_elem_max_sim_dict
+    cluster_centers = []
+
+    start = 0
+    for cluster_elem_list in clusters:
 
       min_sim =  1.0
       min_elem = ''
-      for (cluster_elem, s) in cluster_elem_max_sim_dict.items():
+      for i in range(len(cluster_elem_list)):
+        s = max_other_sim_list[start + i]
         if (s < min_sim):
           min_sim =  s
-          min_elem = cluster_elem
+          min_elem = cluster_elem_list[i]
 
       assert min_elem in cluster_elem_list
 
-      #print '  center:', min_elem
-      #print
-
       cluster_centers.append(min_elem)
+      start += len(cluster_elem_list)
 
     return cluster_centers
-    del self.clusters
+
+  # --------------------------------------------------------------------------
+
+  def __get_sim_sum_list__(self, val_list, cluster_elem_list):
+    """For each value in the given list calculate the sum of its similarities
+       to all other elements in the given cluster (the similarity of an
+       element with itself is not counted).
+
+       The method returns a list with one sum for each value.
+    """
+
+    sim_matrix = self.__get_sim_matrix__(val_list, cluster_elem_list)
+
+    # Sum up similarities in order, starting with the similarity of the
+    # element with itself taken out
+    #
+    sim_sum_matrix = numpy.hstack([numpy.full((len(val_list), 1), -1.0),
+                                   sim_matrix])
+
+    return numpy.cumsum(sim_sum_matrix, axis=1)[:,-1].tolist()
+
+  # --------------------------------------------------------------------------
+
+  def __get_clara_medoid__(self, cluster_elem_list, num_sample=5):
+    """Find the medoid of a large cluster by sampling (CLARA). The medoid of
+       each of num_sample random samples of the cluster is found, and the
+       sample medoid with the highest sum of similarities to all elements in
+       the cluster is returned.
+    """
+
+    sample_size = self.clara_sample_size
+
+    # Fixed seed so the same clusters always give the same medoids
+    #
+    rand = random.Random(len(cluster_elem_list))
+
+    cand_medoid_list = []
+
+    for i in range(num_sample):
+      sample_list = rand.sample(cluster_elem_list, sample_size)
+
+      sample_sim_sum_list = self.__get_sim_sum_list__(sample_list, sample_list)
+      sample_medoid = max(zip(sample_sim_sum_list, sample_list))[1]
+
+      if (sample_medoid not in cand_medoid_list):
+        cand_medoid_list.append(sample_medoid)
+
+    cand_sim_sum_list = self.__get_sim_sum_list__(cand_medoid_list,
+                                                  cluster_elem_list)
+
+    return max(zip(cand_sim_sum_list, cand_medoid_list))[1]
 
   # --------------------------------------------------------------------------
 
@@ -181,14 +342,19 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
        A medoid is the element that has the highest average similarity to all
        other elements in a cluster.
 
+       The similarities of all pairs of elements in a cluster are calculated
+       as one similarity matrix, unless the cluster contains more than
+       clara_sample_size elements, in which case the medoid is found by
+       sampling.
+
        The method returns a dictionary which for each cluster contains its
        medoid (string).
     """
 
     assert self.clusters != None
 
-    clusters =    self.clusters
-    sim_measure = self.sim_measure
+    clusters =          self.clusters
+    clara_sample_size = self.clara_sample_size
 
     cluster_medoids = []
 
@@ -196,31 +362,24 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
     #
     for cluster_elem_list in clusters:
 
-      # A list which for each element in this cluster will contain the sum of
-      # similarities to all other elements in the cluster
-      #
-      cluster_elem_sim_sum_list = []
-
-      for cluster_val in cluster_elem_list:  # All values in this cluster
-
-        cluster_val_sim_sum = -1.0  # Take similarity of element with it self
-                                    # into account
+      if (clara_sample_size != None) and \
+         (len(cluster_elem_list) > clara_sample_size):
+        cluster_medoids.append(self.__get_clara_medoid__(cluster_elem_list))
 
-        for other_cluster_val in cluster_elem_list:
-          s = sim_measure(cluster_val, other_cluster_val, False)
-          cluster_val_sim_sum += s
+      else:
 
-        cluster_elem_sim_sum_list.append([cluster_val_sim_sum,cluster_val])
+        # A list which for each element in this cluster will contain the sum
+        # of similarities to all other elements in the cluster
+        #
+        cluster_elem_sim_sum_list = self.__get_sim_sum_list__(cluster_elem_list,
+                                                              cluster_elem_list)
 
-      cluster_medoid_data = max(cluster_elem_sim_sum_list)
-      #print
-      #print cluster_elem_sim_sum_list
-      #print cluster_medoid_data
+        cluster_medoid_data = max(zip(cluster_elem_sim_sum_list,
+                                      cluster_elem_list))
 
-      cluster_medoids.append(cluster_medoid_data[1])  # Keep medoid element
+        cluster_medoids.append(cluster_medoid_data[1])  # Keep medoid element
 
     return cluster_medoids
-    del self.clusters
 
   # --------------------------------------------------------------------------
 
@@ -247,28 +406,45 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
 
     assert rec_dict != None
 
-    sim_measure =       self.sim_measure
-    min_sim_threshold = self.min_sim_threshold
-    clusters =          self.clusters
+    # Only the distinct blocking key values need to be placed into clusters
+    #
+    rec_id_list, bkv_ind_list, bkv_list = \
+      self.__get_distinct_bkv__(rec_dict, attr_select_list)
+
+    bkv_block_list = self.__place_distinct_bkv__(self.__get_closest_clusters__,
+                                                 bkv_list, self.num_workers)
+
+    # Add records into cluster with highest similarity
+    #
+    block_dict = self.__expand_distinct_bkv__(rec_id_list, bkv_ind_list,
+                                              bkv_block_list)
+
+    return block_dict
+
+  # --------------------------------------------------------------------------
+
+  def __get_closest_clusters__(self, bkv_list):
+    """Find the closest cluster for each of the given blocking key values.
+
+       The method returns a list which for each value contains a list with
+       the number of its closest cluster.
+    """
+
+    sim_measure = self.sim_measure
+    clusters =    self.clusters
 
     if (self.use_medoids == True):
       cluster_medoids = self.cluster_medoids
       assert len(clusters) == len(cluster_medoids)
 
-    block_dict = {}  # Resulting blocks generated
-
-    num_rec_done = 0
+    bkv_block_list = []  # For each value its closest cluster
 
-    for (rec_id, rec_list) in rec_dict.items():
-      num_rec_done += 1
-      if (num_rec_done % 10000 == 0):
-        print('  Processed %d of %d records' % (num_rec_done, len(rec_dict)))
+    num_val_done = 0
 
-      # Generate the blocking key value for this record
-      #
-      bk_val = ''
-      for col_num in attr_select_list:
-        bk_val += rec_list[col_num]
+    for bk_val in bkv_list:
+      num_val_done += 1
+      if (num_val_done % 10000 == 0):
+        print('  Processed %d of %d values' % (num_val_done, len(bkv_list)))
 
       max_sim_cluster_id = -1   # Cluster number with highest similarity
       max_sim =            0.0  # Highest similarity value
@@ -278,7 +454,9 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
       if (self.use_medoids == True):
         for c in range(len(clusters)):
           medoid_val = cluster_medoids[c]
-          s = sim_measure(bk_val, medoid_val)  # Don't cache anything
+          # Don't cache anything, only need to know if s is above max_sim
+          #
+          s = sim_measure(bk_val, medoid_val, min_threshold=max_sim)
           if (s > max_sim):
             max_sim =            s  # New highest similarity found
             max_sim_cluster_id = c  # Assign new best cluster number
@@ -289,18 +467,16 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
           this_cluster_value_list = clusters[c]
 
           for cluster_val in this_cluster_value_list:
-            s = sim_measure(bk_val, cluster_val)  # Don't cache anything
+            # Don't cache anything, only need to know if s is above max_sim
+            #
+            s = sim_measure(bk_val, cluster_val, min_threshold=max_sim)
             if (s > max_sim):
               max_sim =            s  # New highest similarity found
               max_sim_cluster_id = c  # Assign new best cluster number
 
-      # Add record into cluster with highest similarity
-      #
-      best_block_rec_id_list = block_dict.get(max_sim_cluster_id, [])
-      best_block_rec_id_list.append(rec_id)
-      block_dict[max_sim_cluster_id] = best_block_rec_id_list
+      bkv_block_list.append([max_sim_cluster_id])
 
-    return block_dict
+    return bkv_block_list
 
   # --------------------------------------------------------------------------
   def build_index_alice(self, attr_select_list):
@@ -319,10 +495,7 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
     self.attr_select_list_alice = attr_select_list
 
     if (self.clusters == None):  # Only needs to be done once (same clusters
-      self.__nn_clustering__()   # for both database owners)
-
-      if (self.use_medoids == True):
-        self.cluster_medoids = self.__get_cluster_medoids__()
+      self.__build_clusters__()  # for both database owners)
 
     assert self.rec_dict_alice != None
 
@@ -363,7 +536,7 @@ class PPRLIndexKAnonymousNearestNeighbourClustering(PPRLIndex):
     self.attr_select_list_bob = attr_select_list
 
     if (self.clusters == None):  # Only needs to be done once (same clusters
-      self.__nn_clustering__()   # for both database owners)
+      self.__build_clusters__()  # for both database owners)
 
     assert self.rec_dict_bob != None
 
@@ -1,5 +1,6 @@
 import os
-import bisect
+import heapq
+from functools import partial
 from memory_profiler import profile
 
 from pprlindex import PPRLIndex
@@ -18,7 +19,9 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
 
     # --------------------------------------------------------------------------
 
-    def __init__(self, k, sim_measure, min_sim_threshold, overlap, sim_or_size):
+    def __init__(self, k, sim_measure, min_sim_threshold, overlap, sim_or_size,
+                 num_workers=1, sim_pairs=None, cache_dir=None,
+                 group_by_alice_block=False):
         """Initialise the class and set the required parameters.
 
        Arguments:
@@ -39,6 +42,24 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
                             minimum similarity between adjacent reference
                             values, or by merging blocks until they each
                             contain k record identifiers.
+       - num_workers        The number of worker processes used to insert
+                            records into the sorted reference values (default
+                            1, no worker processes).
+       - sim_pairs          An optional function which takes two lists of
+                            strings of the same length and returns the
+                            similarities of the pairs of strings at the same
+                            positions in one batch (such as
+                            DiceSim.sim_pairs()), used to calculate the
+                            similarities between adjacent reference values.
+       - cache_dir          An optional directory where the similarities
+                            between adjacent reference values are stored, so
+                            later runs with the same reference values do not
+                            need to calculate them again.
+       - group_by_alice_block  If set to True then one candidate block is
+                            generated for each block of Alice (with the
+                            records of all overlapping blocks of Bob), instead
+                            of one candidate block for each pair of
+                            overlapping blocks (default False).
     """
 
         self.k = k
@@ -49,11 +70,22 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
         assert sim_or_size in ['SIM', 'SIZE']
         self.sim_or_size = sim_or_size
 
+        assert num_workers >= 1
+        self.num_workers = num_workers
+
+        self.sim_pairs = sim_pairs
+        self.cache_dir = cache_dir
+
+        self.group_by_alice_block = group_by_alice_block
+
         self.ref_val_list = None  # List of selected reference values
 
         self.ref_ind_dict = None  # Reference values with integer values as keys
         # (with reference values sorted)
 
+        self.adj_sim_list = None  # Similarities between adjacent sorted
+        # reference values
+
     # --------------------------------------------------------------------------
     def __sort_ref_values__(self):
         """Sort the reference values and assign an integer value (starting from 0)
@@ -75,6 +107,7 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
 
         self.ref_ind_dict = ref_ind_dict
         self.sort_ref_val_list = sort_ref_val_list
+        self.adj_sim_list = None
 
     # --------------------------------------------------------------------------
     def __generate_sorted_index__(self, rec_dict, attr_select_list):
@@ -108,36 +141,40 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
         block_dict = {}  # Resulting blocks generated
         blk_keys = []  # Resulting block keys
 
-        num_rec_done = 0
-
-        # Insert the records into the sorted reference dictionary
+        # Only the distinct SKVs need to be located in the sorted reference values
         #
-        for (rec_id, rec_list) in rec_dict.items():
-            num_rec_done += 1
-            if num_rec_done % int(len(rec_dict) / 5) == 0:
-                print(num_rec_done, len(rec_dict))
+        rec_id_list, skv_ind_list, skv_list = \
+            self.__get_distinct_bkv__(rec_dict, attr_select_list)
 
-            # Generate the SKV for this record
-            #
-            sk_val = ''
-            for col_num in attr_select_list:
-                sk_val += rec_list[col_num]
+        # Find the position of each SKV in the sorted list of ref vals
+        #
+        skv_pos_list = self.__place_distinct_bkv__(
+            partial(self.__find_sorted_pos__, sort_ref_val_list), skv_list,
+            self.num_workers)
 
-            # Find the position of this SKV in the sorted list of ref vals and
-            # insert it into the corresponding list of record identifiers in the
-            # reference dictionary
-            #
-            pos = bisect.bisect(sort_ref_val_list, sk_val)
-            ref_val = ref_ind_dict[pos]
-            skvs_list = ref_val_dict[ref_val]
-            # skvs_list.append((sk_val,rec_id))  # Store value and record identifier
-            skvs_list.append(rec_id)
-            ref_val_dict[ref_val] = skvs_list
+        # Insert the records into the corresponding list of record identifiers
+        # in the sorted reference dictionary
+        #
+        pos_rec_id_list = self.__group_rec_ids_by_pos__(rec_id_list, skv_ind_list,
+                                                        skv_pos_list, len(ref_ind_dict))
+        for (pos, pos_rec_ids) in enumerate(pos_rec_id_list):
+            if (len(pos_rec_ids) > 0):
+                ref_val_dict[ref_ind_dict[pos]] = pos_rec_ids
 
         len_sort_ref_list = len(sort_ref_val_list)
 
         # a) max block criteria - min similarity between ref values
         if self.sim_or_size == 'SIM':
+            # The similarities between the first 3/4 of adjacent reference
+            # values only depend on the reference values, so they are only
+            # calculated once (for both database owners)
+            #
+            if (self.adj_sim_list == None):
+                self.adj_sim_list = self.__get_adjacent_sim_list__(
+                    [ref_ind_dict[ref_ind] for ref_ind in range(len(ref_ind_dict))],
+                    sim_measure, self.sim_pairs, 0.75, self.cache_dir)
+            adj_sim_list = self.adj_sim_list
+
             # Merge blocks if they contain less than k elements
             #
             i = 0
@@ -160,35 +197,30 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
                     # Similarity of the next (if not the last) ref value with this ref value
                     #
                     if ((i + j + 1) != len_sort_ref_list):
-                        next_ref_val = ref_ind_dict[i + j + 1]
-                        min_len = int(3 * min(len(this_ref_val), len(next_ref_val)) / 4)
-                        sim_val = sim_measure(this_ref_val[:min_len], next_ref_val[:min_len])
-                        # if sim_val >= 0.95:
-                        #     print(this_ref_val, next_ref_val)
+                        sim_val = adj_sim_list[i + j]
 
                     j += 1
 
                 # If a block contains less than k elements (probably the last block)
                 # merge it with the previous block
                 #
+                # (blocks are generated in the order of the reference values, so
+                # the previous block is always the last one generated)
+                #
                 if (len(this_blk_elements_list) < k):
-                    prev_blk_str = '_' + str(i - 1) + '_'
-                    prev_blk_id = next(k for (k, v) in block_dict.items() if \
-                                       prev_blk_str in k)
+                    prev_blk_id = blk_keys.pop()
                     prev_blk_elements_list = block_dict[prev_blk_id]
                     this_blk_elements_list += prev_blk_elements_list
-                    block_id = prev_blk_id
+                    first_ref_ind = prev_blk_id[0]
                     del block_dict[prev_blk_id]  # Delete this block and add a new
                     # merged block
-                    blk_keys.remove(prev_blk_id)
                 else:
-                    block_id = 'b_'
+                    first_ref_ind = i
 
-                # Generate the block identifier of this block consisting of the indices
-                # of all the reference values in the block
+                # The block identifier of this block is the pair of the indices
+                # of the first and last reference values in the block
                 #
-                for b in range(j):
-                    block_id += str(i + b) + '_'
+                block_id = (first_ref_ind, i + j - 1)
 
                 # Insert the list of record identifiers for this block into final dict
                 #
@@ -203,74 +235,150 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
         # merge with the smallest nearest blocks.
         #
         elif (self.sim_or_size == 'SIZE'):
-            blk_keys = []
-            blk_size = {}
-            for ref_ind in ref_ind_dict:
-                ref_val = ref_ind_dict[ref_ind]
-                attr_vals = ref_val_dict[ref_val]
-                blk_id = 'b_' + str(ref_ind) + '_'
-                block_dict[blk_id] = attr_vals
-                blk_keys.append(blk_id)
-                blk_size[blk_id] = len(attr_vals)
-
-            merge_block = ''
-            min_size_blk = min(blk_size, key=blk_size.get)
-            min_size = blk_size[min_size_blk]
-            while (min_size < k and len(blk_keys) > 1):
-                bid = min_size_blk
-                s = blk_keys.index(bid)
-                blk_vals = block_dict[min_size_blk]
-                if s != 0 and s != len(blk_keys) - 1:  ## middle blocks
-                    prev_blk_id = blk_keys[s - 1]
-                    prev_blk_vals = block_dict[prev_blk_id]
-                    num_prev_blk_vals = len(prev_blk_vals)
-                    next_blk_id = blk_keys[s + 1]
-                    next_blk_vals = block_dict[next_blk_id]
-                    num_next_blk_vals = len(next_blk_vals)
-                    if num_prev_blk_vals < num_next_blk_vals:
-                        merge_block = 'prev'
-                    else:
-                        merge_block = 'next'
-                elif s == 0:  ## first block
-                    next_blk_id = blk_keys[s + 1]
-                    next_blk_vals = block_dict[next_blk_id]
-                    merge_block = 'next'
-                elif s == len(blk_keys) - 1:  ## last block
-                    prev_blk_id = blk_keys[s - 1]
-                    prev_blk_vals = block_dict[prev_blk_id]
-                    merge_block = 'prev'
-
-                if merge_block == 'prev':  # merge with next block
-                    prev_blk_vals += blk_vals
-                    new_blk_id = prev_blk_id + bid[2:]
-                    block_dict[new_blk_id] = prev_blk_vals  # new block
-                    del block_dict[prev_blk_id]  # del prev block
-                    blk_keys[s - 1] = new_blk_id
-                    del blk_keys[s]
-                    blk_size[new_blk_id] = len(prev_blk_vals)
-                    del blk_size[prev_blk_id]
-                    del block_dict[bid]  # del this block
-                    del blk_size[bid]
-                elif merge_block == 'next':  # merge with previous block
-                    next_blk_vals += blk_vals
-                    new_blk_id = bid + next_blk_id[2:]
-                    block_dict[new_blk_id] = next_blk_vals  # new block
-                    del block_dict[next_blk_id]  # del next block
-                    blk_keys[s + 1] = new_blk_id
-                    del blk_keys[s]
-                    blk_size[new_blk_id] = len(next_blk_vals)
-                    del blk_size[next_blk_id]
-                    del block_dict[bid]  # del this block
-                    del blk_size[bid]
-
-                min_size_blk = min(blk_size, key=blk_size.get)
-                min_size = blk_size[min_size_blk]
+            block_dict = self.__merge_blocks_by_size__(ref_val_dict)
 
         # print block_dict.keys()
         return block_dict
 
     # --------------------------------------------------------------------------
 
+    def __merge_blocks_by_size__(self, ref_val_dict):
+        """Merge the blocks of the sorted reference values until each block
+       contains at least k records. The smallest block is repeatedly merged
+       with the smaller of its two neighbouring blocks (with the next block
+       if both have the same size).
+
+       Arguments:
+       - ref_val_dict  A dictionary with the reference values as keys and
+                       the lists of record identifiers inserted into them as
+                       values.
+
+       Blocks are kept in a min-heap of (size, block number) pairs, where
+       merged blocks get new (increasing) numbers so that among blocks of the
+       same size the oldest block is merged first. Entries of blocks that have
+       been merged are skipped when they reach the top of the heap. The
+       neighbours of each block are kept in a doubly linked list. Each merge
+       therefore takes O(log R) time, and the record identifier lists are
+       only built once all merges are done.
+
+       The method returns a dictionary with the merged blocks, where the key
+       of each block is the pair of the indices of its first and last
+       reference values.
+    """
+
+        k = self.k
+        ref_ind_dict = self.ref_ind_dict
+
+        blk_size_list = []  # Number of records in each block
+        blk_child_list = []  # For merged blocks the two blocks merged, for
+        # the initial blocks their list of record ids
+        blk_range_list = []  # First and last reference index in each block
+        prev_blk_list = []  # Number of the previous block (-1 if none)
+        next_blk_list = []  # Number of the next block (-1 if none)
+        blk_alive_list = []  # False once a block has been merged
+
+        num_ref = len(ref_ind_dict)
+
+        for ref_ind in range(num_ref):
+            attr_vals = ref_val_dict[ref_ind_dict[ref_ind]]
+            blk_size_list.append(len(attr_vals))
+            blk_child_list.append(attr_vals)
+            blk_range_list.append((ref_ind, ref_ind))
+            prev_blk_list.append(ref_ind - 1)
+            if (ref_ind + 1 < num_ref):
+                next_blk_list.append(ref_ind + 1)
+            else:
+                next_blk_list.append(-1)
+            blk_alive_list.append(True)
+
+        blk_heap = [(blk_size_list[b], b) for b in range(num_ref)]
+        heapq.heapify(blk_heap)
+
+        num_blk = num_ref
+
+        while (num_blk > 1):
+            min_size, bid = blk_heap[0]
+
+            if (blk_alive_list[bid] == False):  # Block has been merged before
+                heapq.heappop(blk_heap)
+                continue
+
+            if (min_size >= k):
+                break
+
+            heapq.heappop(blk_heap)
+
+            prev_bid = prev_blk_list[bid]
+            next_bid = next_blk_list[bid]
+
+            if (prev_bid != -1) and (next_bid != -1):  # Middle blocks
+                merge_prev = (blk_size_list[prev_bid] < blk_size_list[next_bid])
+            else:  # First or last block
+                merge_prev = (next_bid == -1)
+
+            if (merge_prev == True):
+                other_bid = prev_bid
+                first_bid, last_bid = prev_bid, bid
+            else:
+                other_bid = next_bid
+                first_bid, last_bid = bid, next_bid
+
+            # The new block contains the records of the neighbouring block
+            # followed by the records of this block
+            #
+            new_bid = len(blk_size_list)
+            blk_size_list.append(blk_size_list[other_bid] + min_size)
+            blk_child_list.append((other_bid, bid))
+            blk_range_list.append((blk_range_list[first_bid][0],
+                                   blk_range_list[last_bid][1]))
+            blk_alive_list.append(True)
+
+            # Replace the two blocks with the new block in the linked list
+            #
+            new_prev_bid = prev_blk_list[first_bid]
+            new_next_bid = next_blk_list[last_bid]
+            prev_blk_list.append(new_prev_bid)
+            next_blk_list.append(new_next_bid)
+            if (new_prev_bid != -1):
+                next_blk_list[new_prev_bid] = new_bid
+            if (new_next_bid != -1):
+                prev_blk_list[new_next_bid] = new_bid
+
+            blk_alive_list[bid] = False
+            blk_alive_list[other_bid] = False
+
+            heapq.heappush(blk_heap, (blk_size_list[new_bid], new_bid))
+            num_blk -= 1
+
+        # Generate the remaining blocks in the order they were created
+        #
+        block_dict = {}
+
+        for bid in range(len(blk_size_list)):
+            if (blk_alive_list[bid] == False):
+                continue
+
+            blk_id = blk_range_list[bid]  # (first, last) reference index
+
+            blk_vals = []
+            blk_stack = [bid]
+            while (len(blk_stack) > 0):
+                this_bid = blk_stack.pop()
+                if (this_bid < num_ref):  # An initial block
+                    blk_vals += blk_child_list[this_bid]
+                else:
+                    first_child_bid, second_child_bid = blk_child_list[this_bid]
+                    blk_stack.append(second_child_bid)
+                    blk_stack.append(first_child_bid)
+
+            assert len(blk_vals) == blk_size_list[bid]
+
+            block_dict[blk_id] = blk_vals
+
+        return block_dict
+
+    # --------------------------------------------------------------------------
+
     def build_index_alice(self, attr_select_list):
         """Build the index for Alice assuming the sorted reference values have
        been generated.
@@ -357,6 +465,20 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
     def generate_blocks(self):
         """Method which generates the blocks based on the built two index data
        structures.
+
+       Each block of Alice is joined with all blocks of Bob that contain a
+       reference value in the range of reference values of Alice's block,
+       extended by overlap reference values on both sides. Both indexes are
+       partitions of the sorted reference values, so the blocks of Bob for a
+       range are found by looking up the block of its first reference value
+       and then following Bob's blocks in sorted order.
+
+       For each pair of joined blocks a candidate block is generated that
+       contains the two record identifier lists from the indexes (these lists
+       are not copied, and as each record is in only one block of its index
+       no candidate record pair is generated twice). If group_by_alice_block
+       is set then one candidate block is generated for each block of Alice
+       instead, containing the records of all joined blocks of Bob.
     """
 
         block_dict = {}  # contains final candidate record pairs
@@ -368,65 +490,62 @@ class PPRLIndexKAnonymousSortedNeighbour(PPRLIndex):
         overlap = self.overlap
         k = self.k
 
-        bob_block_lookup = {}  # Lookup dictionary that contains the block ids for
-        # each reference id in Bob's index
+        max_ref_ind = len(self.sort_ref_val_list) - 1  # Last index in overlaps
 
-        # Build Lookup dictionary for Bob's blocks
+        # Bob's blocks sorted by their reference value ranges, and a lookup
+        # list that contains the block id for each reference index
         #
-        for block_id in self.index_bob.keys():
-            bob_block_nums = block_id.split('_')
-            bob_blocks = bob_block_nums[1:-1]
-            for blk in bob_blocks:
-                bob_block_lookup[blk] = block_id
-
-        # print 'bob_block_lookup', bob_block_lookup
-        cand_pairs_list = []  # contains unique candidate pairs
+        bob_range_list = sorted(index_bob.keys())
+        bob_pos_dict = dict([(bob_blk, pos) for (pos, bob_blk) in \
+                             enumerate(bob_range_list)])
+
+        bob_block_lookup = self.__get_range_block_lookup__(index_bob,
+                                                           len(self.ref_ind_dict))
+
+        for bob_blk in bob_range_list:
+            assert len(index_bob[bob_blk]) >= k, \
+                (self.__get_range_block_str__(bob_blk), len(index_bob[bob_blk]))
+
         cand_blk_key = 0
 
         # Iterate through Alice's blocks
         #
-        for (block_id, block_vals) in self.index_alice.items():
-            assert len(block_vals) >= k, (block_id, len(block_vals))
-
-            # Get the ids of reference values in each block
-            #
-            block_nums_list = block_id.split('_')
+        for (block_id, block_vals) in index_alice.items():
+            assert len(block_vals) >= k, \
+                (self.__get_range_block_str__(block_id), len(block_vals))
 
-            # First element will be 'b', and last will be empty, so not used
+            # Calculate the range of reference values including the overlap
+            # (never extended to the first, smallest possible, value)
             #
-            block_nums = block_nums_list[1:-1]
-
-            # Calculate overlap blocks
-            #
-            lower_overlap_bound = int(min(block_nums)) - overlap
-            upper_overlap_bound = int(max(block_nums)) + overlap
-            if lower_overlap_bound > 0:
-                block_nums.insert(0, str(lower_overlap_bound))  # Append at front
-            if upper_overlap_bound < len(self.sort_ref_val_list):
-                block_nums.append(str(upper_overlap_bound))  # Append at end
+            first_ref_ind, last_ref_ind = block_id
+            lower_overlap_bound = min(first_ref_ind, max(first_ref_ind - overlap, 1))
+            upper_overlap_bound = max(last_ref_ind, min(last_ref_ind + overlap,
+                                                        max_ref_ind))
 
             alice_blk_list = block_vals
-            bob_blks = set([])  # Bob's blocks that have this ref value
-            bob_blk_list = []  # Bob's rec ids in these blocks
+            bob_blk_list = []  # Bob's rec ids in these blocks (if grouped)
 
-            # Find Bob's blocks that have this reference value
+            # Find Bob's blocks that overlap with this range
             #
-            for block_num in block_nums:
-                bob_block = bob_block_lookup[block_num]
-                bob_blks.add(bob_block)  # Only keep unique values
+            bob_block = bob_block_lookup[lower_overlap_bound]
+            assert bob_block != None, lower_overlap_bound
+            bob_pos = bob_pos_dict[bob_block]
 
-            list(bob_blks)
+            while (bob_pos < len(bob_range_list)) and \
+                    (bob_range_list[bob_pos][0] <= upper_overlap_bound):
+                bob_blk = bob_range_list[bob_pos]
 
-            # Get all Bob's record ids that are in these blocks
-            #
-            for bob_blk in bob_blks:
-                assert len(index_bob[bob_blk]) >= k, (bob_blk, len(index_bob[bob_blk]))
-
-                bob_blk_list += index_bob[bob_blk]
+                if (self.group_by_alice_block == True):
+                    bob_blk_list += index_bob[bob_blk]
+                else:
+                    block_dict[cand_blk_key] = (alice_blk_list, index_bob[bob_blk])
+                    cand_blk_key += 1
 
-            block_dict[cand_blk_key] = (alice_blk_list, bob_blk_list)
+                bob_pos += 1
 
-            cand_blk_key += 1
+            if (self.group_by_alice_block == True):
+                block_dict[cand_blk_key] = (alice_blk_list, bob_blk_list)
+                cand_blk_key += 1
 
         self.block_dict = block_dict
         # print block_dict
@@ -66,50 +66,103 @@ class PPRLIndexPSignature(PPRLIndex):
             bloom = bloom.union(bloom_set)
         return bloom
 
-    def get_sig(self, records, ngram_dict):
-        """Obtain N-gram of selected attributes for all records."""
-        ngrams = set()
-        sig_list = self.sig_list
-        # rec_in_blocks_dict = {}
+    def compile_sig(self, sig):
+        """Compile one signature specification (e.g. '1,0:1,1:3,q2') into a
+        function which takes a record (with the record identifier first) and
+        returns the list of its signature values, in the order they are added
+        to the N-gram dictionary.
+
+        Each part of a specification is an attribute index with a character
+        index, '*' for the whole value, or 'q<n>' for the q-grams of the value.
+        The q-grams of a part are signature values themselves, and the last one
+        is also the start of the value the following parts are appended to.
+        """
+        part_list = []
+        for sig_char in sig.split(':'):
+            sig_char_list = sig_char.split(',')
+            attr_index = int(sig_char_list[0])
+            char_index = sig_char_list[1]
+
+            # Records start with the record identifier
+            col = attr_index + 1 if attr_index >= 0 else attr_index
+
+            if 'q' in char_index:
+                part_list.append(('q', col, int(char_index[1:]), '_' + str(attr_index)))
+            elif char_index == '*':
+                part_list.append(('*', col, None, None))
+            else:
+                part_list.append(('c', col, int(char_index), None))
+
+        if len(part_list) == 1 and part_list[0][0] == '*':  # Whole value
+            col = part_list[0][1]
+
+            def sig_funct(rec):
+                sig_val = rec[col]
+                return [sig_val] if sig_val != '' else []
+
+        elif all([part[0] != 'q' for part in part_list]):  # No q-grams
+            col_char_list = [(col, char_index) for (_, col, char_index, _) in part_list]
+
+            def sig_funct(rec):
+                sig_val = ''.join([rec[col] if char_index == None else
+                                   rec[col][char_index] if len(rec[col]) > char_index else '?'
+                                   for (col, char_index) in col_char_list])
+                return [sig_val] if sig_val != '' else []
+
+        elif len(part_list) == 1:  # Only q-grams
+            col, q_val, suffix = part_list[0][1:]
+
+            def sig_funct(rec):
+                attr_val = rec[col]
+                if len(attr_val) < q_val:
+                    return [attr_val, attr_val] if attr_val != '' else ['']
+                sig_val_list = [attr_val[i:i + q_val] + suffix for i in range(len(attr_val) - (q_val - 1))]
+                sig_val_list.append(sig_val_list[-1])
+                return sig_val_list
 
-        for key, rec in records.items():
-            value = rec[1:]
-            for sig in sig_list:
+        else:
+            def sig_funct(rec):
+                sig_val_list = []
                 sig_val = ''
-                sig_chars = sig.split(':')
-                for sig_char in sig_chars:
-                    attr_index = int(sig_char.split(',')[0])
-                    char_index = sig_char.split(',')[1]
-                    # print(value, sig_char, attr_index, char_index)
-
-                    if 'q' in char_index:
-                        q_val = int(char_index[1:])
-                        # generate q-grams
-                        if len(value[attr_index]) < q_val:
-                            val_set = [value[attr_index]]
+                for (part_type, col, arg, suffix) in part_list:
+                    attr_val = rec[col]
+                    if part_type == 'q':
+                        if len(attr_val) < arg:
+                            sig_val_list.append(attr_val)
                         else:
-                            val_set = [value[attr_index][i:i + q_val] + '_' + str(attr_index) for i in
-                                       range(len(value[attr_index]) - (q_val - 1))]
-                        for sig_val in val_set:
-                            if sig_val in ngram_dict:
-                                ngram_dict[sig_val].append(key)
-                            else:
-                                ngram_dict[sig_val] = [key]
-
+                            sig_val_list.extend([attr_val[i:i + arg] + suffix for i in
+                                                 range(len(attr_val) - (arg - 1))])
+                        sig_val = sig_val_list[-1]
+                    elif part_type == '*':
+                        sig_val += attr_val
+                    elif len(attr_val) < arg + 1:
+                        sig_val += '?'
                     else:
-                        if char_index == '*':
-                            sig_val += value[attr_index]
-                        else:
-                            if len(value[attr_index]) < int(char_index) + 1:
-                                sig_val += '?'
-                            else:
-                                sig_val += value[attr_index][int(char_index)]
+                        sig_val += attr_val[arg]
 
                 if sig_val != '':
-                    if sig_val in ngram_dict:
-                        ngram_dict[sig_val].append(key)
-                    else:
+                    sig_val_list.append(sig_val)
+                return sig_val_list
+
+        return sig_funct
+
+    def get_sig(self, records, ngram_dict):
+        """Obtain N-gram of selected attributes for all records."""
+        ngrams = set()
+        # Parse the signature specifications once, not for every record
+        sig_funct_list = [self.compile_sig(sig) for sig in self.sig_list]
+        # rec_in_blocks_dict = {}
+
+        get_key_list = ngram_dict.get
+
+        for key, rec in records.items():
+            for sig_funct in sig_funct_list:
+                for sig_val in sig_funct(rec):
+                    key_list = get_key_list(sig_val)
+                    if key_list == None:
                         ngram_dict[sig_val] = [key]
+                    else:
+                        key_list.append(key)
 
                 # if key in rec_in_blocks_dict:
                 #  rec_in_blocks_dict[key].append(sig_val)
@@ -0,0 +1,186 @@
+"""Condensed Similarity Matrix Class."""
+import os
+import math
+import tempfile
+
+import numpy
+
+from forkpool import can_fork, fork_imap
+
+# ============================================================================
+
+class CondensedSimMatrix:
+    """Class that implements a symmetric matrix of pairwise similarities
+     between num_val values, stored in condensed form.
+
+     Only the num_val*(num_val-1)/2 entries above the diagonal are stored, row
+     by row, in a one-dimensional numpy array, either in memory or in a
+     memory-mapped temporary file (so the matrix can be larger than the
+     available memory). The diagonal is not stored.
+  """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def __init__(self, num_val, dtype=numpy.float32, memmap_dir=None):
+        """Initialise the matrix with all similarities set to 0.
+
+       Arguments:
+       - num_val     The number of values (rows and columns).
+       - dtype       The numpy data type of the similarities (default
+                     float32).
+       - memmap_dir  If given, the matrix is stored in a temporary file in
+                     this directory which is memory-mapped, otherwise it is
+                     kept in memory.
+    """
+
+        self.num_val = num_val
+        self.dtype = numpy.dtype(dtype)
+
+        num_entries = num_val * (num_val - 1) // 2
+
+        self.memmap_file_name = None
+
+        if (memmap_dir == None):
+            self.data = numpy.zeros(num_entries, dtype=self.dtype)
+        else:
+            os.makedirs(memmap_dir, exist_ok=True)
+
+            memmap_file = tempfile.NamedTemporaryFile(dir=memmap_dir,
+                                                      prefix='simmatrix_', suffix='.dat', delete=False)
+            memmap_file.close()
+            self.memmap_file_name = memmap_file.name
+
+            self.data = numpy.memmap(self.memmap_file_name, dtype=self.dtype,
+                                     mode='w+', shape=(max(num_entries, 1),))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def close(self):
+        """Release the matrix, and remove its file if it is memory-mapped.
+    """
+
+        if (self.memmap_file_name != None):
+            del self.data
+            os.remove(self.memmap_file_name)
+            self.memmap_file_name = None
+
+        self.data = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def row_start(self, row):
+        """Return the position of the entry (row, row+1) in the condensed
+       array, that is of the first stored entry of the given row.
+    """
+
+        return row * (2 * self.num_val - row - 1) // 2
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def get_index(self, row_array, col_array):
+        """Return the positions in the condensed array of the entries with the
+       given rows and columns (numpy integer arrays which are broadcast
+       against each other, where no row can be equal to its column).
+    """
+
+        row_array = numpy.asarray(row_array, dtype=numpy.int64)
+        col_array = numpy.asarray(col_array, dtype=numpy.int64)
+
+        i_array = numpy.minimum(row_array, col_array)
+        j_array = numpy.maximum(row_array, col_array)
+
+        return i_array * (2 * self.num_val - i_array - 1) // 2 + (j_array - i_array - 1)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def get(self, row_array, col_array):
+        """Return the similarities of the entries with the given rows and
+       columns (which are broadcast against each other, and where no row can
+       be equal to its column) as a numpy array.
+    """
+
+        return self.data[self.get_index(row_array, col_array)]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def set(self, row_array, col_array, sim_array):
+        """Set the similarities of the entries with the given rows and columns
+       (where no row can be equal to its column).
+    """
+
+        self.data[self.get_index(row_array, col_array)] = sim_array
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def get_row(self, row, diag_val=0.0):
+        """Return all similarities in the given row as a numpy array with
+       num_val entries, where the diagonal entry is set to diag_val.
+    """
+
+        if (self.num_val == 1):
+            return numpy.array([diag_val], dtype=self.dtype)
+
+        col_array = numpy.arange(self.num_val, dtype=numpy.int64)
+        col_array[row] = (row + 1) % self.num_val  # Any other column
+
+        row_sim_array = self.get(row, col_array)
+        row_sim_array[row] = diag_val
+
+        return row_sim_array
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def fill(self, row_funct, num_workers=1, max_block_size=4000000):
+        """Calculate all similarities in blocks of consecutive rows.
+
+       Arguments:
+       - row_funct       A function which takes a start and an end row number
+                         and returns a numpy array with the similarities of
+                         the stored entries of these rows (the entries (i, j)
+                         with start <= i < end and j > i, row by row).
+       - num_workers     The number of worker processes used to calculate the
+                         blocks of rows (default 1, no worker processes).
+                         Workers are forked, so row_funct does not need to be
+                         picklable.
+       - max_block_size  The maximum number of entries in a block of rows.
+
+       Each block is written into the matrix as soon as it is calculated, so
+       only the blocks in progress are held in memory.
+    """
+
+        assert num_workers >= 1
+
+        num_val = self.num_val
+
+        # Blocks of rows with about the same number of entries
+        #
+        num_entries = num_val * (num_val - 1) // 2
+        if (num_workers > 1):  # Several blocks per worker to balance the load
+            block_size = min(max_block_size,
+                             max(1, int(math.ceil(float(num_entries) / (4 * num_workers)))))
+        else:
+            block_size = max_block_size
+
+        row_range_list = []
+        start_row = 0
+        while (start_row < num_val - 1):
+            end_row = start_row + 1
+            while (end_row < num_val - 1) and \
+                    (self.row_start(end_row + 1) - self.row_start(start_row) <= block_size):
+                end_row += 1
+            row_range_list.append((start_row, end_row))
+            start_row = end_row
+
+        if (num_workers == 1) or (len(row_range_list) < 2) or (not can_fork()):
+            for (start_row, end_row) in row_range_list:
+                self.data[self.row_start(start_row):self.row_start(end_row)] = \
+                    row_funct(start_row, end_row)
+            return
+
+        print('  Calculating %d similarities in %d blocks with %d workers' % \
+              (num_entries, len(row_range_list), num_workers))
+
+        for ((start_row, end_row), block_sim_array) in \
+                zip(row_range_list, fork_imap(lambda row_range: row_funct(*row_range),
+                                              row_range_list, num_workers)):
+            self.data[self.row_start(start_row):self.row_start(end_row)] = block_sim_array
@@ -1,5 +1,7 @@
 """Similarity Measure Class."""
 import hashlib
+import logging
+import numpy
 from config import (
     QGRAM_LEN,
     QGRAM_PADDING,
@@ -11,6 +13,11 @@ from config import (
 def editdist(str1, str2, min_threshold=None):
     """Return approximate string comparator measure (between 0.0 and 1.0)
      using the edit (or Levenshtein) distance.
+
+     If a min_threshold (between 0.0 and 1.0) is given the calculation stops
+     as soon as the similarity is known to be below this threshold, and a
+     value smaller than min_threshold is returned. A min_threshold of 0.0
+     (or None) means no such early stopping.
   """
     # Quick check if the strings are empty or the same - - - - - - - - - - - - -
     #
@@ -23,9 +30,11 @@ def editdist(str1, str2, min_threshold=None):
     m = len(str2)
     max_len = max(n, m)
 
-    if (min_threshold != None):
+    use_threshold = (min_threshold != None) and (min_threshold != 0.0)
+
+    if (use_threshold == True):
         if (isinstance(min_threshold, float)) and (min_threshold > 0.0) and \
-                (min_threshold > 0.0):
+                (min_threshold <= 1.0):
 
             len_diff = abs(n - m)
             w = 1.0 - float(len_diff) / float(max_len)
@@ -33,9 +42,6 @@ def editdist(str1, str2, min_threshold=None):
             if (w < min_threshold):
                 return 0.0  # Similariy is smaller than minimum threshold
 
-            else:  # Calculate the maximum distance possible with this threshold
-                max_dist = (1.0 - min_threshold) * max_len
-
         else:
             logging.exception('Illegal value for minimum threshold (not between' + \
                               ' 0 and 1): %f' % (min_threshold))
@@ -62,8 +68,13 @@ def editdist(str1, str2, min_threshold=None):
             #
             current[j] = min(previous[j] + 1, current[j - 1] + 1, substitute)
 
-        if (min_threshold != None) and (min(current) > max_dist):
-            return 1.0 - float(max_dist + 1) / float(max_len)
+        # The distance is at least the smallest value in this row, so the
+        # similarity (calculated as below) is at most this bound
+        #
+        if (use_threshold == True):
+            max_w = 1.0 - float(min(current)) / float(max_len)
+            if (max_w < min_threshold):
+                return max_w
 
     w = 1.0 - float(current[n]) / float(max_len)
 
@@ -73,6 +84,56 @@ def editdist(str1, str2, min_threshold=None):
     return w
 
 
+def levenshtein_dist(str1, str2, max_dist=None):
+    """Return the edit (or Levenshtein) distance between two strings, that is
+     the number of character insertions, deletions and substitutions needed
+     to convert one string into the other.
+
+     This is the distance editdist() converts into a similarity, as
+     1 - distance / max(len(str1), len(str2)).
+
+     If a max_dist is given the calculation stops as soon as the distance is
+     known to be larger than max_dist. The returned value is then a lower
+     bound of the distance that is larger than max_dist (and the distance
+     itself if it was calculated), so only values up to max_dist are exact.
+  """
+
+    if (str1 == str2):
+        return 0
+
+    n = len(str1)
+    m = len(str2)
+
+    if (max_dist != None) and (abs(n - m) > max_dist):
+        return abs(n - m)
+
+    if (n > m):  # Make sure n <= m, to use O(min(n,m)) space
+        str1, str2 = str2, str1
+        n, m = m, n
+
+    current = list(range(n + 1))
+
+    for i in range(1, m + 1):
+
+        previous = current
+        current = [i] + n * [0]
+        str2char = str2[i - 1]
+
+        for j in range(1, n + 1):
+            substitute = previous[j - 1]
+            if (str1[j - 1] != str2char):
+                substitute += 1
+
+            # Get minimum of insert, delete and substitute
+            #
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, substitute)
+
+        if (max_dist != None) and (min(current) > max_dist):
+            return min(current)
+
+    return current[n]
+
+
 # ============================================================================
 
 class SimMeasure:
@@ -87,11 +148,16 @@ class SimMeasure:
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def sim(self, s1, s2, do_cache=False):
+    def sim(self, s1, s2, do_cache=False, min_threshold=None):
         """Calculate and return the similarity between two strings (a value
        between 0 and 1).
 
        If this similarity should be cached set the argument do_cache to True.
+
+       If a min_threshold is given then the calculation can stop early and
+       return 0.0 as soon as an upper bound shows that the similarity is
+       below this threshold (for example when only a similarity larger than
+       the currently best one is of interest).
     """
 
 
@@ -120,11 +186,16 @@ class DiceSim(SimMeasure):
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def sim(self, s1, s2, do_cache=False):
+    def sim(self, s1, s2, do_cache=False, min_threshold=None):
         """Calculate the similarity between the given two strings. The method
        returns a value between 0.0 and 1.0.
 
        If this similarity should be cached set the argument do_cache to True.
+
+       If a min_threshold is given then 0.0 is returned without generating
+       q-grams if the similarity cannot reach this threshold, based on the
+       number of q-grams of the two strings (at most all q-grams of the
+       shorter string can be common).
     """
 
         assert do_cache in [True, False]
@@ -139,6 +210,21 @@ class DiceSim(SimMeasure):
 
         q_minus_1 = QGRAM_LEN - 1
 
+        # Upper bound of the similarity from the lengths of the q-gram lists
+        #
+        if (min_threshold != None) and (min_threshold > 0.0):
+            if (QGRAM_PADDING == True):
+                num_q_gram1 = len(s1) + q_minus_1
+                num_q_gram2 = len(s2) + q_minus_1
+            else:
+                num_q_gram1 = max(len(s1) - q_minus_1, 0)
+                num_q_gram2 = max(len(s2) - q_minus_1, 0)
+
+            num_q_gram_sum = num_q_gram1 + num_q_gram2
+            if (num_q_gram_sum > 0) and \
+                    (2.0 * min(num_q_gram1, num_q_gram2) / num_q_gram_sum < min_threshold):
+                return 0.0  # Similarity is smaller than minimum threshold
+
         # Convert input strings into q-gram lists
         #
         if (do_cache == True) and (s1 in self.q_gram_cache):
@@ -178,6 +264,155 @@ class DiceSim(SimMeasure):
 
         return sim
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def sim_matrix(self, str_list1, str_list2):
+        """Calculate the similarities between all strings in the first list and
+       all strings in the second list in one batch.
+
+       Both lists are converted into binary matrices (one row per string, one
+       column per distinct q-gram), so the numbers of common q-grams of all
+       pairs are obtained with a single matrix multiplication.
+
+       The method returns a numpy array with len(str_list1) rows and
+       len(str_list2) columns, where each entry has the same value as sim()
+       would return for the corresponding string pair.
+    """
+
+        q_minus_1 = QGRAM_LEN - 1
+
+        q_gram_ind_dict = {}  # Distinct q-grams and their column numbers
+        str_ind_dict = {}  # Distinct strings and unique integer numbers
+
+        # Convert each list into the positions of its q-grams in the matrix
+        #
+        def encode(str_list):
+            row_list = []
+            col_list = []
+            num_q_gram_list = []
+            str_ind_list = []
+
+            for (row, s) in enumerate(str_list):
+                if (QGRAM_PADDING == True):
+                    ps = PADDING_START_CHAR * q_minus_1 + s + PADDING_END_CHAR * q_minus_1
+                else:
+                    ps = s
+
+                l = [ps[i:i + QGRAM_LEN] for i in range(len(ps) - q_minus_1)]
+
+                for q in set(l):
+                    row_list.append(row)
+                    col_list.append(q_gram_ind_dict.setdefault(q, len(q_gram_ind_dict)))
+
+                num_q_gram_list.append(len(l))
+                str_ind_list.append(str_ind_dict.setdefault(s, len(str_ind_dict)))
+
+            return row_list, col_list, num_q_gram_list, str_ind_list
+
+        row_list1, col_list1, num_q_gram_list1, str_ind_list1 = encode(str_list1)
+        row_list2, col_list2, num_q_gram_list2, str_ind_list2 = encode(str_list2)
+
+        num_q_gram = len(q_gram_ind_dict)
+
+        q_gram_matrix1 = numpy.zeros((len(str_list1), num_q_gram), dtype=numpy.float32)
+        q_gram_matrix1[row_list1, col_list1] = 1.0
+        q_gram_matrix2 = numpy.zeros((len(str_list2), num_q_gram), dtype=numpy.float32)
+        q_gram_matrix2[row_list2, col_list2] = 1.0
+
+        # Number of common q-grams (counts are exact in float32)
+        #
+        common = q_gram_matrix1.dot(q_gram_matrix2.T).astype(numpy.float64)
+
+        num_q_gram_sum = numpy.add.outer(numpy.array(num_q_gram_list1, dtype=numpy.float64),
+                                         numpy.array(num_q_gram_list2, dtype=numpy.float64))
+
+        sim = 2.0 * common / num_q_gram_sum
+
+        # Quick check for equality as in sim()
+        #
+        sim[numpy.equal.outer(numpy.array(str_ind_list1, dtype=numpy.int64),
+                              numpy.array(str_ind_list2, dtype=numpy.int64))] = 1.0
+
+        return sim
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def sim_pairs(self, str_list1, str_list2):
+        """Calculate the similarities between the pairs of strings at the same
+       positions in the two given lists (which need to be of the same length)
+       in one batch.
+
+       Each string is converted into the set of integer numbers of its
+       q-grams, and the numbers of common q-grams of all pairs are counted
+       with one numpy set intersection over (pair number, q-gram number)
+       codes.
+
+       The method returns a numpy array with one similarity per pair, where
+       each value is the same as sim() would return for that pair.
+    """
+
+        assert len(str_list1) == len(str_list2)
+
+        q_minus_1 = QGRAM_LEN - 1
+
+        num_pairs = len(str_list1)
+
+        q_gram_ind_dict = {}  # Distinct q-grams and their integer numbers
+
+        # Convert each list into the pair numbers and q-gram numbers of the
+        # distinct q-grams of its strings
+        #
+        def encode(str_list):
+            pair_list = []
+            q_gram_list = []
+            num_q_gram_list = []
+
+            for (pair_num, s) in enumerate(str_list):
+                if (QGRAM_PADDING == True):
+                    ps = PADDING_START_CHAR * q_minus_1 + s + PADDING_END_CHAR * q_minus_1
+                else:
+                    ps = s
+
+                l = [ps[i:i + QGRAM_LEN] for i in range(len(ps) - q_minus_1)]
+
+                for q in set(l):
+                    pair_list.append(pair_num)
+                    q_gram_list.append(q_gram_ind_dict.setdefault(q, len(q_gram_ind_dict)))
+
+                num_q_gram_list.append(len(l))
+
+            return pair_list, q_gram_list, num_q_gram_list
+
+        pair_list1, q_gram_list1, num_q_gram_list1 = encode(str_list1)
+        pair_list2, q_gram_list2, num_q_gram_list2 = encode(str_list2)
+
+        num_q_gram = max(len(q_gram_ind_dict), 1)
+
+        code_array1 = numpy.array(pair_list1, dtype=numpy.int64) * num_q_gram + \
+                      numpy.array(q_gram_list1, dtype=numpy.int64)
+        code_array2 = numpy.array(pair_list2, dtype=numpy.int64) * num_q_gram + \
+                      numpy.array(q_gram_list2, dtype=numpy.int64)
+
+        common_code_array = numpy.intersect1d(code_array1, code_array2,
+                                              assume_unique=True)
+
+        common = numpy.bincount(common_code_array // num_q_gram,
+                                minlength=num_pairs).astype(numpy.float64)
+
+        num_q_gram_sum = numpy.array(num_q_gram_list1, dtype=numpy.float64) + \
+                         numpy.array(num_q_gram_list2, dtype=numpy.float64)
+
+        # Quick check for equality as in sim()
+        #
+        equal_array = numpy.array([s1 == s2 for (s1, s2) in zip(str_list1, str_list2)],
+                                  dtype=bool)
+
+        sim = numpy.ones(num_pairs, dtype=numpy.float64)
+        not_equal = numpy.logical_not(equal_array)
+        sim[not_equal] = 2.0 * common[not_equal] / num_q_gram_sum[not_equal]
+
+        return sim
+
 
 # ----------------------------------------------------------------------------
 
@@ -194,10 +429,21 @@ class BloomFilterSim(SimMeasure):
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def __init__(self):
+    def __init__(self, num_hash_funct=10, bf_len=1000):
         """Initialise a Bloom filter.
+
+       Arguments:
+       - num_hash_funct  The number of hash functions used when converting
+                         strings into Bloom filters.
+       - bf_len          The length (in bits) of the Bloom filters.
     """
 
+        assert num_hash_funct > 0
+        assert bf_len > 0
+
+        self.num_hash_funct = num_hash_funct
+        self.bf_len = bf_len
+
         self.bf_cache = {}  # A cache for strings (keys) and their BF (values)
         self.sim_cache = {}  # Store the string pair and its similarity in a
         # cache as well.
@@ -242,10 +488,10 @@ class BloomFilterSim(SimMeasure):
 
         for q in q_gram_list:
 
-            hex_str1 = h1(q).hexdigest()
+            hex_str1 = h1(q.encode('utf-8')).hexdigest()
             int1 = int(hex_str1, 16)
 
-            hex_str2 = h2(q).hexdigest()
+            hex_str2 = h2(q.encode('utf-8')).hexdigest()
             int2 = int(hex_str2, 16)
 
             for i in range(num_hash_funct):
@@ -261,11 +507,15 @@ class BloomFilterSim(SimMeasure):
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    def sim(self, s1, s2, do_cache=False):
+    def sim(self, s1, s2, do_cache=False, min_threshold=None):
         """Calculate the similarity between the given two strings. The method
        returns a value between 0.0 and 1.0.
 
        If this similarity should be cached set the argument do_cache to True.
+
+       If a min_threshold is given then 0.0 is returned without intersecting
+       the Bloom filters if the similarity cannot reach this threshold, based
+       on the number of bits set to 1 in the two Bloom filters.
     """
 
         assert do_cache in [True, False]
@@ -278,11 +528,18 @@ class BloomFilterSim(SimMeasure):
         if ((s1, s2) in self.sim_cache):
             return self.sim_cache[(s1, s2)]
 
-        bf1 = self.str2bf(s1, do_cache)
-        bf2 = self.str2bf(s2, do_cache)
+        bf1 = self.str2bf(s1, self.num_hash_funct, self.bf_len, do_cache)
+        bf2 = self.str2bf(s2, self.num_hash_funct, self.bf_len, do_cache)
 
         num_bit1 = len(bf1)
         num_bit2 = len(bf2)
+
+        # Upper bound of the similarity from the number of 1-bits
+        #
+        if (min_threshold != None) and (min_threshold > 0.0):
+            if (2.0 * min(num_bit1, num_bit2) / (num_bit1 + num_bit2) < min_threshold):
+                return 0.0  # Similarity is smaller than minimum threshold
+
         num_bit_common = len(bf1.intersection(bf2))
 
         sim = 2.0 * num_bit_common / (num_bit1 + num_bit2)
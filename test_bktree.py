@@ -0,0 +1,51 @@
+"""Tests of the BK-tree in bktree."""
+import random
+
+from bktree import BKTree
+from simmeasure import editdist
+
+
+def scan_most_similar(val_list, query_val):
+    """Find the most similar value by comparing the query value with all
+     values in position order, where a value is only kept if it is more
+     similar than the best value so far.
+  """
+
+    best_sim = 0.0
+    best_pos = None
+    for (pos, val) in enumerate(val_list):
+        sim_val = editdist(query_val, val)
+        if (sim_val > best_sim):
+            best_sim = sim_val
+            best_pos = pos
+
+    return best_sim, best_pos
+
+
+def test_find_most_similar():
+    """The BK-tree finds the same (similarity, position) pair as a scan over
+     all values, for small alphabets (with many equal and equally similar
+     values), empty values, and queries that are in the tree.
+  """
+
+    rand = random.Random(42)
+
+    for alphabet in ['ab', 'abcde', 'abcdefghijklmnopqrstuvwxyz']:
+        val_list = [''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 12))) \
+                    for _ in range(300)]
+        query_list = [''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 14))) \
+                      for _ in range(300)] + val_list[:75]
+
+        bk_tree = BKTree(val_list)
+
+        for query_val in query_list:
+            assert bk_tree.find_most_similar(query_val) == \
+                   scan_most_similar(val_list, query_val), (alphabet, query_val)
+
+
+def test_find_most_similar_empty():
+    """Empty trees and empty values give no most similar value."""
+
+    assert BKTree([]).find_most_similar('abc') == (0.0, None)
+    assert BKTree(['', '']).find_most_similar('') == (0.0, None)
+    assert BKTree(['abc']).find_most_similar('') == (0.0, None)
@@ -0,0 +1,101 @@
+"""Tests of the candidate representative pairs in pprl2partyknnsorted."""
+import random
+from itertools import tee
+
+from pprl2partyknnsorted import PPRLIndex2PartyKAnonymousSortedNeighbour
+
+
+def window_cand_rep_pairs(rep_val_list, alice_rep_vals, bob_rep_vals, w):
+    """Find the candidate pairs with the original window loop: overlapping
+     windows of 2*w values, each extended until it contains w values of each
+     party, where pairs are only added if they were not generated before.
+  """
+
+    skip = w * 2
+    iters = tee(rep_val_list, skip)
+    for i in range(1, skip):
+        for each in iters[i:]:
+            next(each, None)
+
+    cand_ref_list = []
+
+    for each in zip(*iters):
+        num_alice_ref = 0
+        num_bob_ref = 0
+        this_win_alice_ref = []
+        this_win_bob_ref = []
+
+        this_window_list = list(each)
+        for val in this_window_list:
+            if val in alice_rep_vals:
+                num_alice_ref += 1
+                if val not in this_win_alice_ref:
+                    this_win_alice_ref.append(val)
+            if val in bob_rep_vals:
+                num_bob_ref += 1
+                if val not in this_win_bob_ref:
+                    this_win_bob_ref.append(val)
+
+        while num_alice_ref < w or num_bob_ref < w:
+            last_ele_this_list = this_window_list[-1]
+            current_pos = rep_val_list.index(last_ele_this_list)
+            if current_pos + 1 < len(rep_val_list):
+                next_element = rep_val_list[current_pos + 1]
+                this_window_list.append(next_element)
+                if next_element in alice_rep_vals:
+                    num_alice_ref += 1
+                    if next_element not in this_win_alice_ref:
+                        this_win_alice_ref.append(next_element)
+                if next_element in bob_rep_vals:
+                    num_bob_ref += 1
+                    if next_element not in this_win_bob_ref:
+                        this_win_bob_ref.append(next_element)
+            else:
+                break
+
+        for this_alice_ref in this_win_alice_ref:
+            for this_bob_ref in this_win_bob_ref:
+                if [this_alice_ref, this_bob_ref] not in cand_ref_list:
+                    cand_ref_list.append([this_alice_ref, this_bob_ref])
+
+    return cand_ref_list
+
+
+def test_cand_rep_pairs():
+    """The two-pointer sweep gives the same candidate pairs (in the same
+     order) as the original window loop, on random representative values
+     with runs of values of only one party and values of both parties.
+  """
+
+    rand = random.Random(42)
+
+    for w in [1, 2, 3, 5]:
+        snc = PPRLIndex2PartyKAnonymousSortedNeighbour(k=3, w=w, sim_measure=None,
+                                                       min_sim_threshold=0.8, overlap=0,
+                                                       sim_or_size='SIZE')
+
+        for _ in range(200):
+            num_val = rand.randint(0, 40)
+            alice_frac = rand.random()
+            both_frac = rand.random() * 0.5
+
+            alice_rep_vals = []
+            bob_rep_vals = []
+            for i in range(num_val):
+                val = 'v%03d' % (i)
+                if (rand.random() < both_frac):
+                    alice_rep_vals.append(val)
+                    bob_rep_vals.append(val)
+                elif (rand.random() < alice_frac):
+                    alice_rep_vals.append(val)
+                else:
+                    bob_rep_vals.append(val)
+
+            rep_val_list = sorted(set(alice_rep_vals) | set(bob_rep_vals))
+
+            cand_ref_list = snc.__get_cand_rep_pairs__(rep_val_list, set(alice_rep_vals),
+                                                        set(bob_rep_vals))
+
+            assert cand_ref_list == window_cand_rep_pairs(rep_val_list, alice_rep_vals,
+                                                          bob_rep_vals, w), \
+                (w, alice_rep_vals, bob_rep_vals)
@@ -0,0 +1,232 @@
+"""Tests of the HLSH key generation and multi-probe LSH in pprlbloomfilterhlsh."""
+import random
+
+import numpy
+
+from pprlbloomfilterhlsh import PPRLIndexBloomFilterHLSH
+
+
+def get_rec_dict(num_rec, rand):
+    """Return random records with two attributes (besides the record
+     identifier), with empty and short values over a small alphabet.
+  """
+
+    rec_dict = {}
+    for rec_num in range(num_rec):
+        rec_dict[str(rec_num)] = [str(rec_num)] + \
+            [''.join(rand.choice('abcdefgh') for _ in range(rand.randint(0, 10))) \
+             for _ in range(2)]
+
+    return rec_dict
+
+
+def get_hlsh(rec_dict, num_bits_hlsh, num_iter_hlsh):
+    """Return a HLSH index with a plan built from the given records.
+  """
+
+    hlsh = PPRLIndexBloomFilterHLSH(num_hash_funct=10)
+    hlsh.rec_dict_alice = rec_dict
+    hlsh.rec_dict_bob = rec_dict
+    hlsh.__use_plan__(hlsh.build_plan([1, 2], [60, 40], num_bits_hlsh, num_iter_hlsh))
+
+    return hlsh
+
+
+def get_set_hlsh_keys(hlsh, attr_val_tuple):
+    """Return the HLSH keys of one value tuple, calculated from its record
+     Bloom filter as a set of the (shuffled) positions of its 1-bits, with
+     the keys read from '0'/'1' strings.
+  """
+
+    hlsh_plan = hlsh.hlsh_plan
+
+    rec_bf = set()
+    attr_offset = 0
+    for (i, attr_val) in enumerate(attr_val_tuple):
+        attr_bf_len = hlsh_plan.attr_bf_len_list[i]
+        attr_bf = hlsh.__str2bf__(attr_val, attr_bf_len)
+
+        for bit_pos in attr_bf.intersection(hlsh_plan.attr_bf_sel_list[i]):
+            rec_bf.add(hlsh_plan.shuffle_bit_list[bit_pos + attr_offset])
+        attr_offset += attr_bf_len
+
+    key_list = []
+    for sample_bit_list in hlsh_plan.hlsh_sample_bits_list:
+        block_str = ''.join(['1' if (bit_pos in rec_bf) else '0' \
+                             for bit_pos in sample_bit_list])
+        key_list.append(int(block_str, 2))
+
+    return key_list
+
+
+def test_hlsh_key_matrix():
+    """The packed-bit keys are the keys of the record Bloom filters as sets,
+     for keys of up to 64 bits (numpy integers) and longer keys (Python
+     integers).
+  """
+
+    rand = random.Random(42)
+    rec_dict = get_rec_dict(500, rand)
+    bkv_list = [tuple(rec[1:]) for rec in rec_dict.values()]
+
+    for num_bits_hlsh in [1, 30, 64, 90]:
+        hlsh = get_hlsh(rec_dict, num_bits_hlsh, 4)
+
+        key_matrix = hlsh.__get_hlsh_key_matrix__(hlsh.hlsh_plan, bkv_list)
+        assert key_matrix.shape == (len(bkv_list), 4)
+
+        for (row, attr_val_tuple) in enumerate(bkv_list):
+            assert [int(key) for key in key_matrix[row]] == \
+                   get_set_hlsh_keys(hlsh, attr_val_tuple), (num_bits_hlsh, attr_val_tuple)
+
+
+def test_rec_bf_matrix_blocks():
+    """The record Bloom filters do not depend on the size of the blocks of
+     rows they are set in, and no values give no keys.
+  """
+
+    rand = random.Random(42)
+    rec_dict = get_rec_dict(200, rand)
+    bkv_list = [tuple(rec[1:]) for rec in rec_dict.values()]
+
+    hlsh = get_hlsh(rec_dict, 30, 4)
+
+    assert (hlsh.__get_rec_bf_matrix__(hlsh.hlsh_plan, bkv_list, max_block_size=7) == \
+            hlsh.__get_rec_bf_matrix__(hlsh.hlsh_plan, bkv_list)).all()
+
+    assert hlsh.__get_hlsh_key_matrix__(hlsh.hlsh_plan, []).shape == (0, 4)
+
+
+def check_probe_bucket_pairs(hlsh, key_array_alice, key_array_bob, num_bits,
+                             num_probe):
+    """Check that the probed buckets of Bob are those with keys that differ
+     in one or two bits from the key of Alice's bucket and are among the
+     num_probe most probable such keys (any of them if there are ties at the
+     last place), in the order of their probabilities.
+
+     Returns the number of probed bucket pairs.
+  """
+
+    bucket_table_alice = hlsh.__get_bucket_table__(key_array_alice)
+    bucket_table_bob = hlsh.__get_bucket_table__(key_array_bob)
+
+    alice_ind_array, bob_ind_array = \
+        hlsh.__get_probe_bucket_pairs__(bucket_table_alice, bucket_table_bob,
+                                        num_bits, num_probe)
+
+    alice_key_list = [int(key) for key in bucket_table_alice[0]]
+    bob_key_list = [int(key) for key in bucket_table_bob[0]]
+    bob_size_list = numpy.diff(bucket_table_bob[1]).tolist()
+
+    # Fraction of Bob's records with each bit set (the first bit is the most
+    # significant bit of a key)
+    #
+    bit_one_frac_list = []
+    for j in range(num_bits):
+        num_one = sum([bob_size for (bob_key, bob_size) in \
+                       zip(bob_key_list, bob_size_list) \
+                       if (bob_key >> (num_bits - 1 - j)) & 1])
+        bit_one_frac_list.append(float(num_one) / sum(bob_size_list))
+
+    probe_pair_list = list(zip(alice_ind_array.tolist(), bob_ind_array.tolist()))
+    assert len(set(probe_pair_list)) == len(probe_pair_list)
+
+    for (alice_ind, alice_key) in enumerate(alice_key_list):
+        flip_prob_list = []
+        for j in range(num_bits):
+            if (alice_key >> (num_bits - 1 - j)) & 1:
+                flip_prob_list.append(1.0 - bit_one_frac_list[j])
+            else:
+                flip_prob_list.append(bit_one_frac_list[j])
+
+        # Probabilities of all keys one or two bits away, in decreasing order
+        #
+        all_prob_list = flip_prob_list + \
+                        [flip_prob_list[j1] * flip_prob_list[j2] \
+                         for j1 in range(num_bits) for j2 in range(j1 + 1, num_bits)]
+        all_prob_list.sort(reverse=True)
+
+        if (num_probe == 0):
+            min_prob = None
+        elif (num_probe <= len(all_prob_list)):
+            min_prob = all_prob_list[num_probe - 1]
+        else:
+            min_prob = 0.0
+
+        # Probability of each of Bob's keys one or two bits away
+        #
+        bob_prob_dict = {}
+        for (bob_ind, bob_key) in enumerate(bob_key_list):
+            diff_bit_list = [j for j in range(num_bits) \
+                             if ((alice_key ^ bob_key) >> (num_bits - 1 - j)) & 1]
+            if (len(diff_bit_list) in [1, 2]):
+                bob_prob_dict[bob_ind] = numpy.prod([flip_prob_list[j] \
+                                                     for j in diff_bit_list])
+
+        probe_prob_list = []
+        for (pair_alice_ind, bob_ind) in probe_pair_list:
+            if (pair_alice_ind == alice_ind):
+                assert bob_ind in bob_prob_dict, (alice_key, bob_key_list[bob_ind])
+                assert bob_prob_dict[bob_ind] >= min_prob - 1e-12
+                probe_prob_list.append(bob_prob_dict[bob_ind])
+
+        # All more probable keys of Bob are probed
+        #
+        if (min_prob != None):
+            for (bob_ind, bob_prob) in bob_prob_dict.items():
+                if (bob_prob > min_prob + 1e-12):
+                    assert (alice_ind, bob_ind) in probe_pair_list, \
+                        (alice_key, bob_key_list[bob_ind], bob_prob, min_prob)
+
+        assert all([probe_prob_list[i] >= probe_prob_list[i + 1] - 1e-12 \
+                    for i in range(len(probe_prob_list) - 1)]), probe_prob_list
+
+    # Pairs are ordered by Alice's bucket
+    #
+    assert (numpy.diff(alice_ind_array) >= 0).all()
+
+    return len(probe_pair_list)
+
+
+def test_probe_bucket_pairs():
+    """Multi-probe LSH probes the most probable keys of Bob one or two bits
+     away from the keys of Alice, for keys of up to 64 bits and longer keys.
+  """
+
+    rand = random.Random(42)
+    hlsh = PPRLIndexBloomFilterHLSH(num_hash_funct=10)
+
+    for num_bits in [3, 8, 20, 70]:
+        if (num_bits <= 64):
+            key_dtype = numpy.uint64
+        else:
+            key_dtype = object
+
+        for num_probe in [0, 1, 3, 10, 50]:
+            num_pairs = 0
+
+            for _ in range(20):
+
+                # Bob's keys with few bits set, and Alice's keys near them
+                #
+                bob_key_list = []
+                for _ in range(rand.randint(1, 60)):
+                    bob_key = 0
+                    for j in range(num_bits):
+                        if (rand.random() < 0.3):
+                            bob_key |= 1 << j
+                    bob_key_list.append(bob_key)
+
+                alice_key_list = []
+                for _ in range(rand.randint(1, 60)):
+                    alice_key = rand.choice(bob_key_list)
+                    for _ in range(rand.randint(0, 3)):
+                        alice_key ^= 1 << rand.randrange(num_bits)
+                    alice_key_list.append(alice_key)
+
+                num_pairs += check_probe_bucket_pairs(hlsh,
+                                                      numpy.array(alice_key_list, dtype=key_dtype),
+                                                      numpy.array(bob_key_list, dtype=key_dtype),
+                                                      num_bits, num_probe)
+
+            assert (num_probe == 0) == (num_pairs == 0), (num_bits, num_probe)
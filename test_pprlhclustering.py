@@ -0,0 +1,93 @@
+"""Tests of the average linkage merges in pprlhclustering."""
+import random
+
+from pprlhclustering import hclustering
+from simmeasure import editdist
+
+
+def scan_hcluster(ref_val_list, dist, nb):
+    """Cluster with the original scan: in each step all pairs of clusters are
+     compared, and the first pair with the highest average similarity (above
+     0.0) is merged (or clusters 0 and 1 if there is none).
+
+     Returns the list of merges (as hclustering.merge_list) and the clusters.
+  """
+
+    clust = {}
+    for (clust_id, ref_val) in enumerate(ref_val_list):
+        clust[clust_id] = [ref_val]
+
+    distances = {}
+    currentclustid = len(clust)
+    merge_list = []
+
+    while len(clust) > nb:
+        lowestpair = [0, 1]
+        closest = 0.0
+
+        clust_ids = list(clust.keys())
+        for i in range(len(clust_ids)):
+            for j in range(i + 1, len(clust_ids)):
+                cluster1 = clust_ids[i]
+                cluster2 = clust_ids[j]
+
+                if (cluster1, cluster2) not in distances:
+                    alli = clust[cluster1]
+                    allj = clust[cluster2]
+                    sim_val = 0.0
+                    for ai in alli:
+                        for aj in allj:
+                            sim_val += dist(ai, aj)
+                    distances[(cluster1, cluster2)] = sim_val / (len(alli) * len(allj))
+
+                d = distances[(cluster1, cluster2)]
+                if d > closest:
+                    closest = d
+                    lowestpair = [cluster1, cluster2]
+
+        clust[currentclustid] = clust[lowestpair[0]] + clust[lowestpair[1]]
+        currentclustid += 1
+        del clust[lowestpair[0]]
+        del clust[lowestpair[1]]
+
+        merge_list.append((lowestpair[0], lowestpair[1], closest))
+
+    return merge_list, clust
+
+
+def coarse_editdist(str1, str2, min_threshold=None):
+    """Edit distance similarity rounded to quarters, which has even more ties.
+  """
+
+    return round(editdist(str1, str2) * 4) / 4.0
+
+
+def test_average_linkage_merges():
+    """The merges (with their similarities) and the final clusters (with
+     their ids and order) are the same as with the original scan, on random
+     short reference values with many tied similarities.
+  """
+
+    rand = random.Random(42)
+
+    for check_num in range(300):
+        num_ref_val = rand.randint(2, 45)
+        nb = rand.randint(1, num_ref_val)
+
+        ref_val_list = [''.join(rand.choice('abcd') for _ in range(rand.randint(1, 6))) \
+                        for _ in range(num_ref_val)]
+        dist = [editdist, coarse_editdist][check_num % 2]
+
+        # The scan fails if it has to merge clusters 0 and 1 after one of
+        # them was merged already
+        #
+        try:
+            merge_list, clust = scan_hcluster(ref_val_list, dist, nb)
+        except KeyError:
+            continue
+
+        hclust = hclustering(dist, nb, 10, 0.3)
+        hclust.ref_val_list = ref_val_list
+
+        assert list(hclust.hcluster().items()) == list(clust.items()), (ref_val_list, nb)
+        assert hclust.merge_list == merge_list, (ref_val_list, nb)
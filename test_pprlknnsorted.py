@@ -0,0 +1,107 @@
+"""Tests of the size-based block merging in pprlknnsorted."""
+import random
+
+from pprlknnsorted import PPRLIndexKAnonymousSortedNeighbour
+
+
+def loop_merge_blocks_by_size(ref_ind_dict, ref_val_dict, k):
+    """Merge blocks with the original loop: repeatedly find the (first)
+     smallest block with min() and merge it with the smaller neighbouring
+     block (the next block if both have the same size), where the identifier
+     of a block is the string of the indices of its reference values.
+
+     The returned blocks are keyed by the pair of their first and last index,
+     as __merge_blocks_by_size__() does.
+  """
+
+    block_dict = {}
+    blk_keys = []
+    blk_size = {}
+    for ref_ind in ref_ind_dict:
+        attr_vals = list(ref_val_dict[ref_ind_dict[ref_ind]])
+        blk_id = 'b_' + str(ref_ind) + '_'
+        block_dict[blk_id] = attr_vals
+        blk_keys.append(blk_id)
+        blk_size[blk_id] = len(attr_vals)
+
+    min_size_blk = min(blk_size, key=blk_size.get)
+    min_size = blk_size[min_size_blk]
+    while (min_size < k and len(blk_keys) > 1):
+        bid = min_size_blk
+        s = blk_keys.index(bid)
+        blk_vals = block_dict[min_size_blk]
+        if s != 0 and s != len(blk_keys) - 1:  ## middle blocks
+            prev_blk_id = blk_keys[s - 1]
+            next_blk_id = blk_keys[s + 1]
+            if len(block_dict[prev_blk_id]) < len(block_dict[next_blk_id]):
+                merge_block = 'prev'
+            else:
+                merge_block = 'next'
+        elif s == 0:  ## first block
+            next_blk_id = blk_keys[s + 1]
+            merge_block = 'next'
+        else:  ## last block
+            prev_blk_id = blk_keys[s - 1]
+            merge_block = 'prev'
+
+        if merge_block == 'prev':
+            prev_blk_vals = block_dict[prev_blk_id] + blk_vals
+            new_blk_id = prev_blk_id + bid[2:]
+            block_dict[new_blk_id] = prev_blk_vals
+            del block_dict[prev_blk_id]
+            blk_keys[s - 1] = new_blk_id
+            del blk_keys[s]
+            blk_size[new_blk_id] = len(prev_blk_vals)
+            del blk_size[prev_blk_id]
+        else:
+            next_blk_vals = block_dict[next_blk_id] + blk_vals
+            new_blk_id = bid + next_blk_id[2:]
+            block_dict[new_blk_id] = next_blk_vals
+            del block_dict[next_blk_id]
+            blk_keys[s + 1] = new_blk_id
+            del blk_keys[s]
+            blk_size[new_blk_id] = len(next_blk_vals)
+            del blk_size[next_blk_id]
+        del block_dict[bid]
+        del blk_size[bid]
+
+        min_size_blk = min(blk_size, key=blk_size.get)
+        min_size = blk_size[min_size_blk]
+
+    range_block_dict = {}
+    for (blk_id, blk_vals) in block_dict.items():
+        ref_ind_list = [int(ref_ind) for ref_ind in blk_id[2:-1].split('_')]
+        range_block_dict[(ref_ind_list[0], ref_ind_list[-1])] = blk_vals
+
+    return range_block_dict
+
+
+def test_merge_blocks_by_size():
+    """The heap-based merging gives the same blocks (with the same record
+     order and in the same order) as the original loop, on random block
+     sizes with empty blocks and many equal sizes.
+  """
+
+    rand = random.Random(42)
+
+    for k in [1, 2, 3, 5, 10]:
+        snc = PPRLIndexKAnonymousSortedNeighbour(k, None, 0.8, 0, 'SIZE')
+
+        for _ in range(200):
+            num_ref = rand.randint(1, 60)
+            max_size = rand.choice([1, 3, 10])
+
+            snc.ref_ind_dict = {}
+            ref_val_dict = {}
+            rec_num = 0
+            for ref_ind in range(num_ref):
+                ref_val = 'r%03d' % (ref_ind)
+                snc.ref_ind_dict[ref_ind] = ref_val
+                ref_val_dict[ref_val] = []
+                for _ in range(rand.randint(0, max_size)):
+                    ref_val_dict[ref_val].append(str(rec_num))
+                    rec_num += 1
+
+            assert list(snc.__merge_blocks_by_size__(ref_val_dict).items()) == \
+                   list(loop_merge_blocks_by_size(snc.ref_ind_dict, ref_val_dict, k).items()), \
+                (k, [len(ref_val_dict[snc.ref_ind_dict[i]]) for i in range(num_ref)])
@@ -0,0 +1,90 @@
+"""Tests of the compiled signature specifications in pprlpsig."""
+import random
+
+from pprlpsig import PPRLIndexPSignature
+
+# Specifications with all kinds of parts, also q-grams longer than the values,
+# q-grams followed by other parts, and negative attribute indexes
+SIG_LIST = ['1,0:1,1:0,0:0,1', '1,0:1,1:3,0:3,1:3,2:3,3', '3,0:3,1:3,2:3,3',
+            '1,0:1,1:2,*:3,*', '1,q3:3,q3', '1,*', '2,*', '1,0:2,0', '1,q2',
+            '3,q2:1,0', '1,*:2,q9', '2,7', '2,q9', '3,q5', '3,q20', '3,*:0,q2:1,0',
+            '2,q30:1,*', '-1,q2', '-2,0:-1,*', '0,*:1,*:2,*:3,*']
+
+
+def parse_get_sig(sig_list, records, ngram_dict):
+    """Generate the N-gram dictionary by parsing each specification for every
+    record, as get_sig() did before specifications were compiled.
+    """
+    for key, rec in records.items():
+        value = rec[1:]
+        for sig in sig_list:
+            sig_val = ''
+            for sig_char in sig.split(':'):
+                attr_index = int(sig_char.split(',')[0])
+                char_index = sig_char.split(',')[1]
+
+                if 'q' in char_index:
+                    q_val = int(char_index[1:])
+                    if len(value[attr_index]) < q_val:
+                        val_set = [value[attr_index]]
+                    else:
+                        val_set = [value[attr_index][i:i + q_val] + '_' + str(attr_index) for i in
+                                   range(len(value[attr_index]) - (q_val - 1))]
+                    # The last q-gram is also the start of sig_val
+                    for sig_val in val_set:
+                        if sig_val in ngram_dict:
+                            ngram_dict[sig_val].append(key)
+                        else:
+                            ngram_dict[sig_val] = [key]
+
+                elif char_index == '*':
+                    sig_val += value[attr_index]
+                elif len(value[attr_index]) < int(char_index) + 1:
+                    sig_val += '?'
+                else:
+                    sig_val += value[attr_index][int(char_index)]
+
+            if sig_val != '':
+                if sig_val in ngram_dict:
+                    ngram_dict[sig_val].append(key)
+                else:
+                    ngram_dict[sig_val] = [key]
+
+    return ngram_dict
+
+
+def get_records(num_rec):
+    """Random records with four attributes, with empty and short values."""
+    rand = random.Random(42)
+
+    records = {}
+    for rec_num in range(num_rec):
+        records[str(rec_num)] = [str(rec_num)] + \
+            [''.join(rand.choice('abc') for _ in range(rand.randint(0, 8))) for _ in range(4)]
+
+    return records
+
+
+def test_get_sig_each_spec():
+    """Each compiled specification gives the same N-gram dictionary (with the
+    same key and record order) as parsing it for every record.
+    """
+    records = get_records(2000)
+
+    for sig in SIG_LIST:
+        psig = PPRLIndexPSignature(20, 2048, [sig])
+        _, ngram_dict = psig.get_sig(records, {})
+        assert list(ngram_dict.items()) == \
+               list(parse_get_sig([sig], records, {}).items()), sig
+
+
+def test_get_sig_all_specs():
+    """All specifications together, added to a dictionary that is not empty,
+    give the same N-gram dictionary as parsing them for every record.
+    """
+    records = get_records(2000)
+
+    psig = PPRLIndexPSignature(20, 2048, SIG_LIST)
+    _, ngram_dict = psig.get_sig(records, {'a': ['x']})
+    assert list(ngram_dict.items()) == \
+           list(parse_get_sig(SIG_LIST, records, {'a': ['x']}).items())
@@ -0,0 +1,63 @@
+"""Tests of the condensed similarity matrix in simmatrix."""
+import os
+
+import numpy
+
+from simmatrix import CondensedSimMatrix
+
+
+def check_sim_matrix(sim_matrix, full_matrix):
+    """Check that the condensed matrix holds the entries of the given
+     symmetric square matrix, in both orders and as whole rows.
+  """
+
+    num_val = full_matrix.shape[0]
+
+    row_array, col_array = numpy.nonzero(~numpy.eye(num_val, dtype=bool))
+    assert (sim_matrix.get(row_array, col_array) == full_matrix[row_array, col_array]).all()
+
+    for row in range(num_val):
+        row_sim_array = sim_matrix.get_row(row, diag_val=-1.0)
+        assert row_sim_array[row] == -1.0
+        assert (numpy.delete(row_sim_array, row) == numpy.delete(full_matrix[row], row)).all()
+
+    # Setting an entry sets it for both orders
+    #
+    if (num_val > 1):
+        sim_matrix.set(numpy.array([num_val - 1]), numpy.array([0]), numpy.array([7.0]))
+        assert sim_matrix.get(0, num_val - 1) == 7.0
+
+
+def test_fill(tmp_path):
+    """Matrices filled from random symmetric square matrices hold their
+     entries, with one and with several worker processes, small and large
+     blocks of rows, and in memory or memory-mapped into a directory that
+     does not exist yet (whose files are removed when closed).
+  """
+
+    rand_state = numpy.random.RandomState(42)
+
+    memmap_dir = os.path.join(str(tmp_path), 'sub')
+
+    for num_val in [1, 2, 3, 17, 60]:
+        full_matrix = rand_state.random_sample((num_val, num_val))
+        full_matrix = full_matrix + full_matrix.T
+
+        def row_funct(start_row, end_row):
+            return numpy.concatenate([full_matrix[i, i + 1:] for i in range(start_row, end_row)] +
+                                     [numpy.zeros(0)])
+
+        for (num_workers, max_block_size, use_memmap) in [(1, 4000000, False), (1, 5, True),
+                                                          (3, 5, False), (3, 4000000, True)]:
+            if (use_memmap == True):
+                sim_matrix = CondensedSimMatrix(num_val, numpy.float64, memmap_dir)
+            else:
+                sim_matrix = CondensedSimMatrix(num_val, numpy.float64)
+
+            sim_matrix.fill(row_funct, num_workers, max_block_size)
+
+            check_sim_matrix(sim_matrix, full_matrix)
+
+            sim_matrix.close()
+
+    assert os.listdir(memmap_dir) == []
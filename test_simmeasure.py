@@ -0,0 +1,114 @@
+"""Tests of the similarity measures in simmeasure."""
+import random
+
+from simmeasure import editdist, levenshtein_dist, DiceSim, BloomFilterSim
+
+
+def get_str_list(num_str=100):
+    """Return random short strings over a small alphabet (so there are many
+     similar and equal strings), and an empty string.
+  """
+
+    rand = random.Random(42)
+
+    return [''.join(rand.choice('abcde') for _ in range(rand.randint(1, 10))) \
+            for _ in range(num_str - 1)] + ['']
+
+
+def test_min_threshold():
+    """With a min_threshold the similarity measures return the same
+     similarity as without one for all string pairs that reach the
+     threshold, and a value below the threshold for all other pairs.
+  """
+
+    str_list = get_str_list()
+
+    for sim_funct in [editdist, DiceSim().sim, BloomFilterSim().sim]:
+        for s1 in str_list:
+            for s2 in str_list:
+                sim_val = sim_funct(s1, s2)
+
+                for min_threshold in [0.2, 0.5, 0.8]:
+                    bound_sim_val = sim_funct(s1, s2, min_threshold=min_threshold)
+
+                    if (sim_val >= min_threshold):
+                        assert bound_sim_val == sim_val, (s1, s2, min_threshold)
+                    else:
+                        assert bound_sim_val < min_threshold, (s1, s2, min_threshold)
+
+
+def test_editdist_min_threshold_exact():
+    """A similarity equal to the threshold is not cut off by rounding."""
+
+    assert editdist('abdcc', 'bdcc') == 0.8
+    assert editdist('abdcc', 'bdcc', min_threshold=0.8) == 0.8
+
+
+def test_dice_sim_matrix():
+    """DiceSim.sim_matrix() gives the similarity of sim() for each pair of a
+     string of the first list and a string of the second list.
+  """
+
+    str_list = get_str_list()
+    other_str_list = str_list[::-1] + str_list[:len(str_list) // 2]
+
+    dice_sim = DiceSim()
+
+    sim_matrix = dice_sim.sim_matrix(str_list, other_str_list)
+    assert sim_matrix.shape == (len(str_list), len(other_str_list))
+
+    for (i, s1) in enumerate(str_list):
+        for (j, s2) in enumerate(other_str_list):
+            assert sim_matrix[i, j] == dice_sim.sim(s1, s2), (s1, s2)
+
+    assert dice_sim.sim_matrix([], str_list).shape == (0, len(str_list))
+
+
+def test_dice_sim_pairs():
+    """DiceSim.sim_pairs() gives the similarity of sim() for the strings at
+     the same positions in the two lists, for all offsets between a list and
+     a rotated copy (which includes pairs of equal strings).
+  """
+
+    str_list = get_str_list()
+
+    dice_sim = DiceSim()
+
+    for offset in range(len(str_list)):
+        other_str_list = str_list[offset:] + str_list[:offset]
+
+        sim_array = dice_sim.sim_pairs(str_list, other_str_list)
+        assert len(sim_array) == len(str_list)
+
+        for (sim_val, s1, s2) in zip(sim_array, str_list, other_str_list):
+            assert sim_val == dice_sim.sim(s1, s2), (s1, s2)
+
+    assert len(dice_sim.sim_pairs([], [])) == 0
+
+
+def test_levenshtein_dist():
+    """levenshtein_dist() gives the distance editdist() converts into its
+     similarity, and with a max_dist the same distance if this is at most
+     max_dist, and otherwise a lower bound of the distance that is larger
+     than max_dist.
+  """
+
+    str_list = get_str_list()
+
+    for s1 in str_list:
+        for s2 in str_list:
+            dist = levenshtein_dist(s1, s2)
+
+            if (s1 != '') and (s2 != ''):
+                assert 1.0 - float(dist) / float(max(len(s1), len(s2))) == \
+                       editdist(s1, s2), (s1, s2)
+
+            for max_dist in [0, 1, 2, 3, 5]:
+                bound_dist = levenshtein_dist(s1, s2, max_dist)
+
+                if (dist <= max_dist):
+                    assert bound_dist == dist, (s1, s2, max_dist)
+                else:
+                    assert max_dist < bound_dist <= dist, (s1, s2, max_dist)
+
+    assert levenshtein_dist('bbae', 'aebb', 2) > 2